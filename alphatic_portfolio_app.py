@@ -19,9 +19,16 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime, timedelta
 import json
+import os
+import glob
+import heapq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pyfolio as pf
-from scipy.optimize import minimize
+from scipy.optimize import minimize, linprog
+from scipy.signal import lfilter
 from scipy import stats
+from scipy import sparse
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -279,6 +286,12 @@ if 'current_portfolio' not in st.session_state:
     st.session_state.current_portfolio = None
 if 'analysis_data' not in st.session_state:
     st.session_state.analysis_data = {}
+if 'hmm_models' not in st.session_state:
+    st.session_state.hmm_models = {}
+if 'factor_data' not in st.session_state:
+    st.session_state.factor_data = {}
+if 'tax_ledger' not in st.session_state:
+    st.session_state.tax_ledger = None
 
 
 # =============================================================================
@@ -1098,6 +1111,33 @@ def get_earliest_start_date(tickers):
     return None
 
 
+@st.cache_data(ttl=3600)
+def fetch_ticker_data(tickers, start_date, end_date):
+    """
+    Memoized yfinance download of adjusted closes
+    
+    Raises instead of returning on failure (including an empty result), so
+    only successful downloads are ever cached.
+    """
+    data = yf.download(
+        tickers,
+        start=start_date,
+        end=end_date,
+        progress=False,
+        auto_adjust=True  # Automatically adjusts for dividends and splits
+    )
+    if data is None or data.empty:
+        raise ValueError(f"No price data returned for {', '.join(tickers)}")
+    
+    if len(tickers) == 1:
+        data = pd.DataFrame(data['Close'])
+        data.columns = tickers
+    else:
+        data = data['Close']
+    
+    return data
+
+
 def download_ticker_data(tickers, start_date, end_date=None):
     """
     Download historical price data for multiple tickers with DIVIDENDS REINVESTED
@@ -1108,26 +1148,14 @@ def download_ticker_data(tickers, start_date, end_date=None):
     - Other corporate actions
     
     This gives you TOTAL RETURN performance, not just price appreciation.
+    Without an end date, data runs through today (the end is exclusive), keyed
+    by date so the cache does not pin a moment in time.
     """
     if end_date is None:
-        end_date = datetime.now()
+        end_date = pd.Timestamp.now().normalize() + pd.Timedelta(days=1)
     
     try:
-        data = yf.download(
-            tickers,
-            start=start_date,
-            end=end_date,
-            progress=False,
-            auto_adjust=True  # Automatically adjusts for dividends and splits
-        )
-        
-        if len(tickers) == 1:
-            data = pd.DataFrame(data['Close'])
-            data.columns = tickers
-        else:
-            data = data['Close']
-        
-        return data
+        return fetch_ticker_data(list(tickers), start_date, end_date)
     except Exception as e:
         st.error(f"Error downloading data: {str(e)}")
         return None
@@ -1137,10 +1165,18 @@ def download_ticker_data(tickers, start_date, end_date=None):
 # PORTFOLIO OPTIMIZATION FUNCTIONS
 # =============================================================================
 
-def calculate_portfolio_returns(prices, weights):
+def calculate_portfolio_returns(prices, weights, rebalance='daily', transaction_cost=0.0):
     """
     Calculate portfolio returns given prices and weights
+    
+    The default rebalances to target every day (constant mix); any other
+    schedule in REBALANCE_SCHEDULES lets holdings drift between rebalances
+    via backtest_portfolio.
     """
+    if rebalance != 'daily' or transaction_cost > 0:
+        return backtest_portfolio(prices, weights, rebalance=rebalance,
+                                  transaction_cost=transaction_cost)['returns']
+    
     returns = prices.pct_change().dropna()
     portfolio_returns = (returns * weights).sum(axis=1)
     
@@ -1155,100 +1191,827 @@ def calculate_portfolio_returns(prices, weights):
     return portfolio_returns
 
 
-def optimize_portfolio(prices, method='max_sharpe'):
+REBALANCE_SCHEDULES = {
+    'daily': 'Daily (Constant Mix)',
+    'monthly': 'Monthly',
+    'quarterly': 'Quarterly',
+    'annual': 'Annual',
+    'band': 'Threshold Band',
+    'none': 'Buy & Hold (No Rebalancing)'
+}
+
+
+def find_band_rebalances(growth, target_weights, band, chunk_size=252):
     """
-    Optimize portfolio weights
+    Rebalance points for a threshold-band policy
+
+    Starting from each rebalance, drifted weights over the following days are
+    computed in one vectorized block (growth is the T+1 x N cumulative gross
+    return index); the first day any weight is more than `band` away from its
+    target becomes the next rebalance. Blocks double in length until a breach
+    is found, so the work is proportional to the path, not its square.
+    """
+    T = growth.shape[0] - 1
+    rebalances = [0]
+    start = 0
+    length = chunk_size
+    
+    while start < T:
+        stop = min(start + length, T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.where(growth[start] > 0, growth[start + 1:stop + 1] / growth[start], 0.0)
+        drifted = relative * target_weights
+        drifted /= drifted.sum(axis=1, keepdims=True)
+        breached = np.flatnonzero((np.abs(drifted - target_weights) > band).any(axis=1))
+        
+        if len(breached) > 0:
+            start = start + 1 + breached[0]
+            rebalances.append(start)
+            length = chunk_size
+        elif stop == T:
+            break
+        else:
+            length *= 2
+    
+    return np.array(rebalances)
+
+
+def rebalance_points(dates, growth, target_weights, rebalance='quarterly', band=0.05):
+    """
+    Rebalance positions (0..T, where 0 is the initial allocation) for a schedule
+
+    dates are the T return dates and growth the T+1 x N cumulative gross
+    return index; see REBALANCE_SCHEDULES for the supported schedules.
+    """
+    T = len(dates)
+    if rebalance == 'daily':
+        return np.arange(T)
+    if rebalance in ('monthly', 'quarterly', 'annual'):
+        codes = pd.DatetimeIndex(dates).to_period({'monthly': 'M', 'quarterly': 'Q', 'annual': 'Y'}[rebalance]).asi8
+        return np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))
+    if rebalance == 'band':
+        return find_band_rebalances(growth, target_weights, band)
+    if rebalance == 'none':
+        return np.array([0])
+    raise ValueError(f"Unknown rebalance schedule '{rebalance}'. Choose from: {', '.join(REBALANCE_SCHEDULES)}")
+
+
+def simulate_rebalancing(growth, target_weights, rebalances, transaction_costs=(0.0,)):
+    """
+    Portfolio value paths for one rebalancing schedule under several cost levels
+
+    Between rebalances holdings are the anchor holdings scaled by the
+    cumulative gross return index, so the whole path is array operations.
+    Drifted weights at a rebalance are scale-free, so turnover does not
+    depend on the cost level and costs (per dollar traded) compound as a
+    product over rebalance dates - every cost level reuses the same drift.
+    
+    Returns: dict with values (K x T+1, starting at 1), drifted (T+1 x N
+    holdings per unit of value at the latest rebalance), anchor_values
+    (K x rebalances), segment (each day's rebalance number), traded (two-way
+    turnover per day) and is_rebalance
+    """
+    T = growth.shape[0] - 1
+    costs = np.atleast_1d(np.asarray(transaction_costs, dtype=float))[:, None]
+    
+    steps = np.arange(T + 1)
+    segment = np.maximum(np.searchsorted(rebalances, steps, side='left') - 1, 0)
+    anchor = rebalances[segment]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.where(growth[anchor] > 0, growth / growth[anchor], 0.0)
+    drifted = relative * target_weights
+    gross = drifted.sum(axis=1)
+    
+    is_rebalance = np.zeros(T + 1, dtype=bool)
+    is_rebalance[rebalances[1:]] = True
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drifted_weights = drifted / gross[:, None]
+    traded = np.where(is_rebalance, np.abs(target_weights - drifted_weights).sum(axis=1), 0.0)
+    
+    # Value after trading at each rebalance: compounding of segment growth net of costs
+    segment_factor = gross[rebalances[1:]] * (1 - costs * traded[rebalances[1:]])
+    anchor_values = np.hstack([np.ones((len(costs), 1)), np.cumprod(segment_factor, axis=1)])
+    values = anchor_values[:, segment] * gross * (1 - costs * traded)
+    
+    return {
+        'values': values,
+        'drifted': drifted,
+        'anchor_values': anchor_values,
+        'segment': segment,
+        'traded': traded,
+        'is_rebalance': is_rebalance
+    }
+
+
+def backtest_portfolio(prices, weights, rebalance='quarterly', band=0.05,
+                       transaction_cost=0.0, initial_value=1.0):
+    """
+    Simulate a portfolio that drifts with prices and rebalances on a schedule
+    
+    rebalance is one of REBALANCE_SCHEDULES: every day, at the last trading
+    day of each month/quarter/year, whenever any weight drifts more than
+    `band` from target, or never (buy and hold). The path is computed by
+    simulate_rebalancing; only the band policy walks from one rebalance to
+    the next. Costs are charged per dollar traded (transaction_cost) on each
+    rebalance; the initial purchase is not charged.
+    
+    Returns: dict with returns, values, holdings (dollars), weights,
+    turnover (one-way, fraction of value), costs (fraction of value) and
+    rebalance_dates
     """
     returns = prices.pct_change().dropna()
-    mean_returns = returns.mean() * 252
-    cov_matrix = returns.cov() * 252
+    if isinstance(weights, dict):
+        target = np.array([weights.get(ticker, 0.0) for ticker in returns.columns], dtype=float)
+    else:
+        target = np.asarray(weights, dtype=float)
     
-    num_assets = len(prices.columns)
+    dates = returns.index
+    growth = np.vstack([np.ones(returns.shape[1]), np.cumprod(1 + returns.values, axis=0)])
+    rebalances = rebalance_points(dates, growth, target, rebalance, band)
+    sim = simulate_rebalancing(growth, target, rebalances, transaction_cost)
     
-    def portfolio_stats(weights):
-        portfolio_return = np.sum(mean_returns * weights)
-        portfolio_std = np.sqrt(np.dot(weights.T, np.dot(cov_matrix, weights)))
-        sharpe_ratio = portfolio_return / portfolio_std
-        return portfolio_return, portfolio_std, sharpe_ratio
+    values = initial_value * sim['values'][0]
+    holdings = np.where(sim['is_rebalance'][:, None], values[:, None] * target,
+                        initial_value * sim['anchor_values'][0, sim['segment']][:, None] * sim['drifted'])
     
-    def neg_sharpe(weights):
-        return -portfolio_stats(weights)[2]
+    index = dates.insert(0, prices.index[prices.index.get_loc(dates[0]) - 1])
+    values = pd.Series(values, index=index, name='value')
+    holdings = pd.DataFrame(holdings, index=index, columns=returns.columns)
     
-    constraints = ({'type': 'eq', 'fun': lambda x: np.sum(x) - 1})
-    bounds = tuple((0, 1) for _ in range(num_assets))
-    initial_guess = num_assets * [1. / num_assets]
+    return {
+        'returns': values.pct_change().iloc[1:].rename('returns'),
+        'values': values,
+        'holdings': holdings,
+        'weights': holdings.div(holdings.sum(axis=1), axis=0),
+        'turnover': pd.Series(sim['traded'] / 2, index=index, name='turnover'),
+        'costs': pd.Series(transaction_cost * sim['traded'], index=index, name='costs'),
+        'rebalance_dates': index[rebalances[1:]]
+    }
+
+
+@st.cache_data(ttl=3600)
+def run_backtest(prices, weights, rebalance='quarterly', band=0.05, transaction_cost=0.0):
+    """
+    Memoized backtest_portfolio for the Rebalancing tab
+    """
+    return backtest_portfolio(prices, weights, rebalance, band, transaction_cost)
+
+
+def run_parallel(function, jobs, max_workers=None, **shared):
+    """
+    Map function(job, **shared) over jobs on a thread pool
+
+    Shared inputs are passed to every call explicitly rather than through
+    module state, so concurrent sessions of the Streamlit server never see
+    each other's data, and nothing is forked from its multithreaded
+    process. The heavy NumPy/SciPy kernels release the GIL. Runs inline for
+    a single worker.
+    """
+    jobs = list(jobs)
+    workers = max(1, min(len(jobs), max_workers or os.cpu_count() or 1))
+    if workers == 1:
+        return [function(job, **shared) for job in jobs]
     
-    if method == 'max_sharpe':
-        result = minimize(neg_sharpe, initial_guess, method='SLSQP', 
-                         bounds=bounds, constraints=constraints)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda job: function(job, **shared), jobs))
+
+
+def run_rebalancing_job(job, growth, dates, target, costs):
+    """
+    Evaluate one (schedule, band) rebalancing job at every cost level
+    """
+    rebalance, band = job
+    rebalances = rebalance_points(dates, growth, target, rebalance, band)
+    sim = simulate_rebalancing(growth, target, rebalances, costs)
+    return {
+        'rebalance': rebalance,
+        'band': band,
+        'values': sim['values'],
+        'turnover': sim['traded'].sum() / 2,
+        'rebalances': len(rebalances) - 1
+    }
+
+
+def sweep_rebalancing_policies(prices, weights, schedules=('daily', 'monthly', 'quarterly', 'annual', 'band', 'none'),
+                               bands=(0.01, 0.02, 0.03, 0.05, 0.075, 0.10, 0.15, 0.20),
+                               transaction_costs=(0.0, 0.0005, 0.001, 0.0025, 0.005),
+                               max_workers=None, risk_free_rate=0.02):
+    """
+    Evaluate a grid of rebalancing policies (schedule x band x cost) on one price history
+
+    Asset returns and their cumulative growth index are computed once and
+    shared. Each distinct schedule (every band width counts as one) is a job
+    run in parallel (run_parallel); a job evaluates all cost
+    levels at once, since costs only rescale the same drift path. All
+    policy returns are scored in one calculate_batch_metrics call.
     
-    return result.x if result.success else initial_guess
+    Returns: dict with metrics (one row per policy: Schedule, Band, Cost,
+    Rebalances, Annual Turnover plus the batch metrics), returns (T x P)
+    and frontier (policies with the best Sharpe for their turnover or less)
+    """
+    returns = prices.pct_change().dropna()
+    if isinstance(weights, dict):
+        target = np.array([weights.get(ticker, 0.0) for ticker in returns.columns], dtype=float)
+    else:
+        target = np.asarray(weights, dtype=float)
+    
+    jobs = [(s, b) for s in schedules for b in (bands if s == 'band' else (None,))]
+    results = run_parallel(
+        run_rebalancing_job, jobs, max_workers,
+        growth=np.vstack([np.ones(returns.shape[1]), np.cumprod(1 + returns.values, axis=0)]),
+        dates=returns.index,
+        target=target,
+        costs=np.asarray(transaction_costs, dtype=float)
+    )
+    
+    years = len(returns) / 252
+    rows = []
+    paths = {}
+    for result in results:
+        schedule_name = REBALANCE_SCHEDULES[result['rebalance']]
+        if result['band'] is not None:
+            schedule_name = f"{schedule_name} ±{result['band']:.1%}"
+        for cost, values in zip(transaction_costs, result['values']):
+            policy = f"{schedule_name} @ {cost * 10000:g} bps"
+            paths[policy] = values[1:] / values[:-1] - 1
+            rows.append({
+                'Policy': policy,
+                'Schedule': result['rebalance'],
+                'Band': result['band'],
+                'Cost': cost,
+                'Rebalances': result['rebalances'],
+                'Annual Turnover': result['turnover'] / years if years > 0 else np.nan
+            })
+    
+    policy_returns = pd.DataFrame(paths, index=returns.index)
+    metrics = pd.DataFrame(rows).set_index('Policy').join(
+        calculate_batch_metrics(policy_returns, risk_free_rate)
+    )
+    
+    # Turnover vs Sharpe frontier: each policy must beat every cheaper policy's Sharpe
+    ranked = metrics.sort_values(['Annual Turnover', 'Sharpe Ratio'], ascending=[True, False])
+    frontier = ranked[ranked['Sharpe Ratio'] > ranked['Sharpe Ratio'].cummax().shift(fill_value=-np.inf)]
+    
+    return {
+        'metrics': metrics,
+        'returns': policy_returns,
+        'frontier': frontier
+    }
 
 
-def calculate_efficient_frontier(prices, num_portfolios=100):
+@st.cache_data(ttl=3600)
+def get_rebalancing_sweep(prices, weights, bands=(0.01, 0.02, 0.03, 0.05, 0.075, 0.10, 0.15, 0.20),
+                          transaction_costs=(0.0, 0.0005, 0.001, 0.0025, 0.005)):
     """
-    Calculate efficient frontier for visualization
+    Memoized sweep_rebalancing_policies for the Rebalancing tab
+    """
+    return sweep_rebalancing_policies(prices, weights, bands=bands, transaction_costs=transaction_costs)
+
+
+MOMENT_ESTIMATORS = {
+    'sample': 'Sample Covariance',
+    'ledoit_wolf': 'Ledoit-Wolf Shrinkage',
+    'oas': 'OAS Shrinkage',
+    'ewma': 'EWMA (Recent-Weighted)'
+}
+
+
+def compute_moments(prices, window=None, estimator='sample', ewma_halflife=60):
+    """
+    Estimate annualized return moments from a price panel
+
+    Computes daily returns once (optionally over the last `window` days),
+    then the mean vector, covariance and correlation matrices using one of
+    MOMENT_ESTIMATORS:
+    - 'sample': unbiased sample covariance (same as returns.cov())
+    - 'ledoit_wolf': shrinks towards a scaled identity with the
+      Ledoit-Wolf optimal intensity
+    - 'oas': Oracle Approximating Shrinkage towards a scaled identity
+    - 'ewma': exponentially weighted mean and covariance, with weights
+      halving every `ewma_halflife` days
+    Pure function (no Streamlit caching or shared state), safe to call from run_parallel worker threads.
     """
     returns = prices.pct_change().dropna()
-    mean_returns = returns.mean() * 252
-    cov_matrix = returns.cov() * 252
+    if window:
+        returns = returns.iloc[-window:]
+    
+    X = returns.values
+    num_obs, num_assets = X.shape
+    shrinkage = 0.0
+    
+    if estimator == 'ewma':
+        decay = 0.5 ** (1 / ewma_halflife)
+        obs_weights = decay ** np.arange(num_obs - 1, -1, -1)
+        obs_weights /= obs_weights.sum()
+        mean = obs_weights @ X
+        centered = X - mean
+        cov = (centered * obs_weights[:, np.newaxis]).T @ centered
+    else:
+        mean = X.mean(axis=0)
+        centered = X - mean
+        
+        if estimator == 'sample':
+            cov = centered.T @ centered / (num_obs - 1)
+        elif estimator in ('ledoit_wolf', 'oas'):
+            emp_cov = centered.T @ centered / num_obs
+            target = np.trace(emp_cov) / num_assets
+            
+            if estimator == 'ledoit_wolf':
+                sq = centered ** 2
+                beta = np.sum(sq.T @ sq / num_obs - emp_cov ** 2) / num_obs
+                delta = np.sum((emp_cov - target * np.eye(num_assets)) ** 2)
+                shrinkage = min(beta, delta) / delta if delta > 0 else 0.0
+            else:
+                alpha = np.mean(emp_cov ** 2)
+                denominator = (num_obs + 1) * (alpha - target ** 2 / num_assets)
+                shrinkage = 1.0 if denominator == 0 else min((alpha + target ** 2) / denominator, 1.0)
+            
+            cov = (1 - shrinkage) * emp_cov + shrinkage * target * np.eye(num_assets)
+        else:
+            raise ValueError(f"Unknown covariance estimator: {estimator}")
+    
+    vols = np.sqrt(np.diag(cov))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / np.outer(vols, vols)
+    np.fill_diagonal(corr, 1.0)
+    
+    columns = prices.columns
+    return {
+        'returns': returns,
+        'mean_returns': pd.Series(mean * 252, index=columns),
+        'cov_matrix': pd.DataFrame(cov * 252, index=columns, columns=columns),
+        'corr_matrix': pd.DataFrame(corr, index=columns, columns=columns),
+        'estimator': estimator,
+        'shrinkage': shrinkage
+    }
+
+
+@st.cache_data(ttl=3600)
+def estimate_moments(prices, window=None, estimator='sample', ewma_halflife=60):
+    """
+    Cached moments for a price panel - computed once per (prices, window, estimator)
+    """
+    return compute_moments(prices, window, estimator, ewma_halflife)
+
+
+OPTIMIZATION_METHODS = {
+    'max_sharpe': 'Max Sharpe',
+    'min_variance': 'Min Variance',
+    'risk_parity': 'Risk Parity',
+    'max_diversification': 'Max Diversification',
+    'min_cvar': 'Min CVaR',
+    'target_volatility': 'Target Volatility'
+}
+
+
+def optimize_portfolio(prices, method='max_sharpe', risk_free_rate=0.0, bounds=None,
+                       group_constraints=None, target_volatility=0.10, cvar_alpha=0.95,
+                       initial_weights=None, moments=None):
+    """
+    Optimize portfolio weights
+
+    Methods (see OPTIMIZATION_METHODS):
+    - 'max_sharpe': maximize (μ'w - rf) / σ
+    - 'min_variance': minimize w'Σw
+    - 'risk_parity': equalize each asset's share of portfolio variance
+    - 'max_diversification': maximize (σ_i'w) / σ
+    - 'min_cvar': minimize historical CVaR of daily returns, solved as a
+      linear program on the return scenarios (Rockafellar-Uryasev)
+    - 'target_volatility': maximize return subject to σ <= target_volatility;
+      when the target is below the minimum-variance volatility, the
+      minimum-variance weights are returned
+
+    `bounds` is either a single (low, high) pair applied to every asset or a
+    dict {ticker: (low, high)}; unlisted tickers default to (0, 1).
+    `group_constraints` is a list of {'tickers': [...], 'min': x, 'max': y}.
+    All smooth objectives are solved by SLSQP with analytic gradients.
+    `moments` (from estimate_moments) defaults to the cached sample estimate.
+    """
+    if moments is None:
+        moments = estimate_moments(prices)
+    returns = moments['returns']
+    mean_returns = moments['mean_returns'].values
+    cov_matrix = moments['cov_matrix'].values
     
     num_assets = len(prices.columns)
-    results = np.zeros((3, num_portfolios))
-    weights_array = []
     
-    for i in range(num_portfolios):
-        weights = np.random.random(num_assets)
-        weights /= np.sum(weights)
-        weights_array.append(weights)
-        
-        portfolio_return = np.sum(mean_returns * weights)
-        portfolio_std = np.sqrt(np.dot(weights.T, np.dot(cov_matrix, weights)))
-        sharpe = portfolio_return / portfolio_std
-        
-        results[0,i] = portfolio_return
-        results[1,i] = portfolio_std
-        results[2,i] = sharpe
+    if bounds is None:
+        bounds = tuple((0, 1) for _ in range(num_assets))
+    elif isinstance(bounds, dict):
+        bounds = tuple(bounds.get(ticker, (0, 1)) for ticker in prices.columns)
+    else:
+        bounds = tuple(tuple(bounds) for _ in range(num_assets))
+    
+    # Linear group constraints as rows of A with lower/upper limits
+    group_rows, group_min, group_max = [], [], []
+    for group in group_constraints or []:
+        group_rows.append(prices.columns.isin(group['tickers']).astype(float))
+        group_min.append(group.get('min', 0.0))
+        group_max.append(group.get('max', 1.0))
+    
+    ones = np.ones(num_assets)
+    constraints = [{'type': 'eq', 'fun': lambda x: np.sum(x) - 1, 'jac': lambda x: ones}]
+    for row, low, high in zip(group_rows, group_min, group_max):
+        constraints.append({'type': 'ineq', 'fun': lambda x, a=row, l=low: a @ x - l, 'jac': lambda x, a=row: a})
+        constraints.append({'type': 'ineq', 'fun': lambda x, a=row, h=high: h - a @ x, 'jac': lambda x, a=row: -a})
+    
+    if initial_weights is not None:
+        initial_guess = np.asarray(initial_weights, dtype=float)
+    else:
+        initial_guess = ones / num_assets
+    
+    if method == 'min_cvar':
+        # Variables [w, VaR, u_1..u_T]: minimize VaR + Σu / ((1 - α) T)
+        # subject to u_t >= -r_t'w - VaR, u_t >= 0
+        scenarios = returns.values
+        num_scenarios = len(scenarios)
+        c = np.concatenate([np.zeros(num_assets), [1.0],
+                            np.full(num_scenarios, 1.0 / ((1 - cvar_alpha) * num_scenarios))])
+        # Sparse so the T x T slack block stays O(T) in memory
+        A_ub = sparse.hstack([sparse.csr_matrix(-scenarios), -np.ones((num_scenarios, 1)),
+                              -sparse.eye(num_scenarios)], format='csr')
+        b_ub = np.zeros(num_scenarios)
+        if group_rows:
+            group_matrix = np.array(group_rows)
+            padding = sparse.csr_matrix((len(group_rows), 1 + num_scenarios))
+            A_ub = sparse.vstack([A_ub, sparse.hstack([group_matrix, padding]),
+                                  sparse.hstack([-group_matrix, padding])], format='csr')
+            b_ub = np.concatenate([b_ub, group_max, -np.array(group_min)])
+        A_eq = np.concatenate([ones, np.zeros(1 + num_scenarios)])[np.newaxis, :]
+        lp_bounds = list(bounds) + [(None, None)] + [(0, None)] * num_scenarios
+        
+        result = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=[1.0],
+                         bounds=lp_bounds, method='highs')
+        return result.x[:num_assets] if result.success else initial_guess
+    
+    def neg_sharpe(weights):
+        cov_w = cov_matrix @ weights
+        portfolio_std = np.sqrt(weights @ cov_w)
+        excess = mean_returns @ weights - risk_free_rate
+        value = -excess / portfolio_std
+        grad = -(mean_returns * portfolio_std - excess * cov_w / portfolio_std) / portfolio_std ** 2
+        return value, grad
+    
+    def variance(weights):
+        cov_w = cov_matrix @ weights
+        return weights @ cov_w, 2 * cov_w
+    
+    def risk_parity(weights):
+        # Squared deviation of risk contributions w_i(Σw)_i / w'Σw from 1/N
+        cov_w = cov_matrix @ weights
+        port_var = weights @ cov_w
+        contrib = weights * cov_w / port_var
+        diff = contrib - 1.0 / num_assets
+        grad = 2 * (diff * cov_w / port_var
+                    + cov_matrix @ (diff * weights) / port_var
+                    - 2 * cov_w * (diff @ contrib) / port_var)
+        return diff @ diff, grad
+    
+    asset_vols = np.sqrt(np.diag(cov_matrix))
+    
+    def neg_diversification(weights):
+        cov_w = cov_matrix @ weights
+        portfolio_std = np.sqrt(weights @ cov_w)
+        weighted_vol = asset_vols @ weights
+        value = -weighted_vol / portfolio_std
+        grad = -(asset_vols * portfolio_std - weighted_vol * cov_w / portfolio_std) / portfolio_std ** 2
+        return value, grad
+    
+    def neg_return(weights):
+        return -(mean_returns @ weights), -mean_returns
+    
+    objectives = {
+        'max_sharpe': neg_sharpe,
+        'min_variance': variance,
+        'risk_parity': risk_parity,
+        'max_diversification': neg_diversification,
+        'target_volatility': neg_return
+    }
+    if method not in objectives:
+        raise ValueError(f"Unknown optimization method: {method}")
+    
+    if method == 'target_volatility':
+        # Below the minimum-variance volatility no weights satisfy the target: return that portfolio
+        min_variance = minimize(variance, initial_guess, jac=True, method='SLSQP',
+                                bounds=bounds, constraints=constraints,
+                                options={'ftol': 1e-12, 'maxiter': 500})
+        if min_variance.success and min_variance.x @ cov_matrix @ min_variance.x >= target_volatility ** 2:
+            return min_variance.x
+        constraints.append({
+            'type': 'ineq',
+            'fun': lambda x: target_volatility ** 2 - x @ cov_matrix @ x,
+            'jac': lambda x: -2 * cov_matrix @ x
+        })
+    
+    result = minimize(objectives[method], initial_guess, jac=True, method='SLSQP',
+                      bounds=bounds, constraints=constraints,
+                      options={'ftol': 1e-12, 'maxiter': 500})
+    
+    return result.x if result.success else initial_guess
+
+
+def run_walk_forward_chunk(fold_indices, prices, windows, objective):
+    """
+    Fit a contiguous run of walk-forward folds, warm-starting each from the last
+    """
+    fitted = []
+    previous = None
+    for fold in fold_indices:
+        start, stop = windows[fold]
+        previous = np.asarray(objective(prices.iloc[start:stop], previous), dtype=float)
+        fitted.append(previous)
+    return fitted
+
+
+def walk_forward_optimization(prices, method='max_sharpe', train_window=756, refit='quarterly',
+                              window_type='rolling', estimator='sample', risk_free_rate=0.0,
+                              objective=None, max_workers=None, **optimizer_kwargs):
+    """
+    Out-of-sample walk-forward backtest of a portfolio optimizer
+    
+    At the last trading day of each refit period (monthly/quarterly/annual),
+    weights are fitted on the trailing `train_window` days ('rolling') or on
+    all history so far ('expanding'), then held until the next refit. The
+    realized returns of those weights are stitched into one out-of-sample
+    series, so no day is ever scored with weights fitted on it.
+    
+    By default each fold runs optimize_portfolio(method, ...) on moments from
+    compute_moments(estimator). Pass objective(train_prices, initial_weights)
+    to fit anything else. Folds are split into contiguous chunks run in
+    parallel (run_parallel); within a chunk each fit is warm-started from the
+    previous fold's weights.
+    
+    Returns: dict with returns (out-of-sample Series), weights (DataFrame
+    indexed by refit date), turnover (one-way per refit) and fold_windows
+    (train start/end dates per refit)
+    """
+    prices = prices.dropna()
+    returns = prices.pct_change().iloc[1:]
+    T = len(returns)
+    
+    codes = returns.index.to_period({'monthly': 'M', 'quarterly': 'Q', 'annual': 'Y'}[refit]).asi8
+    period_ends = np.flatnonzero(codes[1:] != codes[:-1])
+    refits = period_ends[period_ends >= train_window - 1]
+    if len(refits) == 0:
+        raise ValueError(f"Need more than {train_window} days of history for walk-forward analysis")
+    
+    # Return rows [first, refit] map to price rows [first, refit + 1]
+    first = refits - train_window + 1 if window_type == 'rolling' else np.zeros_like(refits)
+    windows = list(zip(first, refits + 2))
+    
+    if objective is None:
+        def objective(train_prices, initial_weights):
+            moments = compute_moments(train_prices, estimator=estimator)
+            return optimize_portfolio(train_prices, method=method, risk_free_rate=risk_free_rate,
+                                      initial_weights=initial_weights, moments=moments, **optimizer_kwargs)
+    
+    workers = max(1, min(len(refits), max_workers or os.cpu_count() or 1))
+    chunks = [chunk for chunk in np.array_split(np.arange(len(refits)), workers) if len(chunk)]
+    fitted = run_parallel(run_walk_forward_chunk, chunks, workers,
+                          prices=prices, windows=windows, objective=objective)
+    weights = np.vstack([w for chunk in fitted for w in chunk])
+    
+    # Each day after the first refit uses the weights of the latest refit before it
+    days = np.arange(refits[0] + 1, T)
+    fold_of_day = np.searchsorted(refits, days, side='left') - 1
+    oos_returns = np.einsum('ij,ij->i', returns.values[days], weights[fold_of_day])
+    
+    refit_dates = returns.index[refits]
+    turnover = np.abs(np.diff(weights, axis=0, prepend=weights[:1])).sum(axis=1) / 2
+    
+    return {
+        'returns': pd.Series(oos_returns, index=returns.index[days], name='returns'),
+        'weights': pd.DataFrame(weights, index=refit_dates, columns=prices.columns),
+        'turnover': pd.Series(turnover, index=refit_dates, name='turnover'),
+        'fold_windows': pd.DataFrame({'Train Start': returns.index[first], 'Train End': refit_dates},
+                                     index=refit_dates)
+    }
+
+
+@st.cache_data(ttl=3600)
+def get_walk_forward(prices, method='max_sharpe', train_window=756, refit='quarterly',
+                     window_type='rolling', estimator='sample', **optimizer_kwargs):
+    """
+    Memoized walk_forward_optimization for the Optimization tab
+    """
+    return walk_forward_optimization(prices, method=method, train_window=train_window, refit=refit,
+                                     window_type=window_type, estimator=estimator, **optimizer_kwargs)
+
+
+def generate_random_portfolios(mean_returns, cov_matrix, num_portfolios=100000, risk_free_rate=0.0,
+                               chunk_size=50000, dtype=np.float32, seed=None):
+    """
+    Draw a cloud of random long-only portfolios in one batched pass
+
+    Builds a (K x N) weight matrix, then computes every portfolio's return,
+    volatility (via einsum over w'Σw) and Sharpe ratio in chunks of
+    `chunk_size` rows to bound memory. Returns a (3 x K) results array
+    [return, volatility, sharpe] and the (K x N) weight matrix.
+    """
+    rng = np.random.default_rng(seed)
+    mean_returns = np.asarray(mean_returns, dtype=dtype)
+    cov_matrix = np.asarray(cov_matrix, dtype=dtype)
+    num_assets = len(mean_returns)
+
+    weights = rng.random((num_portfolios, num_assets), dtype=dtype)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    results = np.empty((3, num_portfolios), dtype=dtype)
+    for start in range(0, num_portfolios, chunk_size):
+        w = weights[start:start + chunk_size]
+        results[0, start:start + len(w)] = w @ mean_returns
+        results[1, start:start + len(w)] = np.sqrt(np.einsum('ij,jk,ik->i', w, cov_matrix, w, optimize=True))
+
+    results[2] = (results[0] - risk_free_rate) / results[1]
+
+    return results, weights
+
+
+def calculate_efficient_frontier(prices, num_portfolios=100, moments=None):
+    """
+    Calculate efficient frontier for visualization
+    """
+    if moments is None:
+        moments = estimate_moments(prices)
     
-    return results, weights_array
+    return generate_random_portfolios(moments['mean_returns'].values, moments['cov_matrix'].values,
+                                      num_portfolios)
+
+
+def calculate_exact_efficient_frontier(prices, num_points=50, risk_free_rate=0.0, moments=None):
+    """
+    Trace the exact long-only efficient frontier
+
+    Solves min w'Σw subject to sum(w) = 1, μ'w = target, w >= 0 for a sweep
+    of target returns from the minimum-variance portfolio up to the
+    highest-return asset. Each quadratic program is solved by an active-set
+    method on the KKT system, warm-started from the previous point's set of
+    held assets, so consecutive points usually need only one or two linear
+    solves and the sweep stays fast for 200+ assets. SLSQP with analytic
+    gradients is used as a fallback if the active set fails to settle.
+    Also returns the minimum-variance and tangency (maximum Sharpe) portfolios.
+    """
+    if moments is None:
+        moments = estimate_moments(prices)
+    mean_returns = moments['mean_returns'].values
+    cov_matrix = moments['cov_matrix'].values
+
+    num_assets = len(mean_returns)
+    tol = 1e-10 * max(np.abs(np.diag(cov_matrix)).max(), 1e-12)
+
+    def solve_qp(A, b, free):
+        """min w'Σw s.t. Aw = b, w >= 0, starting from the active set `free`"""
+        free = free.copy()
+        for _ in range(4 * num_assets):
+            idx = np.flatnonzero(free)
+            if len(idx) == 0:
+                break
+            k = len(b)
+            kkt = np.block([[cov_matrix[np.ix_(idx, idx)], A[:, idx].T],
+                            [A[:, idx], np.zeros((k, k))]])
+            rhs = np.concatenate([np.zeros(len(idx)), b])
+            try:
+                sol = np.linalg.solve(kkt, rhs)
+            except np.linalg.LinAlgError:
+                sol = np.linalg.lstsq(kkt, rhs, rcond=None)[0]
+            w_free, nu = sol[:len(idx)], sol[len(idx):]
+
+            # Primal feasibility: release the most negative holding
+            if w_free.min() < -1e-12:
+                free[idx[np.argmin(w_free)]] = False
+                continue
+
+            w = np.zeros(num_assets)
+            w[idx] = w_free
+
+            # Dual feasibility: bring in the asset whose multiplier is most negative
+            slack = cov_matrix @ w + A.T @ nu
+            slack[free] = 0
+            if slack.min() < -tol:
+                free[np.argmin(slack)] = True
+                continue
+
+            if np.abs(A @ w - b).max() < 1e-8:
+                return w, free
+            break
+        return None, free
+
+    def solve_slsqp(A, b, start):
+        """Fallback for the same QP using SLSQP with analytic gradients"""
+        constraints = [{'type': 'eq', 'fun': lambda w, a=a, t=t: a @ w - t, 'jac': lambda w, a=a: a}
+                       for a, t in zip(A, b)]
+        result = minimize(lambda w: w @ cov_matrix @ w, start, jac=lambda w: 2 * cov_matrix @ w,
+                          method='SLSQP', bounds=tuple((0, None) for _ in range(num_assets)),
+                          constraints=constraints, options={'ftol': 1e-12, 'maxiter': 500})
+        return np.clip(result.x, 0, None)
+
+    def solve(A, b, free, start):
+        w, free = solve_qp(A, b, free)
+        if w is None:
+            w = solve_slsqp(A, b, start)
+            free = w > 1e-10
+        return w, free
+
+    def portfolio_point(w):
+        port_return = mean_returns @ w
+        port_std = np.sqrt(w @ cov_matrix @ w)
+        return {
+            'weights': pd.Series(w, index=prices.columns),
+            'return': port_return,
+            'volatility': port_std,
+            'sharpe': (port_return - risk_free_rate) / port_std if port_std > 0 else 0
+        }
+
+    ones = np.ones((1, num_assets))
+    equal_weights = np.full(num_assets, 1.0 / num_assets)
+
+    # Minimum-variance portfolio anchors the bottom of the frontier
+    min_var_weights, free = solve(ones, np.ones(1), np.ones(num_assets, dtype=bool), equal_weights)
+    min_var_weights = min_var_weights / min_var_weights.sum()
+
+    # Sweep target returns, warm-starting each QP from the previous active set
+    targets = np.linspace(mean_returns @ min_var_weights, mean_returns.max(), num_points)
+    A = np.vstack([ones, mean_returns])
+    frontier_weights = np.empty((num_points, num_assets))
+    frontier_weights[0] = min_var_weights
+
+    # The top of the frontier is the single highest-return asset
+    frontier_weights[-1] = np.eye(num_assets)[np.argmax(mean_returns)]
 
+    w = min_var_weights
+    for i in range(1, num_points - 1):
+        w, free = solve(A, np.array([1.0, targets[i]]), free, w)
+        frontier_weights[i] = w
+
+    frontier_returns = frontier_weights @ mean_returns
+    frontier_stds = np.sqrt(np.einsum('ij,jk,ik->i', frontier_weights, cov_matrix, frontier_weights))
+    frontier_sharpes = (frontier_returns - risk_free_rate) / np.where(frontier_stds > 0, frontier_stds, np.nan)
+
+    # Tangency portfolio: min y'Σy s.t. (μ - rf)'y = 1, y >= 0, then w = y / sum(y)
+    excess = mean_returns - risk_free_rate
+    best_point = frontier_weights[np.nanargmax(frontier_sharpes)]
+    tangency_weights = best_point
+    if excess @ best_point > 0:
+        y, _ = solve(excess[np.newaxis, :], np.ones(1), best_point > 0, best_point / (excess @ best_point))
+        if y.sum() > 0:
+            tangency_weights = y / y.sum()
+
+    return {
+        'returns': frontier_returns,
+        'volatilities': frontier_stds,
+        'sharpe': frontier_sharpes,
+        'weights': pd.DataFrame(frontier_weights, columns=prices.columns),
+        'min_variance': portfolio_point(min_var_weights),
+        'tangency': portfolio_point(tangency_weights)
+    }
 
 # =============================================================================
 # ANALYSIS FUNCTIONS
 # =============================================================================
 
-def calculate_portfolio_metrics(returns, benchmark_returns=None, risk_free_rate=0.02):
+def compute_return_statistics(returns, risk_free_rate=0.02):
     """
-    Calculate comprehensive portfolio metrics
+    Fused return statistics kernel
+
+    Makes one pass over the daily returns array and derives every headline
+    statistic the app displays: return, volatility, Sharpe, Sortino,
+    cumulative and drawdown series, max drawdown, Calmar, win rate,
+    VaR/CVaR, drawdown episodes and recovery time. Semantics match the original
+    per-metric calculations (sample std, linear-interpolated quantiles,
+    drawdown measured from the running peak of cumulative growth).
     """
-    # Ensure returns are a pandas Series
     if isinstance(returns, pd.DataFrame):
         returns = returns.iloc[:, 0]
+    returns = returns.dropna()
     
-    # Basic metrics
-    total_return = (1 + returns).prod() - 1
-    ann_return = (1 + total_return) ** (252 / len(returns)) - 1
-    ann_vol = returns.std() * np.sqrt(252)
+    r = returns.values.astype(float)
+    n = len(r)
+    
+    growth = np.cumprod(1 + r)
+    running_max = np.maximum.accumulate(growth)
+    drawdown = growth / running_max - 1
+    
+    total_return = growth[-1] - 1
+    ann_return = (1 + total_return) ** (252 / n) - 1
+    ann_vol = r.std(ddof=1) * np.sqrt(252)
     sharpe = (ann_return - risk_free_rate) / ann_vol if ann_vol != 0 else 0
     
-    # Downside metrics
-    downside_returns = returns[returns < 0]
-    downside_std = downside_returns.std() * np.sqrt(252)
+    # Downside deviation uses only the negative days, as before
+    losses = r[r < 0]
+    downside_std = losses.std(ddof=1) * np.sqrt(252) if len(losses) > 1 else np.nan
     sortino = (ann_return - risk_free_rate) / downside_std if downside_std != 0 else 0
     
-    # Drawdown
-    cum_returns = (1 + returns).cumprod()
-    running_max = cum_returns.expanding().max()
-    drawdown = (cum_returns - running_max) / running_max
     max_drawdown = drawdown.min()
-    
-    # Calmar ratio
     calmar = ann_return / abs(max_drawdown) if max_drawdown != 0 else 0
     
-    # Win rate
-    win_rate = (returns > 0).sum() / len(returns)
+    var_95, var_99 = np.quantile(r, [0.05, 0.01])
     
-    metrics = {
+    # Recovery time: calendar days from peak back to a new high; a still-open
+    # drawdown counts with the days elapsed so far
+    episodes = calculate_drawdown_episodes(returns)
+    avg_recovery_days = float(episodes['Duration (Days)'].mean()) if len(episodes) else 0
+    
+    return {
         'Total Return': total_return,
         'Annual Return': ann_return,
         'Annual Volatility': ann_vol,
@@ -1256,8 +2019,124 @@ def calculate_portfolio_metrics(returns, benchmark_returns=None, risk_free_rate=
         'Sortino Ratio': sortino,
         'Max Drawdown': max_drawdown,
         'Calmar Ratio': calmar,
-        'Win Rate': win_rate
+        'Win Rate': (r > 0).sum() / n,
+        'Expected Annual Return': r.mean() * 252,
+        'VaR (95%)': var_95,
+        'VaR (99%)': var_99,
+        'CVaR (95%)': r[r <= var_95].mean(),
+        'CVaR (99%)': r[r <= var_99].mean(),
+        'Probability of Daily Loss': (r < 0).sum() / n,
+        'Avg Recovery Days': avg_recovery_days,
+        'Cumulative Returns': pd.Series(growth, index=returns.index),
+        'Drawdown': pd.Series(drawdown, index=returns.index),
+        'Drawdown Episodes': episodes
     }
+
+
+@st.cache_data(ttl=3600)
+def get_return_statistics(returns, risk_free_rate=0.02):
+    """
+    Memoized return statistics - computed once per returns series and shared by every tab
+    """
+    return compute_return_statistics(returns, risk_free_rate)
+
+
+CALENDAR_FREQUENCIES = {'W': 'Weekly', 'M': 'Monthly', 'Q': 'Quarterly', 'Y': 'Annual'}
+
+
+def compute_calendar_returns(returns, frequencies=('W', 'M', 'Q', 'Y')):
+    """
+    Compounded weekly/monthly/quarterly/annual returns from daily returns
+
+    Daily returns are converted to log returns once and summed per calendar
+    period with a single np.add.reduceat per frequency, so compounding never
+    calls back into Python per period. Works on a Series or a DataFrame
+    (one column per series); missing days count as flat, matching
+    (1 + x).prod() - 1. Periods are labelled by their last calendar day.
+
+    Returns: dict {frequency: Series/DataFrame of period returns}
+    """
+    is_series = isinstance(returns, pd.Series)
+    frame = returns.to_frame() if is_series else returns
+    frame = frame.sort_index()
+    index = pd.DatetimeIndex(frame.index)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_returns = np.log1p(frame.to_numpy(dtype=float))
+    log_returns = np.where(np.isnan(log_returns), 0.0, log_returns)
+
+    calendar = {}
+    for freq in frequencies:
+        periods = index.to_period(freq)
+        codes = periods.asi8
+        if len(codes) == 0:
+            period_returns = np.empty((0, frame.shape[1]))
+            labels = pd.DatetimeIndex([])
+        else:
+            starts = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))
+            period_returns = np.expm1(np.add.reduceat(log_returns, starts, axis=0))
+            labels = periods[starts].to_timestamp(how='end').normalize()
+
+        result = pd.DataFrame(period_returns, index=labels, columns=frame.columns)
+        calendar[freq] = result.iloc[:, 0].rename(returns.name) if is_series else result
+
+    return calendar
+
+
+@st.cache_data(ttl=3600)
+def get_calendar_returns(returns, frequencies=('W', 'M', 'Q', 'Y')):
+    """
+    Memoized calendar returns - one aggregation per portfolio shared by the heatmap,
+    annual bars, grading and the dollar P&L table
+    """
+    return compute_calendar_returns(returns, frequencies)
+
+
+def calculate_monthly_dollar_gains(monthly_returns, initial_capital, annual_dividend_yield=0.018):
+    """
+    Month-by-month dollar P&L for a starting portfolio value
+
+    Vectorized over months: the value path is a cumulative product of monthly
+    growth factors, and each month's gain is its opening value times its return.
+    Dividends are an estimated flat yield on the opening value.
+
+    Returns: DataFrame with Date, Month, Year, Return %, Total Gain/Loss,
+    Capital Gain/Loss, Dividend Income and Portfolio Value
+    """
+    values = initial_capital * np.cumprod(1 + monthly_returns.to_numpy(dtype=float))
+    start_values = np.concatenate(([initial_capital], values[:-1]))
+    total_gain = start_values * monthly_returns.to_numpy(dtype=float)
+    dividends = start_values * (annual_dividend_yield / 12)
+    dates = pd.DatetimeIndex(monthly_returns.index)
+
+    return pd.DataFrame({
+        'Date': dates.strftime('%Y-%m'),
+        'Month': dates.strftime('%B'),
+        'Year': dates.year,
+        'Return %': monthly_returns.to_numpy(dtype=float) * 100,
+        'Total Gain/Loss': total_gain,
+        'Capital Gain/Loss': total_gain - dividends,
+        'Dividend Income': dividends,
+        'Portfolio Value': values
+    })
+
+
+def calculate_portfolio_metrics(returns, benchmark_returns=None, risk_free_rate=0.02):
+    """
+    Calculate comprehensive portfolio metrics
+    """
+    # Ensure returns are a pandas Series
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+    
+    # Basic, downside and drawdown metrics from the shared kernel
+    stats = get_return_statistics(returns, risk_free_rate)
+    ann_return = stats['Annual Return']
+    
+    metrics = {key: stats[key] for key in [
+        'Total Return', 'Annual Return', 'Annual Volatility', 'Sharpe Ratio',
+        'Sortino Ratio', 'Max Drawdown', 'Calmar Ratio', 'Win Rate'
+    ]}
     
     # Alpha and Beta (if benchmark provided)
     if benchmark_returns is not None:
@@ -1286,134 +2165,2164 @@ def calculate_portfolio_metrics(returns, benchmark_returns=None, risk_free_rate=
     return metrics
 
 
-def detect_market_regimes(returns, lookback=60):
+def calculate_batch_metrics(returns, risk_free_rate=0.02):
     """
-    Detect market regimes based on volatility and returns
+    Calculate portfolio metrics for many return series at once
+
+    Takes a T x P returns matrix (DataFrame with one column per portfolio or
+    benchmark, or a 2-D array) and returns a P x M metrics DataFrame using
+    vectorized column operations. Missing values are ignored per column, so
+    series with different date ranges can be aligned on one index. Metric
+    definitions match calculate_portfolio_metrics, plus daily VaR/CVaR (95%)
+    and the probability of a daily loss. The same code path serves 3
+    portfolios or 10,000 candidates.
+    """
+    if isinstance(returns, pd.Series):
+        returns = returns.to_frame()
+    if not isinstance(returns, pd.DataFrame):
+        returns = pd.DataFrame(returns)
+    
+    r = returns.values.astype(float)
+    valid = ~np.isnan(r)
+    n = valid.sum(axis=0)
+    filled = np.where(valid, r, 0.0)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Growth path with missing days treated as flat, and masked out so a
+        # series' running peak starts at its own first observation
+        growth = np.cumprod(1 + filled, axis=0)
+        total_return = growth[-1] - 1
+        growth[~valid] = np.nan
+        drawdown = growth / np.fmax.accumulate(growth, axis=0) - 1
+        max_drawdown = np.nanmin(drawdown, axis=0)
+        
+        ann_return = (1 + total_return) ** (252 / n) - 1
+        mean = filled.sum(axis=0) / n
+        ann_vol = np.sqrt((np.where(valid, r - mean, 0.0) ** 2).sum(axis=0) / (n - 1)) * np.sqrt(252)
+        sharpe = np.where(ann_vol != 0, (ann_return - risk_free_rate) / ann_vol, 0)
+        
+        is_loss = filled < 0
+        loss_count = is_loss.sum(axis=0)
+        loss_mean = np.where(is_loss, filled, 0.0).sum(axis=0) / loss_count
+        loss_var = (np.where(is_loss, filled - loss_mean, 0.0) ** 2).sum(axis=0) / (loss_count - 1)
+        downside_std = np.where(loss_count > 1, np.sqrt(loss_var), np.nan) * np.sqrt(252)
+        sortino = np.where(downside_std != 0, (ann_return - risk_free_rate) / downside_std, 0)
+        
+        calmar = np.where(max_drawdown != 0, ann_return / np.abs(max_drawdown), 0)
+        
+        # Linear-interpolated 5% quantile per column from one sort (NaNs sort last)
+        ordered = np.sort(r, axis=0)
+        position = 0.05 * (n - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, np.maximum(n - 1, 0))
+        low_value = np.take_along_axis(ordered, lower[np.newaxis, :], axis=0)[0]
+        high_value = np.take_along_axis(ordered, upper[np.newaxis, :], axis=0)[0]
+        var_95 = low_value + (position - lower) * (high_value - low_value)
+        in_tail = valid & (filled <= var_95)
+        cvar_95 = np.where(in_tail, filled, 0.0).sum(axis=0) / in_tail.sum(axis=0)
+        
+        metrics = pd.DataFrame({
+            'Total Return': total_return,
+            'Annual Return': ann_return,
+            'Annual Volatility': ann_vol,
+            'Sharpe Ratio': sharpe,
+            'Sortino Ratio': sortino,
+            'Max Drawdown': max_drawdown,
+            'Calmar Ratio': calmar,
+            'Win Rate': (r > 0).sum(axis=0) / n,
+            'VaR (95%)': var_95,
+            'CVaR (95%)': cvar_95,
+            'Probability of Daily Loss': loss_count / n
+        }, index=returns.columns)
     
-    Regimes:
-    1. Bull Market (Low Vol) - Positive returns, low volatility
-    2. Bull Market (High Vol) - Positive returns, high volatility  
-    3. Sideways/Choppy - Returns near zero, any volatility
-    4. Bear Market (Low Vol) - Negative returns, low volatility
-    5. Bear Market (High Vol) - Negative returns, high volatility (crisis)
+    return metrics
+
+
+@st.cache_data(ttl=3600)
+def get_asset_returns(prices):
+    """
+    Memoized daily asset returns for a price panel - the shared input for what-if repricing
+    """
+    return prices.pct_change().dropna()
+
+
+def reprice_portfolio(asset_returns, weights, risk_free_rate=0.02):
+    """
+    Portfolio returns and metrics for new weights without rebuilding the portfolio
+    
+    weights is a dict {ticker: weight}, a weight vector in column order, or a
+    batch of weight vectors (P x N array or DataFrame with one row per
+    candidate). All candidates are priced with one matrix product against
+    the cached asset returns and scored with calculate_batch_metrics.
+    
+    Returns: dict with returns (Series, or T x P DataFrame for a batch) and
+    metrics (dict, or P x M DataFrame for a batch)
+    """
+    if isinstance(weights, dict):
+        weights = np.array([weights.get(ticker, 0.0) for ticker in asset_returns.columns], dtype=float)
+    if isinstance(weights, pd.DataFrame):
+        labels = weights.index
+        weights = weights.reindex(columns=asset_returns.columns, fill_value=0.0).values
+    else:
+        labels = None
+    
+    weights = np.asarray(weights, dtype=float)
+    single = weights.ndim == 1
+    weight_matrix = np.atleast_2d(weights)
+    
+    portfolio_returns = pd.DataFrame(asset_returns.values @ weight_matrix.T, index=asset_returns.index,
+                                     columns=labels if labels is not None else range(len(weight_matrix)))
+    metrics = calculate_batch_metrics(portfolio_returns, risk_free_rate)
+    
+    if single:
+        return {
+            'returns': portfolio_returns.iloc[:, 0].rename('returns'),
+            'metrics': metrics.iloc[0].to_dict()
+        }
+    return {'returns': portfolio_returns, 'metrics': metrics}
+
+
+def calculate_drawdown_episodes(returns):
+    """
+    Drawdown episode table for one or many return series
+
+    Pure-NumPy run-length engine: every series is flattened into one array,
+    underwater runs are located from sign changes, and each run's trough is
+    found with a single lexsort - no Python loop over days or episodes, so
+    thousands of series are processed at once. Accepts a Series or a
+    DataFrame (one column per series). Still-open drawdowns are kept and
+    flagged with 'Open' = True and no recovery date.
+
+    Returns a DataFrame with one row per episode: Series, Peak Date,
+    Trough Date, Recovery Date, Depth, Duration (Days) (peak to recovery, or
+    to the last date if open), Days to Trough, Days to Recover and Open.
+    """
+    if isinstance(returns, pd.Series):
+        returns = returns.to_frame(returns.name if returns.name is not None else 'returns')
+    
+    dates = returns.index
+    r = np.nan_to_num(returns.values.astype(float))
+    num_days, num_series = r.shape
+    
+    growth = np.cumprod(1 + r, axis=0)
+    drawdown = growth / np.maximum.accumulate(growth, axis=0) - 1
+    
+    # Flatten column by column; the first day of each series is never underwater,
+    # so runs cannot leak across series boundaries
+    dd = drawdown.T.ravel()
+    underwater = dd < 0
+    previous = np.concatenate([[False], underwater[:-1]])
+    next_day = np.concatenate([underwater[1:], [False]])
+    
+    starts = np.flatnonzero(underwater & ~previous)
+    last_underwater = np.flatnonzero(underwater & ~next_day)
+    series_idx = starts // num_days
+    
+    # Trough: deepest point of each run (segment minimum, then first position matching it)
+    positions = np.flatnonzero(underwater)
+    run_lengths = last_underwater - starts + 1
+    segment_starts = np.concatenate([[0], np.cumsum(run_lengths)[:-1]])
+    underwater_dd = dd[positions]
+    depths = np.minimum.reduceat(underwater_dd, segment_starts) if len(starts) else np.array([])
+    hits = np.flatnonzero(underwater_dd == np.repeat(depths, run_lengths))
+    hit_episode = np.repeat(np.arange(len(starts)), run_lengths)[hits]
+    first_hit = np.concatenate([[True], hit_episode[1:] != hit_episode[:-1]]) if len(hits) else hits.astype(bool)
+    troughs = positions[hits[first_hit]]
+    
+    # Recovery is the day after the run ends, unless the run reaches the end of its series
+    is_open = (last_underwater % num_days) == num_days - 1
+    recoveries = last_underwater + 1
+    
+    peak_dates = dates[starts % num_days - 1]
+    trough_dates = dates[troughs % num_days]
+    recovery_dates = pd.DatetimeIndex(np.where(is_open, np.datetime64('NaT'),
+                                               dates[np.minimum(recoveries % num_days, num_days - 1)].values))
+    end_dates = pd.DatetimeIndex(np.where(is_open, dates[-1].to_datetime64(), recovery_dates.values))
+    
+    episodes = pd.DataFrame({
+        'Series': returns.columns[series_idx],
+        'Peak Date': peak_dates,
+        'Trough Date': trough_dates,
+        'Recovery Date': recovery_dates,
+        'Depth': depths,
+        'Duration (Days)': (end_dates - peak_dates).days,
+        'Days to Trough': (trough_dates - peak_dates).days,
+        'Days to Recover': (recovery_dates - trough_dates).days,
+        'Open': is_open
+    })
+    
+    return episodes
+
+
+def format_drawdown_episodes(episodes, top_n=5):
+    """
+    Display table of the deepest drawdown episodes
+    """
+    worst = episodes.nsmallest(top_n, 'Depth')
+    return pd.DataFrame({
+        'Peak': worst['Peak Date'].dt.strftime('%Y-%m-%d'),
+        'Trough': worst['Trough Date'].dt.strftime('%Y-%m-%d'),
+        'Recovered': [d.strftime('%Y-%m-%d') if not is_open else '⏳ Still open'
+                      for d, is_open in zip(worst['Recovery Date'], worst['Open'])],
+        'Depth': worst['Depth'].map('{:.2%}'.format),
+        'Days to Trough': worst['Days to Trough'],
+        'Days to Recover': [f"{d:.0f}" if not is_open else '-'
+                            for d, is_open in zip(worst['Days to Recover'], worst['Open'])],
+        'Total Days': worst['Duration (Days)']
+    })
+
+
+def create_incremental_metrics(returns, windows=(21, 63, 252)):
+    """
+    Build an incremental metrics state from a returns history
+
+    The state is a plain dict holding running aggregates - Welford mean and
+    variance, downside (negative-day) Welford variance, cumulative growth,
+    running peak and max drawdown, win/loss counts, and a ring buffer per
+    rolling window - so new returns can be absorbed in O(1) per day with
+    update_incremental_metrics.
     """
-    # Ensure returns is a Series
     if isinstance(returns, pd.DataFrame):
         returns = returns.iloc[:, 0]
+    returns = returns.dropna()
+    r = returns.values.astype(float)
+    
+    losses = r[r < 0]
+    growth = np.cumprod(1 + r)
+    
+    state = {
+        'count': len(r),
+        'mean': r.mean() if len(r) else 0.0,
+        'm2': ((r - r.mean()) ** 2).sum() if len(r) else 0.0,
+        'downside_count': len(losses),
+        'downside_mean': losses.mean() if len(losses) else 0.0,
+        'downside_m2': ((losses - losses.mean()) ** 2).sum() if len(losses) else 0.0,
+        'wins': int((r > 0).sum()),
+        'growth': growth[-1] if len(r) else 1.0,
+        'peak': growth.max() if len(r) else -np.inf,
+        'max_drawdown': (growth / np.maximum.accumulate(growth) - 1).min() if len(r) else 0.0,
+        'last_date': returns.index[-1] if len(r) else None,
+        'windows': {}
+    }
     
-    # Calculate rolling metrics
-    rolling_returns = returns.rolling(lookback).mean() * 252  # Annualized
-    rolling_vol = returns.rolling(lookback).std() * np.sqrt(252)  # Annualized
+    for window in windows:
+        recent = r[-window:]
+        buffer = np.zeros(window)
+        buffer[:len(recent)] = recent
+        state['windows'][window] = {
+            'buffer': buffer,
+            'position': len(recent) % window,
+            'filled': len(recent),
+            'sum': recent.sum(),
+            'sum_sq': (recent ** 2).sum()
+        }
     
-    # Calculate percentiles for thresholds
-    vol_median = rolling_vol.median()
-    return_positive = rolling_returns > 0.02  # Above 2% annualized
-    return_negative = rolling_returns < -0.02  # Below -2% annualized
-    vol_high = rolling_vol > vol_median
+    return state
+
+
+def update_incremental_metrics(state, new_returns):
+    """
+    Absorb new daily returns into an incremental metrics state (O(1) per day)
+
+    Returns already covered by the state (dated on or before its last date)
+    are skipped, so the full returns series can be passed safely.
+    """
+    if isinstance(new_returns, pd.DataFrame):
+        new_returns = new_returns.iloc[:, 0]
+    new_returns = new_returns.dropna()
+    if state['last_date'] is not None:
+        new_returns = new_returns[new_returns.index > state['last_date']]
+    
+    for date, x in new_returns.items():
+        # Welford update for mean and variance
+        state['count'] += 1
+        delta = x - state['mean']
+        state['mean'] += delta / state['count']
+        state['m2'] += delta * (x - state['mean'])
+        
+        # Downside variance over negative days only
+        if x < 0:
+            state['downside_count'] += 1
+            delta = x - state['downside_mean']
+            state['downside_mean'] += delta / state['downside_count']
+            state['downside_m2'] += delta * (x - state['downside_mean'])
+        
+        if x > 0:
+            state['wins'] += 1
+        
+        # Running peak and drawdown
+        state['growth'] *= 1 + x
+        state['peak'] = max(state['peak'], state['growth'])
+        state['max_drawdown'] = min(state['max_drawdown'], state['growth'] / state['peak'] - 1)
+        
+        # Rolling windows: overwrite the oldest slot in each ring buffer
+        for window, ring in state['windows'].items():
+            if ring['filled'] == window:
+                oldest = ring['buffer'][ring['position']]
+                ring['sum'] -= oldest
+                ring['sum_sq'] -= oldest ** 2
+            else:
+                ring['filled'] += 1
+            ring['buffer'][ring['position']] = x
+            ring['position'] = (ring['position'] + 1) % window
+            ring['sum'] += x
+            ring['sum_sq'] += x ** 2
+        
+        state['last_date'] = date
     
-    # Classify regimes
-    regimes = pd.Series(index=returns.index, dtype='object')
-    regimes[:] = 'Sideways/Choppy'  # Default
+    return state
+
+
+def incremental_metrics_summary(state, risk_free_rate=0.02):
+    """
+    Headline metrics from an incremental state
+
+    Returns the same keys and definitions as calculate_portfolio_metrics,
+    plus annualized rolling return and volatility for each ring-buffer window.
+    """
+    n = state['count']
+    total_return = state['growth'] - 1
+    ann_return = (1 + total_return) ** (252 / n) - 1
+    ann_vol = np.sqrt(state['m2'] / (n - 1)) * np.sqrt(252) if n > 1 else np.nan
+    sharpe = (ann_return - risk_free_rate) / ann_vol if ann_vol != 0 else 0
     
-    # Bull markets
-    regimes[return_positive & ~vol_high] = 'Bull Market (Low Vol)'
-    regimes[return_positive & vol_high] = 'Bull Market (High Vol)'
+    downside_n = state['downside_count']
+    downside_std = np.sqrt(state['downside_m2'] / (downside_n - 1)) * np.sqrt(252) if downside_n > 1 else np.nan
+    sortino = (ann_return - risk_free_rate) / downside_std if downside_std != 0 else 0
     
-    # Bear markets
-    regimes[return_negative & ~vol_high] = 'Bear Market (Low Vol)'
-    regimes[return_negative & vol_high] = 'Bear Market (High Vol)'
+    max_drawdown = state['max_drawdown']
     
-    return regimes
+    summary = {
+        'Total Return': total_return,
+        'Annual Return': ann_return,
+        'Annual Volatility': ann_vol,
+        'Sharpe Ratio': sharpe,
+        'Sortino Ratio': sortino,
+        'Max Drawdown': max_drawdown,
+        'Calmar Ratio': ann_return / abs(max_drawdown) if max_drawdown != 0 else 0,
+        'Win Rate': state['wins'] / n
+    }
+    
+    for window, ring in state['windows'].items():
+        filled = ring['filled']
+        if filled > 1:
+            mean = ring['sum'] / filled
+            variance = max(ring['sum_sq'] - filled * mean ** 2, 0) / (filled - 1)
+            summary[f'Rolling Return ({window}d)'] = mean * 252
+            summary[f'Rolling Volatility ({window}d)'] = np.sqrt(variance * 252)
+    
+    return summary
+
+
+def compute_rolling_statistics(returns, windows=(60,), benchmark=None):
+    """
+    Rolling statistics for many series and several windows in one pass
+
+    Builds cumulative sums of returns, squared returns, clipped downside
+    returns and (optionally) cross-products with `benchmark` once, then
+    every window is a difference of two cumsum rows - O(T) per window
+    regardless of window length. Matches pandas rolling(window) semantics:
+    a value needs a full window of observations.
+
+    Returns {window: {'Rolling Return', 'Rolling Volatility', 'Rolling Sharpe',
+    'Rolling Sortino', 'Rolling Beta', 'Rolling Correlation'}} with one
+    DataFrame (T x series) per statistic; beta and correlation are against
+    `benchmark` and only present when it is given. Sharpe and Sortino use no
+    risk-free rate, Sortino's downside deviation is the std of min(r, 0).
+    """
+    if isinstance(returns, pd.Series):
+        returns = returns.to_frame(returns.name if returns.name is not None else 'returns')
+    
+    index, columns = returns.index, returns.columns
+    r = returns.values.astype(float)
+    valid = ~np.isnan(r)
+    
+    # Center each series before accumulating so the variance differences stay precise
+    centered = np.where(valid, r - np.nanmean(r, axis=0), 0.0)
+    downside = np.minimum(np.where(valid, r, 0.0), 0)
+    downside = np.where(valid, downside - np.nanmean(np.where(valid, downside, np.nan), axis=0), 0.0)
+    
+    def cumulative(x):
+        return np.vstack([np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)])
+    
+    sums = {
+        'count': cumulative(valid.astype(float)),
+        'x': cumulative(centered),
+        'xx': cumulative(centered ** 2),
+        'd': cumulative(downside),
+        'dd': cumulative(downside ** 2)
+    }
+    
+    if benchmark is not None:
+        bench = benchmark.iloc[:, 0] if isinstance(benchmark, pd.DataFrame) else benchmark
+        b = bench.reindex(index).values.astype(float)[:, np.newaxis]
+        pair_valid = valid & ~np.isnan(b)
+        b_centered = np.where(pair_valid, b - np.nanmean(b), 0.0)
+        x_paired = np.where(pair_valid, centered, 0.0)
+        sums.update({
+            'pair_count': cumulative(pair_valid.astype(float)),
+            'px': cumulative(x_paired),
+            'pxx': cumulative(x_paired ** 2),
+            'b': cumulative(b_centered),
+            'bb': cumulative(b_centered ** 2),
+            'xb': cumulative(x_paired * b_centered)
+        })
+    
+    column_means = np.nanmean(r, axis=0)
+    results = {}
+    
+    for window in windows:
+        def window_sum(key):
+            total = np.full(r.shape, np.nan)
+            total[window - 1:] = sums[key][window:] - sums[key][:-window]
+            return total
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            full = window_sum('count') == window
+            s, ss = window_sum('x'), window_sum('xx')
+            mean = np.where(full, s / window + column_means, np.nan)
+            vol = np.sqrt(np.maximum(ss - s ** 2 / window, 0) / (window - 1))
+            d, dd = window_sum('d'), window_sum('dd')
+            downside_vol = np.sqrt(np.maximum(dd - d ** 2 / window, 0) / (window - 1))
+            
+            ann_return = mean * 252
+            ann_vol = np.where(full, vol * np.sqrt(252), np.nan)
+            ann_downside = np.where(full, downside_vol * np.sqrt(252), np.nan)
+            
+            stats = {
+                'Rolling Return': ann_return,
+                'Rolling Volatility': ann_vol,
+                'Rolling Sharpe': ann_return / ann_vol,
+                'Rolling Sortino': ann_return / ann_downside
+            }
+            
+            if benchmark is not None:
+                pair_full = window_sum('pair_count') == window
+                px, pxx = window_sum('px'), window_sum('pxx')
+                bs, bb, xb = window_sum('b'), window_sum('bb'), window_sum('xb')
+                cov = xb - px * bs / window
+                var_x = np.maximum(pxx - px ** 2 / window, 0)
+                var_b = np.maximum(bb - bs ** 2 / window, 0)
+                stats['Rolling Beta'] = np.where(pair_full, cov / var_b, np.nan)
+                stats['Rolling Correlation'] = np.where(pair_full, cov / np.sqrt(var_x * var_b), np.nan)
+        
+        results[window] = {name: pd.DataFrame(values, index=index, columns=columns)
+                           for name, values in stats.items()}
+    
+    return results
+
+
+@st.cache_data(ttl=3600)
+def get_rolling_statistics(returns, windows=(60,), benchmark=None):
+    """
+    Cached rolling statistics - computed once per (series set, windows, benchmark)
+    """
+    return compute_rolling_statistics(returns, windows, benchmark)
+
+
+def calculate_rolling_correlations(returns, window=63, method='window', halflife=None):
+    """
+    Rolling correlation cube for all holding pairs
+
+    Walks forward one day at a time, updating the covariance incrementally:
+    for 'window' the new day's outer product is added and the day leaving
+    the window subtracted; for 'ewma' the covariance decays by λ each day
+    (halflife defaults to `window`). Only the upper triangle of each
+    correlation matrix is kept, as float32, so 50 holdings over 20 years
+    needs ~25 MB instead of a full N x N x T float64 cube.
+
+    Returns a dict with 'tickers', 'dates', 'pairs' (i, j index arrays),
+    'correlations' (T x pairs) and 'volatilities' (T x N, annualized) -
+    betas follow as corr_ij * vol_i / vol_j (see rolling_matrix_at).
+    """
+    tickers = list(returns.columns)
+    x = returns.values.astype(float)
+    x = x - x.mean(axis=0)  # center once so running sums stay well conditioned
+    num_days, num_assets = x.shape
+    
+    upper_i, upper_j = np.triu_indices(num_assets, k=1)
+    correlations = np.full((num_days, len(upper_i)), np.nan, dtype=np.float32)
+    volatilities = np.full((num_days, num_assets), np.nan, dtype=np.float32)
+    
+    if method == 'ewma':
+        decay = 0.5 ** (1 / (halflife or window))
+        mean = np.zeros(num_assets)
+        cov = np.zeros((num_assets, num_assets))
+        weight = 0.0
+        for t in range(num_days):
+            # Exponentially weighted mean and covariance (West's update)
+            weight = decay * weight + 1
+            delta = x[t] - mean
+            mean += delta / weight
+            cov = decay * cov + np.outer(delta, x[t] - mean)
+            if t >= window - 1:
+                variances = np.diag(cov)
+                scale = np.sqrt(np.outer(variances, variances))[upper_i, upper_j]
+                correlations[t] = cov[upper_i, upper_j] / scale
+                volatilities[t] = np.sqrt(variances / weight * 252)
+    else:
+        sums = np.zeros(num_assets)
+        products = np.zeros((num_assets, num_assets))
+        for t in range(num_days):
+            sums += x[t]
+            products += np.outer(x[t], x[t])
+            if t >= window:
+                sums -= x[t - window]
+                products -= np.outer(x[t - window], x[t - window])
+            if t >= window - 1:
+                cov = (products - np.outer(sums, sums) / window) / (window - 1)
+                variances = np.diag(cov)
+                scale = np.sqrt(np.outer(variances, variances))[upper_i, upper_j]
+                correlations[t] = cov[upper_i, upper_j] / scale
+                volatilities[t] = np.sqrt(np.maximum(variances, 0) * 252)
+    
+    return {
+        'tickers': tickers,
+        'dates': returns.index,
+        'pairs': (upper_i, upper_j),
+        'correlations': correlations,
+        'volatilities': volatilities
+    }
+
+
+@st.cache_data(ttl=3600)
+def get_rolling_correlations(returns, window=63, method='window'):
+    """
+    Cached rolling correlation cube per (returns panel, window, method)
+    """
+    return calculate_rolling_correlations(returns, window, method)
+
+
+def rolling_matrix_at(rolling_corr, t, kind='correlation'):
+    """
+    Rebuild the full N x N correlation (or beta) matrix for day index `t`
+
+    Beta is row asset on column asset: β_ij = ρ_ij σ_i / σ_j.
+    """
+    tickers = rolling_corr['tickers']
+    upper_i, upper_j = rolling_corr['pairs']
+    
+    matrix = np.eye(len(tickers))
+    matrix[upper_i, upper_j] = rolling_corr['correlations'][t]
+    matrix[upper_j, upper_i] = rolling_corr['correlations'][t]
+    
+    if kind == 'beta':
+        vols = rolling_corr['volatilities'][t].astype(float)
+        matrix = matrix * vols[:, np.newaxis] / vols[np.newaxis, :]
+    
+    return pd.DataFrame(matrix, index=tickers, columns=tickers)
+
+
+MARKET_REGIMES = [
+    'Bull Market (Low Vol)',
+    'Bull Market (High Vol)',
+    'Sideways/Choppy',
+    'Bear Market (Low Vol)',
+    'Bear Market (High Vol)'
+]
+
+REGIME_LOOKBACKS = (20, 60, 120, 252)
+
+
+def classify_market_regimes(returns, lookbacks=REGIME_LOOKBACKS):
+    """
+    Classify market regimes for several lookbacks at once
+
+    Rolling return and volatility for every lookback come from one
+    cumulative-sum pass (compute_rolling_statistics); each lookback is then
+    coded with a single np.select over the same rules as
+    detect_market_regimes. Returns a DataFrame with one categorical column
+    per lookback (categories = MARKET_REGIMES, stored as integer codes).
+    """
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+    
+    rolling = compute_rolling_statistics(returns, tuple(lookbacks))
+    regimes = {}
+    
+    for lookback in lookbacks:
+        rolling_returns = rolling[lookback]['Rolling Return'].values[:, 0]
+        rolling_vol = rolling[lookback]['Rolling Volatility'].values[:, 0]
+        
+        return_positive = rolling_returns > 0.02  # Above 2% annualized
+        return_negative = rolling_returns < -0.02  # Below -2% annualized
+        vol_high = rolling_vol > np.nanmedian(rolling_vol)
+        
+        codes = np.select(
+            [return_positive & ~vol_high, return_positive & vol_high,
+             return_negative & ~vol_high, return_negative & vol_high],
+            [0, 1, 3, 4],
+            default=2  # Sideways/Choppy
+        ).astype(np.int8)
+        
+        regimes[lookback] = pd.Categorical.from_codes(codes, categories=MARKET_REGIMES)
+    
+    return pd.DataFrame(regimes, index=returns.index)
+
+
+@st.cache_data(ttl=3600)
+def get_market_regimes(returns, lookbacks=REGIME_LOOKBACKS):
+    """
+    Cached regime classification - computed once per portfolio returns and lookback set
+    """
+    return classify_market_regimes(returns, lookbacks)
+
+
+def detect_market_regimes(returns, lookback=60):
+    """
+    Detect market regimes based on volatility and returns
+    
+    Regimes:
+    1. Bull Market (Low Vol) - Positive returns, low volatility
+    2. Bull Market (High Vol) - Positive returns, high volatility  
+    3. Sideways/Choppy - Returns near zero, any volatility
+    4. Bear Market (Low Vol) - Negative returns, low volatility
+    5. Bear Market (High Vol) - Negative returns, high volatility (crisis)
+
+    Bull/bear means rolling annualized return above 2% / below -2%; high
+    volatility means rolling volatility above its median. Returns a
+    categorical Series (see classify_market_regimes).
+    """
+    return classify_market_regimes(returns, (lookback,))[lookback]
+
+
+def analyze_regime_performance(returns, regimes):
+    """
+    Analyze portfolio performance by market regime
+    """
+    df = pd.DataFrame({'returns': returns, 'regime': regimes})
+    df['win'] = df['returns'] > 0
+    
+    grouped = df.groupby('regime', observed=True, sort=False)
+    regime_stats = grouped['returns'].agg(['size', 'mean', 'std', 'max', 'min'])
+    regime_stats['win_rate'] = grouped['win'].mean()
+    
+    return pd.DataFrame({
+        'Regime': regime_stats.index.astype(str),
+        'Occurrences': regime_stats['size'].values,
+        'Avg Daily Return': regime_stats['mean'].values,
+        'Volatility': regime_stats['std'].values * np.sqrt(252),
+        'Best Day': regime_stats['max'].values,
+        'Worst Day': regime_stats['min'].values,
+        'Win Rate': regime_stats['win_rate'].values
+    })
+
+
+def fit_gaussian_hmm(returns, num_states=3, max_iter=100, tol=1e-6, init_params=None):
+    """
+    Fit a Gaussian hidden Markov model to daily returns (Baum-Welch)
+
+    Each hidden state emits normally distributed daily returns with its own
+    mean and standard deviation. Forward-backward is the scaled variant:
+    probabilities are renormalized each day and the scaling constants carry
+    the likelihood, so long histories do not underflow.
+    Pass a previous fit as `init_params` to warm-start a refit (e.g. after
+    new days are appended) - it typically converges in a few iterations.
+
+    States are ordered by mean return. Returns a dict with 'start_prob',
+    'transition', 'means', 'stds', 'labels' (MARKET_REGIMES label for each
+    state), 'log_likelihood', 'iterations' and 'log_alpha' (filtered state
+    log-probabilities on the last day, for hmm_filter_step).
+    """
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+    x = returns.dropna().values.astype(float)
+    num_obs = len(x)
+    var_floor = 1e-4 * x.var()
+    
+    if init_params is not None and len(init_params['means']) == num_states:
+        start_prob = np.asarray(init_params['start_prob'], dtype=float)
+        transition = np.asarray(init_params['transition'], dtype=float)
+        means = np.asarray(init_params['means'], dtype=float)
+        stds = np.asarray(init_params['stds'], dtype=float)
+    else:
+        # Quantile initialization: split sorted returns into equal buckets
+        buckets = np.array_split(np.sort(x), num_states)
+        means = np.array([b.mean() for b in buckets])
+        stds = np.sqrt(np.maximum(np.array([b.var() for b in buckets]), var_floor)) + x.std() * 0.5
+        start_prob = np.full(num_states, 1.0 / num_states)
+        transition = np.full((num_states, num_states), 0.05 / max(num_states - 1, 1))
+        np.fill_diagonal(transition, 0.95)
+    
+    previous_ll = -np.inf
+    for iteration in range(1, max_iter + 1):
+        log_emission = (-0.5 * ((x[:, np.newaxis] - means) / stds) ** 2
+                        - np.log(stds) - 0.5 * np.log(2 * np.pi))
+        # Emissions relative to each day's best state, so exp() cannot underflow
+        emission_peak = log_emission.max(axis=1)
+        emission = np.exp(log_emission - emission_peak[:, np.newaxis])
+        
+        # Scaled forward and backward passes: alpha is renormalized every day
+        # and the normalizers (scale) carry the likelihood. Each day's
+        # transition-times-emission matrix gets an extra row-sum column so one
+        # vector-matrix product yields both the next alpha and its normalizer.
+        step_matrix = transition[np.newaxis, :, :] * emission[:, np.newaxis, :]
+        step_matrix = np.concatenate([step_matrix, step_matrix.sum(axis=2, keepdims=True)], axis=2)
+        alpha = np.empty((num_obs, num_states))
+        beta = np.ones((num_obs, num_states))
+        scale = np.empty(num_obs)
+        alpha[0] = start_prob * emission[0]
+        scale[0] = alpha[0].sum()
+        alpha[0] /= scale[0]
+        for t in range(1, num_obs):
+            step = alpha[t - 1] @ step_matrix[t]
+            scale[t] = step[num_states]
+            alpha[t] = step[:num_states] / scale[t]
+        back_matrix = step_matrix[:, :, :num_states] / scale[:, np.newaxis, np.newaxis]
+        for t in range(num_obs - 2, -1, -1):
+            beta[t] = back_matrix[t + 1] @ beta[t + 1]
+        
+        log_likelihood = np.log(scale).sum() + emission_peak.sum()
+        
+        # E-step: state and transition posteriors
+        gamma = alpha * beta
+        ahead = emission[1:] * beta[1:] / scale[1:, np.newaxis]
+        xi_sum = transition * (alpha[:-1].T @ ahead)
+        
+        # M-step
+        start_prob = gamma[0] / gamma[0].sum()
+        transition = xi_sum / xi_sum.sum(axis=1, keepdims=True)
+        weights = gamma.sum(axis=0)
+        means = gamma.T @ x / weights
+        stds = np.sqrt(np.maximum((gamma * (x[:, np.newaxis] - means) ** 2).sum(axis=0) / weights, var_floor))
+        
+        if abs(log_likelihood - previous_ll) < tol * max(1.0, abs(log_likelihood)):
+            break
+        previous_ll = log_likelihood
+    
+    # Order states by mean return so fits are comparable across refits
+    order = np.argsort(means)
+    means, stds = means[order], stds[order]
+    start_prob = start_prob[order]
+    transition = transition[np.ix_(order, order)]
+    log_alpha_last = np.log(np.maximum(alpha[-1][order], 1e-300))
+    
+    # Map each state onto the regime labels with the same rules as the threshold classifier
+    ann_means = means * 252
+    high_vol = stds > x.std()
+    labels = []
+    for ann_mean, is_high in zip(ann_means, high_vol):
+        if ann_mean > 0.02:
+            labels.append(MARKET_REGIMES[1] if is_high else MARKET_REGIMES[0])
+        elif ann_mean < -0.02:
+            labels.append(MARKET_REGIMES[4] if is_high else MARKET_REGIMES[3])
+        else:
+            labels.append(MARKET_REGIMES[2])
+    
+    return {
+        'start_prob': start_prob,
+        'transition': transition,
+        'means': means,
+        'stds': stds,
+        'labels': labels,
+        'log_likelihood': log_likelihood,
+        'iterations': iteration,
+        'log_alpha': log_alpha_last
+    }
+
+
+def viterbi_hmm(returns, params):
+    """
+    Most likely hidden state path for a fitted Gaussian HMM (log-space Viterbi)
+    """
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+    x = returns.values.astype(float)
+    means, stds = params['means'], params['stds']
+    num_obs, num_states = len(x), len(means)
+    
+    log_emission = -0.5 * ((x[:, np.newaxis] - means) / stds) ** 2 - np.log(stds)
+    log_transition = np.log(np.maximum(params['transition'], 1e-300))
+    
+    scores = np.log(np.maximum(params['start_prob'], 1e-300)) + log_emission[0]
+    backpointers = np.empty((num_obs, num_states), dtype=np.int8)
+    for t in range(1, num_obs):
+        candidates = scores[:, np.newaxis] + log_transition
+        backpointers[t] = np.argmax(candidates, axis=0)
+        scores = candidates[backpointers[t], np.arange(num_states)] + log_emission[t]
+    
+    path = np.empty(num_obs, dtype=np.int8)
+    path[-1] = np.argmax(scores)
+    for t in range(num_obs - 1, 0, -1):
+        path[t - 1] = backpointers[t, path[t]]
+    
+    return path
+
+
+def hmm_filter_step(params, new_return):
+    """
+    Absorb one new daily return into the filtered state probabilities
+
+    Updates params['log_alpha'] in place with one forward step (O(states²))
+    and returns the filtered probability of each state for the new day.
+    """
+    log_transition = np.log(np.maximum(params['transition'], 1e-300))
+    prior = params['log_alpha'][:, np.newaxis] + log_transition
+    peak = prior.max(axis=0)
+    log_prior = peak + np.log(np.exp(prior - peak).sum(axis=0))
+    
+    log_emission = (-0.5 * ((new_return - params['means']) / params['stds']) ** 2
+                    - np.log(params['stds']))
+    log_alpha = log_prior + log_emission
+    log_alpha -= log_alpha.max() + np.log(np.exp(log_alpha - log_alpha.max()).sum())
+    
+    params['log_alpha'] = log_alpha
+    return np.exp(log_alpha)
+
+
+def hmm_regimes(returns, params):
+    """
+    Regime labels from a fitted HMM, in the same categorical format as detect_market_regimes
+    """
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+    returns = returns.dropna()
+    
+    path = viterbi_hmm(returns, params)
+    label_codes = np.array([MARKET_REGIMES.index(label) for label in params['labels']], dtype=np.int8)
+    
+    return pd.Series(pd.Categorical.from_codes(label_codes[path], categories=MARKET_REGIMES),
+                     index=returns.index)
+
+
+def returns_fingerprint(returns):
+    """
+    Hash of a return series (dates and values) for matching stored model fits
+    """
+    return int(pd.util.hash_pandas_object(returns, index=True).sum())
+
+
+def detect_market_regimes_hmm(returns, num_states=3, init_params=None):
+    """
+    Detect market regimes with a Gaussian hidden Markov model
+
+    Drop-in alternative to detect_market_regimes: fits the HMM (optionally
+    warm-started), decodes the most likely state path with Viterbi and maps
+    states onto the same five regime labels.
+    """
+    params = fit_gaussian_hmm(returns, num_states, init_params=init_params)
+    return hmm_regimes(returns, params)
+
+
+def monte_carlo_simulation(returns, days_forward=252, num_simulations=1000):
+    """
+    Run Monte Carlo simulation for forward-looking risk analysis
+    """
+    # Ensure returns is a Series
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+    
+    # Calculate parameters from historical returns
+    mean_return = returns.mean()
+    std_return = returns.std()
+    
+    # Run simulations
+    last_price = 1.0  # Normalized starting point
+    simulations = np.zeros((days_forward, num_simulations))
+    
+    for i in range(num_simulations):
+        daily_returns = np.random.normal(mean_return, std_return, days_forward)
+        price_path = last_price * (1 + daily_returns).cumprod()
+        simulations[:, i] = price_path
+    
+    return simulations
+
+
+def estimate_regime_transition_matrix(returns, regimes):
+    """
+    Estimate a Markov regime-switching model from classified history
+
+    Counts day-to-day transitions in the detect_market_regimes output and
+    row-normalizes them into a transition matrix. Each regime also gets its
+    own daily mean and standard deviation of returns.
+    """
+    # Ensure returns is a Series
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+
+    aligned = pd.DataFrame({'returns': returns, 'regime': regimes}).dropna()
+    codes, regime_names = pd.factorize(aligned['regime'])
+    num_regimes = len(regime_names)
+
+    # Count transitions between consecutive days
+    counts = np.zeros((num_regimes, num_regimes))
+    np.add.at(counts, (codes[:-1], codes[1:]), 1)
+
+    # Regimes that were never left (e.g. only seen on the last day) persist
+    row_sums = counts.sum(axis=1, keepdims=True)
+    transition_matrix = np.where(
+        row_sums > 0, counts / np.where(row_sums == 0, 1, row_sums), np.eye(num_regimes)
+    )
+
+    # Per-regime return distribution
+    grouped = aligned['returns'].groupby(codes)
+    regime_means = grouped.mean().reindex(range(num_regimes)).values
+    regime_stds = grouped.std().reindex(range(num_regimes)).fillna(aligned['returns'].std()).values
+
+    return {
+        'regimes': list(regime_names),
+        'transition_matrix': transition_matrix,
+        'mean': regime_means,
+        'std': regime_stds,
+        'current_regime': codes[-1]
+    }
+
+
+def regime_switching_simulation(returns, regimes, days_forward=252, num_simulations=1000, seed=None):
+    """
+    Run Monte Carlo simulation from a fitted regime-switching process
+
+    Paths start in today's regime, hop between regimes according to the
+    estimated transition matrix, and draw returns from the active regime's
+    distribution. All paths advance together, one vectorized step per day.
+    """
+    model = estimate_regime_transition_matrix(returns, regimes)
+    rng = np.random.default_rng(seed)
+
+    cum_transition = np.cumsum(model['transition_matrix'], axis=1)
+    cum_transition[:, -1] = 1.0  # Guard against rounding
+
+    uniforms = rng.random((days_forward, num_simulations))
+    shocks = rng.standard_normal((days_forward, num_simulations))
+
+    states = np.full(num_simulations, model['current_regime'])
+    daily_returns = np.empty((days_forward, num_simulations))
+
+    for t in range(days_forward):
+        # Inverse-CDF draw of the next regime for every path at once
+        states = (uniforms[t][:, None] > cum_transition[states]).sum(axis=1)
+        daily_returns[t] = model['mean'][states] + model['std'][states] * shocks[t]
+
+    # Normalized starting point of 1.0, same layout as monte_carlo_simulation
+    return np.cumprod(1 + daily_returns, axis=0)
+
+
+def fit_garch_11(returns):
+    """
+    Fit a GARCH(1,1) volatility model by Gaussian maximum likelihood
+
+    Uses variance targeting (omega = long-run variance * (1 - alpha - beta)),
+    so only alpha and beta are optimized. The conditional variance recursion
+    is evaluated as a linear filter rather than a Python loop.
+    """
+    # Ensure returns is a Series
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+
+    r = np.asarray(returns, dtype=float)
+    r = r[~np.isnan(r)]
+
+    mu = r.mean()
+    residuals = r - mu
+    squared = residuals ** 2
+    long_run_var = squared.mean()
+
+    def conditional_variance(alpha, beta):
+        omega = long_run_var * (1 - alpha - beta)
+        # sigma2[t] = omega + alpha * eps[t-1]^2 + beta * sigma2[t-1]
+        drive = omega + alpha * squared[:-1]
+        tail, _ = lfilter([1.0], [1.0, -beta], drive, zi=[beta * long_run_var])
+        return np.concatenate(([long_run_var], tail))
+
+    def neg_log_likelihood(params):
+        sigma2 = np.maximum(conditional_variance(*params), 1e-12)
+        return 0.5 * np.sum(np.log(sigma2) + squared / sigma2)
+
+    constraints = ({'type': 'ineq', 'fun': lambda x: 0.999 - x[0] - x[1]})
+    bounds = ((1e-6, 0.5), (0.0, 0.999))
+    result = minimize(neg_log_likelihood, [0.08, 0.90], method='SLSQP',
+                      bounds=bounds, constraints=constraints)
+    alpha, beta = result.x if result.success else (0.08, 0.90)
+    omega = long_run_var * (1 - alpha - beta)
+
+    sigma2 = conditional_variance(alpha, beta)
+    next_variance = omega + alpha * squared[-1] + beta * sigma2[-1]
+
+    return {
+        'mu': mu,
+        'omega': omega,
+        'alpha': alpha,
+        'beta': beta,
+        'long_run_variance': long_run_var,
+        'next_variance': next_variance
+    }
+
+
+def garch_simulation(returns, days_forward=252, num_simulations=1000, seed=None):
+    """
+    Run Monte Carlo simulation with GARCH(1,1) volatility clustering
+
+    Paths start from today's conditional volatility, so forward risk reflects
+    whether markets are currently calm or stressed. The variance recursion is
+    vectorized across all paths.
+    """
+    params = fit_garch_11(returns)
+    rng = np.random.default_rng(seed)
+    shocks = rng.standard_normal((days_forward, num_simulations))
+
+    sigma2 = np.full(num_simulations, params['next_variance'])
+    daily_returns = np.empty((days_forward, num_simulations))
+
+    for t in range(days_forward):
+        eps = np.sqrt(sigma2) * shocks[t]
+        daily_returns[t] = params['mu'] + eps
+        sigma2 = params['omega'] + params['alpha'] * eps ** 2 + params['beta'] * sigma2
+
+    return np.cumprod(1 + daily_returns, axis=0)
+
+
+def goal_based_simulation(returns, initial_value=100000, periodic_cash_flow=0.0, years=30,
+                          periods_per_year=12, inflation=0.025, target_value=None,
+                          num_simulations=100000, seed=None):
+    """
+    Simulate a long-term plan with periodic contributions or withdrawals
+
+    Per-period growth is lognormal, fitted to the portfolio's daily history.
+    The cash flow (positive = contribution, negative = withdrawal) is applied
+    at the end of each period to every path at once and grows with inflation.
+    Paths that run out of money stay depleted. Shocks are drawn as antithetic
+    pairs, which halves random number generation and reduces noise.
+
+    target_value and all reported percentiles are in today's dollars.
+    """
+    # Ensure returns is a Series
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+
+    log_returns = np.log1p(returns.dropna())
+    period_mu = log_returns.mean() * 252 / periods_per_year
+    period_sigma = log_returns.std() * np.sqrt(252 / periods_per_year)
+
+    num_periods = int(round(years * periods_per_year))
+    period_inflation = (1 + inflation) ** (1 / periods_per_year)
+    rng = np.random.default_rng(seed)
+
+    wealth = np.full(num_simulations, float(initial_value))
+    depleted = np.zeros(num_simulations, dtype=bool)
+    cash_flow = float(periodic_cash_flow)
+
+    percentile_levels = [5, 25, 50, 75, 95]
+    yearly_percentiles = [np.percentile(wealth, percentile_levels)]
+
+    # Antithetic pairs: each shock z is reused as -z, halving the draws needed
+    half = (num_simulations + 1) // 2
+
+    # Draw shocks one year at a time to bound memory on 100k-path runs
+    for block_start in range(0, num_periods, periods_per_year):
+        block = min(periods_per_year, num_periods - block_start)
+        shock = np.exp(period_sigma * rng.standard_normal((block, half), dtype=np.float32))
+        growth = np.empty((block, num_simulations), dtype=np.float32)
+        growth[:, :half] = shock
+        np.reciprocal(shock[:, :num_simulations - half], out=growth[:, half:])
+        growth *= np.float32(np.exp(period_mu))
+
+        for k in range(block):
+            wealth *= growth[k]
+            wealth += cash_flow
+            np.maximum(wealth, 0.0, out=wealth)
+            depleted |= wealth <= 0
+            cash_flow *= period_inflation
+
+        periods_elapsed = block_start + block
+        deflator = period_inflation ** periods_elapsed
+        yearly_percentiles.append(np.percentile(wealth, percentile_levels) / deflator)
+
+    terminal_real = wealth / period_inflation ** num_periods
+    success = ~depleted
+    if target_value is not None:
+        success &= terminal_real >= target_value
+
+    checkpoint_years = [0] + [min((i + 1), num_periods / periods_per_year)
+                              for i in range(len(yearly_percentiles) - 1)]
+    percentiles_df = pd.DataFrame(
+        yearly_percentiles,
+        index=pd.Index(checkpoint_years, name='Year'),
+        columns=[f'{p}th' for p in percentile_levels]
+    )
+
+    return {
+        'terminal_wealth': wealth,
+        'terminal_real': terminal_real,
+        'success_probability': success.mean(),
+        'depletion_probability': depleted.mean(),
+        'percentiles': percentiles_df
+    }
+
+
+def calculate_forward_risk_metrics(returns, confidence_level=0.95):
+    """
+    Calculate forward-looking risk metrics
+    """
+    # Ensure returns is a Series
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.iloc[:, 0]
+    
+    stats = get_return_statistics(returns)
+    
+    return {
+        'Expected Annual Return': stats['Expected Annual Return'],
+        'Expected Volatility': stats['Annual Volatility'],
+        'VaR (95%)': stats['VaR (95%)'],
+        'VaR (99%)': stats['VaR (99%)'],
+        'CVaR (95%)': stats['CVaR (95%)'],
+        'CVaR (99%)': stats['CVaR (99%)'],
+        'Probability of Daily Loss': stats['Probability of Daily Loss'],
+        'Estimated Max Drawdown': stats['Max Drawdown']
+    }
+
+
+STRESS_SCENARIOS = {
+    '2008 Global Financial Crisis': ('2007-10-09', '2009-03-09'),
+    '2010 Flash Crash & Euro Crisis': ('2010-04-23', '2010-07-02'),
+    '2011 US Debt Downgrade': ('2011-07-07', '2011-10-03'),
+    '2015-16 China & Oil Selloff': ('2015-08-10', '2016-02-11'),
+    '2018 Q4 Selloff': ('2018-09-20', '2018-12-24'),
+    '2020 COVID Crash': ('2020-02-19', '2020-03-23'),
+    '2022 Rate Shock': ('2022-01-03', '2022-10-12')
+}
+
+# Older funds with near-identical exposure, used before a holding's inception
+STRESS_PROXY_MAP = {
+    'VOO': 'SPY', 'IVV': 'SPY', 'SPLG': 'SPY', 'VTI': 'SPY', 'ITOT': 'SPY', 'SCHB': 'SPY',
+    'QQQM': 'QQQ', 'VGT': 'XLK', 'VUG': 'IWF', 'VTV': 'IWD',
+    'VTWO': 'IWM', 'VB': 'IWM', 'IJR': 'IWM', 'VO': 'IJH',
+    'VXUS': 'EFA', 'VEA': 'EFA', 'IEFA': 'EFA', 'VT': 'SPY',
+    'IEMG': 'EEM', 'VWO': 'EEM',
+    'SCHD': 'DVY', 'VYM': 'DVY', 'NOBL': 'DVY',
+    'BND': 'AGG', 'SCHZ': 'AGG', 'VNQ': 'IYR', 'XLRE': 'IYR', 'IAU': 'GLD'
+}
+
+
+def get_stress_price_panel(tickers):
+    """
+    Price history for stress testing, from before the earliest scenario to today
+    """
+    earliest = min(pd.Timestamp(start) for start, _ in STRESS_SCENARIOS.values()) - pd.Timedelta(days=10)
+    return download_ticker_data(list(tickers), earliest, pd.Timestamp.today().normalize())
+
+
+def apply_stress_proxies(asset_returns, proxy_map=STRESS_PROXY_MAP):
+    """
+    Fill returns before each holding's inception with its proxy's returns
+
+    Proxy chains (A -> B -> C) are followed. Gaps inside a holding's own
+    history are treated as flat days.
+    
+    Returns: (filled returns, DataFrame of booleans marking proxied days)
+    """
+    own = asset_returns.notna()
+    lifetime = own.cumsum() > 0
+    filled = asset_returns.where(~lifetime, asset_returns.fillna(0.0))
+    
+    for _ in range(3):
+        for ticker, proxy in proxy_map.items():
+            if ticker in filled.columns and proxy in filled.columns:
+                filled[ticker] = filled[ticker].fillna(filled[proxy])
+    
+    return filled, filled.notna() & ~lifetime
+
+
+def run_stress_tests(asset_returns, portfolios, scenarios=STRESS_SCENARIOS, proxy_map=STRESS_PROXY_MAP):
+    """
+    Replay portfolios through historical crisis windows
+    
+    All portfolios (a dict of {name: {ticker: weight}}) are priced with one
+    matrix product over the proxy-filled asset returns, then every scenario
+    and portfolio is evaluated at once on a scenarios x days x portfolios
+    array of log growth. A portfolio gets no result in a window where one of
+    its holdings has neither its own nor proxy data.
+    
+    Windows run from the close of the start date (the pre-crisis peak) to
+    the close of the end date. For each scenario and portfolio: return over
+    the window, max drawdown within it, worst day, and trading days from the
+    trough until the pre-trough peak is regained (possibly after the window;
+    NaN if never).
+    
+    Returns: DataFrame indexed by (Scenario, Portfolio)
+    """
+    filled, proxied = apply_stress_proxies(asset_returns, proxy_map)
+    names = list(portfolios)
+    weight_matrix = np.array([[portfolios[name].get(ticker, 0.0) for ticker in filled.columns] for name in names])
+    
+    dates = filled.index
+    R = filled.values
+    portfolio_returns = np.nan_to_num(R) @ weight_matrix.T
+    log_growth = np.vstack([np.zeros((1, len(names))), np.cumsum(np.log1p(portfolio_returns), axis=0)])
+    
+    labels = list(scenarios)
+    # Scenario starts are peak closes: the first return counted is the day after
+    starts = np.array([dates.searchsorted(pd.Timestamp(scenarios[s][0]), side='right') for s in labels])
+    ends = np.array([dates.searchsorted(pd.Timestamp(scenarios[s][1]), side='right') - 1 for s in labels])
+    
+    # Row i of log_growth is the close after return i - 1, so window s spans rows starts[s]..ends[s] + 1
+    rows = np.arange(len(dates) + 1)[np.newaxis, :, np.newaxis]
+    base = starts[:, np.newaxis, np.newaxis]
+    last = ends[:, np.newaxis, np.newaxis] + 1
+    in_window = (rows >= base) & (rows <= last)
+    relative = log_growth[np.newaxis] - log_growth[starts][:, np.newaxis, :]
+    
+    peak = np.maximum.accumulate(np.where(in_window, relative, -np.inf), axis=1)
+    drawdown = np.where(in_window, np.expm1(relative - peak), np.inf)
+    trough = drawdown.argmin(axis=1)
+    max_drawdown = np.minimum(drawdown.min(axis=1), 0)
+    window_return = np.expm1(relative[np.arange(len(labels)), ends + 1])
+    
+    peak_at_trough = np.take_along_axis(peak, trough[:, np.newaxis, :], axis=1)
+    recovered = (rows > trough[:, np.newaxis, :]) & (relative >= peak_at_trough - 1e-12)
+    recovery_row = recovered.argmax(axis=1)
+    days_to_recover = np.where(recovered.any(axis=1), recovery_row - trough, np.nan)
+    days_to_recover = np.where(max_drawdown < 0, days_to_recover, 0)
+    
+    daily = np.where(in_window[:, 1:] & (rows[:, 1:] > base), portfolio_returns[np.newaxis], np.inf)
+    worst_row = daily.argmin(axis=1)
+    worst_day = np.take_along_axis(daily, worst_row[:, np.newaxis, :], axis=1)[:, 0]
+    
+    # Coverage: every held asset needs data (own or proxy) on every day of the window
+    return_rows = np.arange(len(dates))[np.newaxis, :]
+    window_rows = (return_rows >= starts[:, np.newaxis]) & (return_rows <= ends[:, np.newaxis])
+    available = ~(window_rows[:, :, np.newaxis] & np.isnan(R)[np.newaxis]).any(axis=1)
+    available &= (ends >= starts)[:, np.newaxis]
+    held = weight_matrix != 0
+    covered = ~(held[np.newaxis] & ~available[:, np.newaxis, :]).any(axis=2)
+    uses_proxy = (window_rows[:, :, np.newaxis] & proxied.values[np.newaxis]).any(axis=1)
+    
+    records = []
+    for s, scenario in enumerate(labels):
+        for p, name in enumerate(names):
+            ok = covered[s, p]
+            records.append({
+                'Scenario': scenario,
+                'Portfolio': name,
+                'Start': scenarios[scenario][0],
+                'End': scenarios[scenario][1],
+                'Return': window_return[s, p] if ok else np.nan,
+                'Max Drawdown': max_drawdown[s, p] if ok else np.nan,
+                'Worst Day': worst_day[s, p] if ok else np.nan,
+                'Worst Day Date': dates[worst_row[s, p]] if ok else pd.NaT,
+                'Trough Date': dates[trough[s, p] - 1] if ok and trough[s, p] > 0 else pd.NaT,
+                'Days to Recover': days_to_recover[s, p] if ok else np.nan,
+                'Proxies Used': ', '.join(f"{t}→{proxy_map.get(t, '?')}" for t in filled.columns[held[p] & uses_proxy[s]]),
+                'Covered': ok
+            })
+    
+    return pd.DataFrame(records).set_index(['Scenario', 'Portfolio'])
+
+
+@st.cache_data(ttl=3600)
+def get_stress_tests(portfolios):
+    """
+    Memoized stress test replay for the Forward Risk tab - downloads one price panel
+    covering every holding, benchmark and proxy. Raises ValueError when the
+    download fails, so a failure is never cached.
+    """
+    tickers = {t for weights in portfolios.values() for t in weights}
+    tickers |= {STRESS_PROXY_MAP[t] for t in tickers if t in STRESS_PROXY_MAP}
+    tickers |= {STRESS_PROXY_MAP[t] for t in tickers if t in STRESS_PROXY_MAP}
+    panel = get_stress_price_panel(tuple(sorted(tickers)))
+    if panel is None or panel.empty:
+        raise ValueError("Could not download the price history needed for stress testing")
+    return run_stress_tests(panel.ffill().pct_change().iloc[1:], portfolios)
+
+
+def calculate_risk_contributions(asset_returns, weights, alpha=0.95, cov_matrix=None):
+    """
+    Marginal and component contributions to volatility, VaR and CVaR per holding
+    
+    Volatility uses one covariance product: marginal = Σw / σ and component
+    = w * marginal, which sums to σ (Euler allocation). VaR and CVaR are
+    historical, daily and reported as positive losses: the portfolio
+    scenarios are one matrix-vector product, and each holding's component
+    is its weighted average return over the tail scenarios (CVaR) or over
+    the scenarios adjacent to the VaR quantile (VaR), so components sum to
+    the totals. `cov_matrix` (annualized) defaults to the sample estimate.
+    
+    Returns: dict with contributions (DataFrame per ticker), volatility
+    (annualized), var and cvar (daily)
+    """
+    if isinstance(weights, dict):
+        weights = np.array([weights.get(ticker, 0.0) for ticker in asset_returns.columns], dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    R = asset_returns.dropna().values
+    
+    cov = np.cov(R, rowvar=False) * 252 if cov_matrix is None else np.asarray(cov_matrix, dtype=float)
+    cov_w = cov @ weights
+    volatility = np.sqrt(weights @ cov_w)
+    marginal_vol = cov_w / volatility
+    component_vol = weights * marginal_vol
+    
+    # Scenario-based measures from one sorted pass over portfolio returns
+    scenarios = R @ weights
+    order = np.argsort(scenarios)
+    tail_size = max(1, int(np.floor(len(scenarios) * (1 - alpha))))
+    tail = order[:tail_size]
+    cvar = -scenarios[tail].mean()
+    component_cvar = -weights * R[tail].mean(axis=0)
+    
+    # VaR components: average over a small band of scenarios around the quantile
+    band = max(1, int(round(0.005 * len(scenarios))))
+    neighbourhood = order[max(0, tail_size - 1 - band):tail_size + band]
+    var = -np.quantile(scenarios, 1 - alpha)
+    component_var = -weights * R[neighbourhood].mean(axis=0)
+    component_var *= var / component_var.sum() if component_var.sum() != 0 else 0.0
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        contributions = pd.DataFrame({
+            'Weight': weights,
+            'Marginal Vol': marginal_vol,
+            'Component Vol': component_vol,
+            '% of Vol': component_vol / volatility,
+            'Component VaR': component_var,
+            '% of VaR': component_var / var,
+            'Component CVaR': component_cvar,
+            '% of CVaR': component_cvar / cvar
+        }, index=asset_returns.columns)
+    
+    return {
+        'contributions': contributions,
+        'volatility': volatility,
+        'var': var,
+        'cvar': cvar
+    }
+
+
+def calculate_brinson_attribution(portfolio_weights, portfolio_returns, benchmark_weights, benchmark_returns,
+                                  categories=None):
+    """
+    Brinson-Fama return attribution of a portfolio against a benchmark
+    
+    Holdings are grouped into segments (ETF category from the ETF database
+    by default, 'Other' when unknown). With segment weights w and returns r,
+    active return splits into allocation (w_p - w_b)(r_b - R_b), selection
+    w_b(r_p - r_b) and interaction (w_p - w_b)(r_p - r_b). A segment the
+    benchmark does not hold is measured against itself (r_b = r_p), so it
+    counts purely as allocation, (w_p - w_b)(r_p - R_b). Asset returns
+    are annualized arithmetic means over the dates both return panels
+    cover, so the effects add up exactly to the difference in annual return
+    of the two (daily-rebalanced) portfolios.
+    
+    Returns: DataFrame indexed by segment plus a 'Total' row
+    """
+    common = portfolio_returns.dropna().index.intersection(benchmark_returns.dropna().index)
+    mean_returns = pd.concat([portfolio_returns.loc[common].mean(), benchmark_returns.loc[common].mean()])
+    mean_returns = mean_returns[~mean_returns.index.duplicated()] * 252
+    
+    holdings = pd.DataFrame({
+        'Portfolio': pd.Series(portfolio_weights, dtype=float),
+        'Benchmark': pd.Series(benchmark_weights, dtype=float)
+    }).fillna(0.0)
+    
+    if categories is None:
+        categories = {ticker: (get_etf_expense_ratio_database(ticker) or {}).get('category', 'Other')
+                      for ticker in holdings.index}
+    segment = holdings.index.map(lambda t: categories.get(t, 'Other'))
+    
+    weighted = holdings.mul(mean_returns.reindex(holdings.index), axis=0)
+    segment_weights = holdings.groupby(segment).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        segment_returns = weighted.groupby(segment).sum() / segment_weights
+    
+    benchmark_total = (segment_weights['Benchmark'] * segment_returns['Benchmark'].fillna(0)).sum()
+    rp = segment_returns['Portfolio'].fillna(segment_returns['Benchmark']).fillna(0.0)
+    rb = segment_returns['Benchmark'].fillna(rp)
+    wp, wb = segment_weights['Portfolio'], segment_weights['Benchmark']
+    
+    attribution = pd.DataFrame({
+        'Portfolio Weight': wp,
+        'Benchmark Weight': wb,
+        'Portfolio Return': segment_returns['Portfolio'],
+        'Benchmark Return': segment_returns['Benchmark'],
+        'Allocation': (wp - wb) * (rb - benchmark_total),
+        'Selection': wb * (rp - rb),
+        'Interaction': (wp - wb) * (rp - rb)
+    })
+    attribution['Total'] = attribution[['Allocation', 'Selection', 'Interaction']].sum(axis=1)
+    
+    totals = attribution[['Portfolio Weight', 'Benchmark Weight', 'Allocation', 'Selection', 'Interaction', 'Total']].sum()
+    totals['Portfolio Return'] = (wp * rp).sum()
+    totals['Benchmark Return'] = benchmark_total
+    attribution.loc['Total'] = totals
+    return attribution
+
+
+# =============================================================================
+# FACTOR ANALYSIS FUNCTIONS
+# =============================================================================
+
+FACTOR_DATA_DIR = 'factor_data'
+
+
+def load_factor_returns(source, percent=None):
+    """
+    Load factor returns from a Fama-French style CSV file
+    
+    `source` is a file path or an uploaded file object. Text preambles and
+    trailing sections (e.g. the annual block in Ken French files) are skipped:
+    the table starts at the first header row followed by a dated row and ends
+    at the first row that is not dated. Dates may be YYYYMMDD (daily),
+    YYYYMM (monthly) or any format pandas parses. Values quoted in percent are
+    converted to decimals; by default this is detected from their magnitude.
+    
+    Returns: DataFrame of factor returns indexed by date, including an 'RF'
+    column when the file has one
+    """
+    if hasattr(source, 'read'):
+        text = source.read()
+        text = text.decode('utf-8', errors='ignore') if isinstance(text, bytes) else text
+    else:
+        with open(source, encoding='utf-8', errors='ignore') as f:
+            text = f.read()
+    
+    def parse_date(field):
+        field = field.strip()
+        if not field:
+            return None
+        if field.isdigit() and len(field) == 8:
+            return pd.to_datetime(field, format='%Y%m%d')
+        if field.isdigit() and len(field) == 6:
+            return pd.to_datetime(field, format='%Y%m') + pd.offsets.MonthEnd(0)
+        if field.isdigit():
+            return None
+        try:
+            date = pd.to_datetime(field)
+        except (ValueError, TypeError):
+            return None
+        return None if pd.isna(date) else date
+    
+    lines = [line for line in text.splitlines() if line.strip()]
+    start = next((i for i in range(len(lines) - 1)
+                  if ',' in lines[i] and parse_date(lines[i].split(',')[0]) is None
+                  and parse_date(lines[i + 1].split(',')[0]) is not None), None)
+    if start is None:
+        raise ValueError("No dated factor table found in file")
+    
+    header = [name.strip() for name in lines[start].split(',')]
+    dates, rows = [], []
+    for line in lines[start + 1:]:
+        fields = line.split(',')
+        date = parse_date(fields[0])
+        if date is None:
+            break
+        dates.append(date)
+        rows.append([float(x) if x.strip() else np.nan for x in fields[1:len(header)]])
+    
+    factors = pd.DataFrame(rows, index=pd.DatetimeIndex(dates), columns=header[1:]).sort_index()
+    if percent is None:
+        percent = np.nanmedian(np.abs(factors.values)) > 0.05
+    return factors / 100 if percent else factors
+
+
+def list_local_factor_files(directory=FACTOR_DATA_DIR):
+    """
+    CSV factor files available in the local factor data directory
+    """
+    return sorted(glob.glob(os.path.join(directory, '*.csv')))
+
+
+def align_factor_data(returns, factors):
+    """
+    Align returns with factor returns, in excess of the factor file's risk-free rate
+
+    Daily returns are compounded to month ends when the factors are monthly.
+    Rows missing factor data are dropped; a missing return stays NaN so each
+    series keeps its own history (see factor_regression_groups).
+    
+    Returns: (excess returns DataFrame, factor DataFrame without RF), sharing one index
+    """
+    if isinstance(returns, pd.Series):
+        returns = returns.to_frame(returns.name if returns.name is not None else 'returns')
+    
+    spacing = np.median(np.diff(factors.index.values).astype('timedelta64[D]').astype(float)) if len(factors) > 1 else 1
+    if spacing > 20:
+        returns = compute_calendar_returns(returns, ('M',))['M']
+    
+    data = returns.join(factors, how='inner')
+    data = data[data[factors.columns].notna().all(axis=1) & data[returns.columns].notna().any(axis=1)]
+    factor_columns = [c for c in factors.columns if c != 'RF']
+    excess = data[returns.columns]
+    if 'RF' in factors.columns:
+        excess = excess.sub(data['RF'], axis=0)
+    return excess, data[factor_columns]
+
+
+def factor_regression_groups(excess):
+    """
+    Group series that share the same available observations
+    
+    Yields (column positions, row mask) per group, so every regression drops
+    only its own missing rows while series with identical histories (a
+    portfolio and its holdings) still share one solve.
+    """
+    valid = excess.notna().values
+    masks, group_of_column = np.unique(valid.T, axis=0, return_inverse=True)
+    for group, mask in enumerate(masks):
+        yield np.flatnonzero(group_of_column.ravel() == group), mask
+
+
+def calculate_factor_exposures(returns, factors):
+    """
+    Multi-factor regressions for many return series in a few least-squares solves
+    
+    Every column of `returns` (the portfolio, its holdings, comparison
+    portfolios) is regressed on an intercept + factor design matrix over the
+    dates it has data for. Series with the same dates share a single
+    np.linalg.lstsq call. Returns are taken in excess of 'RF' when the
+    factor data has it.
+    
+    Returns: dict with betas (series x factors), alpha (annualized),
+    t_stats (series x ['Alpha'] + factors), r_squared, residual_vol
+    (annualized) and observations (per series)
+    """
+    excess, factor_data = align_factor_data(returns, factors)
+    num_factors = factor_data.shape[1]
+    num_series = excess.shape[1]
+    periods_per_year = 12 if np.median(np.diff(excess.index.values).astype('timedelta64[D]').astype(float)) > 20 else 252
+    
+    coefficients = np.full((num_factors + 1, num_series), np.nan)
+    t_stats = np.full((num_factors + 1, num_series), np.nan)
+    residual_var = np.full(num_series, np.nan)
+    r_squared = np.full(num_series, np.nan)
+    observations = np.zeros(num_series, dtype=int)
+    
+    for columns, mask in factor_regression_groups(excess):
+        num_obs = int(mask.sum())
+        observations[columns] = num_obs
+        if num_obs <= num_factors + 1:
+            continue
+        X = np.column_stack([np.ones(num_obs), factor_data.values[mask]])
+        Y = excess.values[mask][:, columns]
+        group_coefficients, _, _, _ = np.linalg.lstsq(X, Y, rcond=None)
+        
+        residuals = Y - X @ group_coefficients
+        group_var = (residuals ** 2).sum(axis=0) / (num_obs - num_factors - 1)
+        standard_errors = np.sqrt(np.outer(np.diag(np.linalg.pinv(X.T @ X)), group_var))
+        total_ss = ((Y - Y.mean(axis=0)) ** 2).sum(axis=0)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_stats[:, columns] = group_coefficients / standard_errors
+            r_squared[columns] = 1 - (residuals ** 2).sum(axis=0) / total_ss
+        coefficients[:, columns] = group_coefficients
+        residual_var[columns] = group_var
+    
+    if not np.isfinite(residual_var).any():
+        raise ValueError("Not enough overlapping observations between returns and factors")
+    
+    names = excess.columns
+    return {
+        'betas': pd.DataFrame(coefficients[1:].T, index=names, columns=factor_data.columns),
+        'alpha': pd.Series(coefficients[0] * periods_per_year, index=names, name='Alpha'),
+        't_stats': pd.DataFrame(t_stats.T, index=names, columns=['Alpha'] + list(factor_data.columns)),
+        'r_squared': pd.Series(r_squared, index=names, name='R-Squared'),
+        'residual_vol': pd.Series(np.sqrt(residual_var * periods_per_year), index=names, name='Residual Volatility'),
+        'observations': pd.Series(observations, index=names, name='Observations')
+    }
+
+
+def calculate_rolling_factor_exposures(returns, factors, window=126):
+    """
+    Rolling-window multi-factor betas for many series at once
+    
+    Uses the same cumulative-sum approach as compute_rolling_statistics:
+    cross-products X'X and X'Y are accumulated once (on centered data),
+    each window is a difference of two cumsum rows, and all windows are
+    solved with one batched np.linalg.solve (windows whose factors are
+    collinear are left NaN). Each group of series sharing
+    the same available dates (factor_regression_groups) is solved on its
+    own rows; windows are counted in observations.
+    
+    Returns: {factor: DataFrame (dates x series) of rolling betas}, plus
+    'Alpha' (annualized rolling intercept)
+    """
+    excess, factor_data = align_factor_data(returns, factors)
+    periods_per_year = 12 if np.median(np.diff(excess.index.values).astype('timedelta64[D]').astype(float)) > 20 else 252
+    
+    def cumulative(x):
+        return np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(x, axis=0)])
+    
+    factor_names = list(factor_data.columns) + ['Alpha']
+    rolling = {factor: [] for factor in factor_names}
+    for columns, mask in factor_regression_groups(excess):
+        num_obs = int(mask.sum())
+        if num_obs < window:
+            continue
+        factor_values = factor_data.values[mask]
+        series_values = excess.values[mask][:, columns]
+        F = factor_values - factor_values.mean(axis=0)
+        Y = series_values - series_values.mean(axis=0)
+        X = np.column_stack([np.ones(num_obs), F])
+        
+        xx = cumulative(X[:, :, np.newaxis] * X[:, np.newaxis, :])
+        xy = cumulative(X[:, :, np.newaxis] * Y[:, np.newaxis, :])
+        window_xx = xx[window:] - xx[:-window]
+        window_xy = xy[window:] - xy[:-window]
+        
+        # A factor that is constant (e.g. zero-filled) within a window makes that window
+        # singular: leave those windows NaN instead of failing the whole panel
+        solvable = np.linalg.cond(window_xx) < 1e12
+        coefficients = np.full(window_xy.shape, np.nan)
+        if solvable.any():
+            coefficients[solvable] = np.linalg.solve(window_xx[solvable], window_xy[solvable])
+        
+        # Undo the centering: alpha = mean(y) - beta'mean(f) on the original scale
+        y_means = series_values.mean(axis=0)
+        f_means = factor_values.mean(axis=0)
+        alpha = coefficients[:, 0, :] + y_means - np.einsum('k,tkp->tp', f_means, coefficients[:, 1:, :])
+        
+        index = excess.index[mask][window - 1:]
+        names = excess.columns[columns]
+        for k, factor in enumerate(factor_data.columns):
+            rolling[factor].append(pd.DataFrame(coefficients[:, k + 1, :], index=index, columns=names))
+        rolling['Alpha'].append(pd.DataFrame(alpha * periods_per_year, index=index, columns=names))
+    
+    if not rolling['Alpha']:
+        return {}
+    return {factor: pd.concat(frames, axis=1).reindex(columns=excess.columns).dropna(axis=1, how='all')
+            for factor, frames in rolling.items()}
+
+
+@st.cache_data(ttl=3600)
+def get_factor_exposures(returns, factors, window=126):
+    """
+    Memoized static and rolling factor exposures for the Detailed Analysis tab
+    """
+    return {
+        'static': calculate_factor_exposures(returns, factors),
+        'rolling': calculate_rolling_factor_exposures(returns, factors, window)
+    }
+
+
+# Macro factors represented by liquid ETF proxies. Shocks are entered in `unit`
+# and converted to a proxy return with `scale` (rates and spreads via duration).
+MACRO_SHOCK_FACTORS = {
+    'Equities': {'proxy': 'SPY', 'unit': '%', 'scale': 0.01},
+    'Rates': {'proxy': 'IEF', 'unit': 'bp', 'scale': -7.5 / 10000},
+    'Credit Spreads': {'proxy': 'HYG', 'unit': 'bp', 'scale': -4.0 / 10000},
+    'Gold': {'proxy': 'GLD', 'unit': '%', 'scale': 0.01},
+    'US Dollar': {'proxy': 'UUP', 'unit': '%', 'scale': 0.01},
+    'Oil': {'proxy': 'USO', 'unit': '%', 'scale': 0.01}
+}
+
+SHOCK_PRESETS = {
+    'Rates +200bp, Equities -20%': {'Rates': 200, 'Equities': -20},
+    'Equity Crash (-30%)': {'Equities': -30},
+    'Stagflation': {'Oil': 50, 'Rates': 150, 'Equities': -15},
+    'Flight to Quality': {'Equities': -15, 'Rates': -100, 'Gold': 10},
+    'Credit Crunch': {'Credit Spreads': 300, 'Equities': -25},
+    'Dollar Surge (+10%)': {'US Dollar': 10},
+    'Soft Landing Rally': {'Equities': 15, 'Rates': -50}
+}
+
+
+def estimate_factor_sensitivities(asset_returns, factor_prices):
+    """
+    Historical sensitivities of each holding to the MACRO_SHOCK_FACTORS proxies
+
+    One multivariate least-squares fit (calculate_factor_exposures) over the
+    dates both panels cover. The factor covariance is kept so shocks to
+    some factors can be propagated to the others.
+    
+    Returns: dict with betas (holdings x factors), r_squared and factor_cov
+    (daily covariance of proxy returns)
+    """
+    proxy_names = {spec['proxy']: name for name, spec in MACRO_SHOCK_FACTORS.items()}
+    factor_returns = factor_prices.ffill().pct_change().iloc[1:].rename(columns=proxy_names)
+    factor_returns = factor_returns[[name for name in MACRO_SHOCK_FACTORS if name in factor_returns.columns]].dropna()
+    
+    exposures = calculate_factor_exposures(asset_returns, factor_returns)
+    common = factor_returns.loc[factor_returns.index.intersection(asset_returns.dropna().index)]
+    return {
+        'betas': exposures['betas'],
+        'r_squared': exposures['r_squared'],
+        'factor_cov': common.cov()
+    }
+
+
+def apply_factor_shocks(betas, weights, shocks, factor_cov=None):
+    """
+    Portfolio and holding P&L for many factor-shock scenarios in one matrix product
+    
+    `shocks` is an M x K DataFrame in MACRO_SHOCK_FACTORS units (%, bp), one
+    row per scenario; NaN means "not shocked". Without `factor_cov`
+    unshocked factors stay at zero. With it, they move by their conditional
+    expectation given the shocked ones, f_U = f_S Σ_SS⁻¹ Σ_SU, computed
+    once per distinct set of shocked factors.
+    
+    Returns: dict with portfolio (Series of P&L per scenario), holdings
+    (M x N weighted P&L) and factor_moves (M x K proxy returns used)
+    """
+    factors = list(betas.columns)
+    shocks = shocks.reindex(columns=factors)
+    scale = np.array([MACRO_SHOCK_FACTORS[f]['scale'] for f in factors])
+    moves = shocks.values * scale
+    
+    shocked = ~np.isnan(moves)
+    if factor_cov is not None:
+        cov = factor_cov.loc[factors, factors].values
+        patterns, pattern_ids = np.unique(shocked, axis=0, return_inverse=True)
+        for pattern_id, pattern in enumerate(patterns):
+            if pattern.all() or not pattern.any():
+                continue
+            rows = pattern_ids.ravel() == pattern_id
+            propagation = np.linalg.solve(cov[np.ix_(pattern, pattern)], cov[np.ix_(pattern, ~pattern)])
+            block = moves[rows]
+            block[:, ~pattern] = block[:, pattern] @ propagation
+            moves[rows] = block
+    moves = np.nan_to_num(moves)
+    
+    if isinstance(weights, dict):
+        weights = np.array([weights.get(ticker, 0.0) for ticker in betas.index], dtype=float)
+    holding_pnl = (moves @ betas.values.T) * weights
+    
+    return {
+        'portfolio': pd.Series(holding_pnl.sum(axis=1), index=shocks.index, name='P&L'),
+        'holdings': pd.DataFrame(holding_pnl, index=shocks.index, columns=betas.index),
+        'factor_moves': pd.DataFrame(moves, index=shocks.index, columns=factors)
+    }
+
+
+@st.cache_data(ttl=3600)
+def get_macro_sensitivities(prices, start_date, end_date):
+    """
+    Memoized macro factor sensitivities for a portfolio's holdings
+
+    Raises ValueError when the proxy download fails, so a failure is never cached.
+    """
+    proxies = [spec['proxy'] for spec in MACRO_SHOCK_FACTORS.values()]
+    factor_prices = download_ticker_data(proxies, start_date, end_date)
+    if factor_prices is None or factor_prices.empty:
+        raise ValueError("Could not download factor proxy data for shock analysis")
+    return estimate_factor_sensitivities(get_asset_returns(prices), factor_prices)
+
+
+def factor_shock_grid(betas, weights, factor_x, values_x, factor_y, values_y, factor_cov=None):
+    """
+    Portfolio P&L over a 2-D grid of shocks to two factors (e.g. equities x rates)
+
+    Returns: DataFrame indexed by factor_y values with factor_x values as columns
+    """
+    grid_x, grid_y = np.meshgrid(values_x, values_y)
+    shocks = pd.DataFrame({factor_x: grid_x.ravel(), factor_y: grid_y.ravel()})
+    pnl = apply_factor_shocks(betas, weights, shocks, factor_cov)['portfolio'].values
+    return pd.DataFrame(pnl.reshape(grid_x.shape), index=values_y, columns=values_x)
+
+
+# =============================================================================
+# TAX LOT FUNCTIONS
+# =============================================================================
+
+# ETF swaps that keep market exposure after a loss sale
+TAX_LOSS_SWAP_MAP = {
+    'SPY': {'swap_to': 'VOO', 'name': 'Vanguard S&P 500', 'note': 'Identical index, lower fees'},
+    'VOO': {'swap_to': 'IVV', 'name': 'iShares Core S&P 500', 'note': 'Identical index'},
+    'IVV': {'swap_to': 'SPY', 'name': 'SPDR S&P 500', 'note': 'Identical index'},
+    'QQQ': {'swap_to': 'QQQM', 'name': 'Invesco NASDAQ 100', 'note': 'Identical index, lower fees'},
+    'QQQM': {'swap_to': 'QQQ', 'name': 'Invesco QQQ Trust', 'note': 'Identical index'},
+    'VTI': {'swap_to': 'ITOT', 'name': 'iShares Core Total US', 'note': 'Same exposure'},
+    'ITOT': {'swap_to': 'VTI', 'name': 'Vanguard Total Market', 'note': 'Same exposure'},
+    'IWM': {'swap_to': 'VTWO', 'name': 'Vanguard Russell 2000', 'note': 'Identical index'},
+    'VTWO': {'swap_to': 'VB', 'name': 'Vanguard Small-Cap', 'note': 'Similar exposure'},
+    'AGG': {'swap_to': 'BND', 'name': 'Vanguard Total Bond', 'note': 'Identical exposure'},
+    'BND': {'swap_to': 'AGG', 'name': 'iShares Aggregate Bond', 'note': 'Identical exposure'},
+}
+
+LOT_METHODS = {
+    'FIFO': 'First In, First Out',
+    'HIFO': 'Highest Cost First (minimizes gains)',
+    'SPEC_ID': 'Specific Lot (from Lot ID column)'
+}
+
+WASH_SALE_WINDOW_DAYS = 30
 
 
-def analyze_regime_performance(returns, regimes):
-    """
-    Analyze portfolio performance by market regime
+def load_transactions(source):
     """
-    df = pd.DataFrame({'returns': returns, 'regime': regimes})
+    Load a transaction history CSV for the tax-lot ledger
     
-    regime_stats = []
-    for regime in df['regime'].unique():
-        regime_returns = df[df['regime'] == regime]['returns']
-        
-        if len(regime_returns) > 0:
-            stats = {
-                'Regime': regime,
-                'Occurrences': len(regime_returns),
-                'Avg Daily Return': regime_returns.mean(),
-                'Volatility': regime_returns.std() * np.sqrt(252),
-                'Best Day': regime_returns.max(),
-                'Worst Day': regime_returns.min(),
-                'Win Rate': (regime_returns > 0).sum() / len(regime_returns)
-            }
-            regime_stats.append(stats)
+    Required columns (case-insensitive): Date, Ticker, Action (BUY/SELL),
+    Shares, Price. Optional: Lot ID - on a BUY it names the lot, on a SELL it
+    picks the lot to sell under specific identification - and Account, which
+    keeps several accounts' lots apart in one file. Rows are sorted by date,
+    buys before sells on the same day.
     
-    return pd.DataFrame(regime_stats)
+    Returns: DataFrame with Date, Ticker, Action, Shares, Price, Lot ID
+    (plus Account when present)
+    """
+    transactions = pd.read_csv(source)
+    transactions.columns = [c.strip().lower().replace('_', ' ') for c in transactions.columns]
+    missing = {'date', 'ticker', 'action', 'shares', 'price'} - set(transactions.columns)
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+    
+    accounts = transactions['account'].astype(str).str.strip() if 'account' in transactions.columns else None
+    transactions = pd.DataFrame({
+        'Date': pd.to_datetime(transactions['date']),
+        'Ticker': transactions['ticker'].astype(str).str.strip().str.upper(),
+        'Action': transactions['action'].astype(str).str.strip().str.upper(),
+        'Shares': pd.to_numeric(transactions['shares']).abs(),
+        'Price': pd.to_numeric(transactions['price']),
+        'Lot ID': transactions['lot id'].astype(str).where(transactions['lot id'].notna(), None)
+                  if 'lot id' in transactions.columns else None
+    })
+    if accounts is not None:
+        transactions.insert(0, 'Account', accounts)
+    invalid = ~transactions['Action'].isin(['BUY', 'SELL'])
+    if invalid.any():
+        raise ValueError(f"Unknown actions: {', '.join(transactions.loc[invalid, 'Action'].unique())}")
+    
+    transactions['Order'] = transactions['Action'].map({'BUY': 0, 'SELL': 1})
+    transactions = transactions.sort_values(['Date', 'Order'], kind='stable').drop(columns='Order')
+    return transactions.reset_index(drop=True)
+
+
+def build_tax_lots(transactions, method='FIFO'):
+    """
+    Replay transactions into open tax lots and realized gains
+    
+    Each ticker keeps its open lots in sorted structures so every sale
+    touches only the lots it consumes: a deque in acquisition order (FIFO),
+    a heap keyed on cost per share (HIFO) and a dict by lot id (SPEC_ID,
+    falling back to FIFO for shares the named lot cannot cover). Fully
+    consumed lots are skipped lazily. With an Account column every account
+    keeps its own lots. Gains are long-term when the lot was held more than
+    one year.
+    
+    Returns: dict with lots (open lots DataFrame), realized (one row per
+    lot consumed by a sale) and purchases (every BUY with the lot id it was
+    assigned, indexed like `transactions`)
+    """
+    has_accounts = 'Account' in transactions.columns
+    lot_ids, lot_accounts, lot_tickers, lot_dates, lot_costs, lot_remaining = [], [], [], [], [], []
+    lot_rows, lot_shares = [], []
+    fifo, hifo, by_id = {}, {}, {}
+    realized = []
+    
+    accounts = transactions['Account'].tolist() if has_accounts else [None] * len(transactions)
+    rows = zip(transactions.index.tolist(), accounts,
+               *(transactions[column].tolist() for column in ['Date', 'Ticker', 'Action', 'Shares', 'Price', 'Lot ID']))
+    for row, account, date, ticker, action, shares, price, lot_ref in rows:
+        lot_ref = lot_ref if isinstance(lot_ref, str) and lot_ref else None
+        position = (account, ticker)
+        if action == 'BUY':
+            lot = len(lot_ids)
+            lot_id = lot_ref or f"{ticker}-{lot + 1}"
+            lot_ids.append(lot_id)
+            lot_accounts.append(account)
+            lot_tickers.append(ticker)
+            lot_dates.append(date)
+            lot_costs.append(price)
+            lot_remaining.append(shares)
+            lot_rows.append(row)
+            lot_shares.append(shares)
+            if method == 'HIFO':
+                heapq.heappush(hifo.setdefault(position, []), (-price, date, lot))
+            else:
+                fifo.setdefault(position, deque()).append(lot)
+            by_id[(account, lot_id)] = lot
+            continue
+        
+        def take(lot, wanted):
+            quantity = min(wanted, lot_remaining[lot])
+            lot_remaining[lot] -= quantity
+            realized.append((account, date, ticker, lot_ids[lot], lot_dates[lot], quantity,
+                             quantity * price, quantity * lot_costs[lot]))
+            return wanted - quantity
+        
+        remaining = shares
+        if method == 'SPEC_ID' and (account, lot_ref) in by_id:
+            lot = by_id[(account, lot_ref)]
+            if lot_tickers[lot] == ticker and lot_remaining[lot] > 0:
+                remaining = take(lot, remaining)
+        
+        if method == 'HIFO':
+            heap = hifo.get(position, [])
+            while remaining > 1e-12 and heap:
+                lot = heap[0][2]
+                if lot_remaining[lot] <= 1e-12:
+                    heapq.heappop(heap)
+                    continue
+                remaining = take(lot, remaining)
+        else:
+            queue = fifo.get(position, deque())
+            while remaining > 1e-12 and queue:
+                lot = queue[0]
+                if lot_remaining[lot] <= 1e-12:
+                    queue.popleft()
+                    continue
+                remaining = take(lot, remaining)
+        
+        if remaining > 1e-9:
+            where = f" in account {account}" if has_accounts else ""
+            raise ValueError(f"Sale of {shares:g} {ticker} on {date:%Y-%m-%d}{where} exceeds shares held")
+    
+    purchases = pd.DataFrame({
+        'Account': lot_accounts,
+        'Date': pd.to_datetime(lot_dates),
+        'Ticker': lot_tickers,
+        'Lot ID': lot_ids,
+        'Shares': lot_shares,
+        'Price': lot_costs
+    }, index=pd.Index(lot_rows, name=transactions.index.name))
+    lots = pd.DataFrame({
+        'Account': lot_accounts,
+        'Lot ID': lot_ids,
+        'Ticker': lot_tickers,
+        'Acquired': pd.to_datetime(lot_dates),
+        'Shares': lot_remaining,
+        'Cost/Share': lot_costs
+    })
+    lots = lots[lots['Shares'] > 1e-9].reset_index(drop=True)
+    lots['Cost Basis'] = lots['Shares'] * lots['Cost/Share']
+    
+    realized = pd.DataFrame(realized, columns=['Account', 'Sale Date', 'Ticker', 'Lot ID', 'Acquired', 'Shares',
+                                               'Proceeds', 'Cost Basis'])
+    realized['Gain/Loss'] = realized['Proceeds'] - realized['Cost Basis']
+    long_term = realized['Sale Date'] > pd.to_datetime(realized['Acquired']) + pd.DateOffset(years=1)
+    realized['Term'] = np.where(long_term, 'Long', 'Short')
+    
+    if not has_accounts:
+        lots = lots.drop(columns='Account')
+        realized = realized.drop(columns='Account')
+        purchases = purchases.drop(columns='Account')
+    return {'lots': lots, 'realized': realized, 'purchases': purchases}
+
+
+def get_wash_sale_partners(ticker):
+    """
+    Funds whose purchase may count as buying back `ticker` for wash-sale purposes
+
+    Swap partners from TAX_LOSS_SWAP_MAP and get_cheaper_etf_alternatives, in
+    both directions.
+    """
+    partners = {alt['symbol'] for alt in get_cheaper_etf_alternatives(ticker, None)}
+    if ticker in TAX_LOSS_SWAP_MAP:
+        partners.add(TAX_LOSS_SWAP_MAP[ticker]['swap_to'])
+    partners |= {t for t, swap in TAX_LOSS_SWAP_MAP.items() if swap['swap_to'] == ticker}
+    partners |= {t for t in ('SPY', 'QQQ', 'IWM', 'AGG', 'VTI')
+                 if ticker in {alt['symbol'] for alt in get_cheaper_etf_alternatives(t, None)}}
+    partners.discard(ticker)
+    return partners
 
 
-def monte_carlo_simulation(returns, days_forward=252, num_simulations=1000):
+def detect_wash_sales(ledger, window_days=WASH_SALE_WINDOW_DAYS, include_partners=True):
     """
-    Run Monte Carlo simulation for forward-looking risk analysis
+    Match loss sales with purchases inside the ±window_days wash-sale window
+    
+    `ledger` is the output of build_tax_lots. For each ticker sold at a
+    loss, the sale windows form an IntervalIndex. Every window has the same
+    length, so sorted by start they are also sorted by end, and the windows
+    containing a purchase date are one contiguous slice found with two
+    binary searches. Purchases of the same ticker and, optionally, of its
+    swap partners are checked, within the same account when accounts are
+    given.
+    
+    Shares of a purchase that were sold on or before the sale date
+    (including in the loss sale itself) cannot replace it. The remaining
+    shares replace sold shares only once: conflicts are allocated in
+    chronological order (by sale, then purchase), and the disallowed loss
+    is the sold lot's loss pro rata to the shares matched.
+    
+    Returns: DataFrame with one row per (loss sale, purchase) match
     """
-    # Ensure returns is a Series
-    if isinstance(returns, pd.DataFrame):
-        returns = returns.iloc[:, 0]
-    
-    # Calculate parameters from historical returns
-    mean_return = returns.mean()
-    std_return = returns.std()
-    
-    # Run simulations
-    last_price = 1.0  # Normalized starting point
-    simulations = np.zeros((days_forward, num_simulations))
-    
-    for i in range(num_simulations):
-        daily_returns = np.random.normal(mean_return, std_return, days_forward)
-        price_path = last_price * (1 + daily_returns).cumprod()
-        simulations[:, i] = price_path
-    
-    return simulations
+    columns = ['Sale Date', 'Sold', 'Loss', 'Sold Lot', 'Buy Date', 'Bought', 'Buy Shares',
+               'Matched Shares', 'Days Apart', 'Match', 'Disallowed Loss']
+    realized = ledger['realized']
+    losses = realized[realized['Gain/Loss'] < 0]
+    buys = ledger['purchases'].copy()
+    if losses.empty or buys.empty:
+        return pd.DataFrame(columns=columns)
+    
+    if 'Account' not in losses.columns:
+        losses = losses.assign(Account='')
+        realized = realized.assign(Account='')
+        buys['Account'] = ''
+    buys_by_ticker = {key: group for key, group in buys.groupby(['Account', 'Ticker'])}
+    window = pd.Timedelta(days=window_days)
+    conflicts = []
+    
+    for (account, ticker), sales in losses.groupby(['Account', 'Ticker']):
+        sales = sales.sort_values('Sale Date')
+        windows = pd.IntervalIndex.from_arrays(sales['Sale Date'] - window, sales['Sale Date'] + window, closed='both')
+        related = [(ticker, 'Same ticker')]
+        if include_partners:
+            related += [(partner, 'Swap partner') for partner in sorted(get_wash_sale_partners(ticker))]
+        
+        for bought, match in related:
+            if (account, bought) not in buys_by_ticker:
+                continue
+            purchases = buys_by_ticker[(account, bought)]
+            dates = purchases['Date'].values
+            first = np.searchsorted(windows.right.values, dates, side='left')
+            last = np.searchsorted(windows.left.values, dates, side='right')
+            counts = np.maximum(last - first, 0)
+            if counts.sum() == 0:
+                continue
+            
+            buy_rows = np.repeat(np.arange(len(purchases)), counts)
+            sale_rows = np.concatenate([np.arange(a, b) for a, b in zip(first, last) if b > a])
+            sale = sales.iloc[sale_rows]
+            purchase = purchases.iloc[buy_rows]
+            
+            conflicts.append(pd.DataFrame({
+                'sale_row': sale.index.values,
+                'buy_row': purchase.index.values,
+                'Account': account,
+                'Sale Date': sale['Sale Date'].values,
+                'Sold': ticker,
+                'Loss': sale['Gain/Loss'].values,
+                'Sold Lot': sale['Lot ID'].values,
+                'Buy Date': purchase['Date'].values,
+                'Bought': bought,
+                'Bought Lot': purchase['Lot ID'].values,
+                'Buy Shares': purchase['Shares'].values,
+                'Days Apart': ((purchase['Date'].values - sale['Sale Date'].values)
+                               / np.timedelta64(1, 'D')).astype(int),
+                'Match': match
+            }))
+    
+    if not conflicts:
+        return pd.DataFrame(columns=columns)
+    conflicts = pd.concat(conflicts, ignore_index=True).sort_values(['Sale Date', 'Buy Date'], kind='stable')
+    conflicts = conflicts.reset_index(drop=True)
+    
+    # Shares of each purchased lot already sold by the sale date, inclusive
+    sold = realized.groupby(['Account', 'Lot ID', 'Sale Date'])['Shares'].sum().groupby(level=[0, 1]).cumsum()
+    sold = sold.rename('Sold Through').reset_index().rename(columns={'Lot ID': 'Bought Lot'})
+    conflicts = pd.merge_asof(conflicts.reset_index().sort_values('Sale Date'), sold.sort_values('Sale Date'),
+                              on='Sale Date', by=['Account', 'Bought Lot'])
+    conflicts = conflicts.sort_values('index').set_index('index')
+    conflicts['Sold Through'] = conflicts['Sold Through'].fillna(0.0)
+    
+    # Allocate replacement shares once, earliest sale and purchase first
+    sale_left = dict(zip(losses.index, losses['Shares']))
+    buy_used = dict.fromkeys(buys.index, 0.0)
+    matched = []
+    rows = zip(conflicts['sale_row'].tolist(), conflicts['buy_row'].tolist(),
+               conflicts['Buy Shares'].tolist(), conflicts['Sold Through'].tolist())
+    for sale, buy, bought_shares, sold_through in rows:
+        quantity = max(0.0, min(sale_left[sale], bought_shares - sold_through - buy_used[buy]))
+        sale_left[sale] -= quantity
+        buy_used[buy] += quantity
+        matched.append(quantity)
+    
+    conflicts['Matched Shares'] = matched
+    conflicts['Disallowed Loss'] = conflicts['Loss'] * conflicts['Matched Shares'] / losses.loc[conflicts['sale_row'], 'Shares'].values
+    conflicts = conflicts[conflicts['Matched Shares'] > 1e-12]
+    return conflicts[columns].reset_index(drop=True)
+
+
+# Federal rates used to value a harvested loss by holding period
+HARVEST_TAX_RATES = {'Short': 0.37, 'Long': 0.20}
+
+
+def get_latest_prices(tickers, as_of=None):
+    """
+    Last close for many tickers from one batched (cached) download
 
+    `as_of` is an exclusive end date; by default the latest close through today.
+    """
+    end_date = pd.Timestamp(as_of) if as_of is not None else pd.Timestamp.now().normalize() + pd.Timedelta(days=1)
+    data = download_ticker_data(list(tickers), end_date - timedelta(days=10), end_date)
+    if data is None or data.empty:
+        return pd.Series(dtype=float)
+    return data.ffill().iloc[-1].dropna()
 
-def calculate_forward_risk_metrics(returns, confidence_level=0.95):
+
+def scan_tax_loss_harvesting(lots, prices, as_of=None, tax_rates=None, min_loss=100.0,
+                             window_days=WASH_SALE_WINDOW_DAYS, include_partners=True):
     """
-    Calculate forward-looking risk metrics
+    Rank tax-loss harvesting candidates across every lot of every account
+    
+    Unrealized gain/loss, holding period and tax value are computed for all
+    lots at once against one price per ticker. Losing lots are grouped into
+    one candidate per account and ticker, valued at the short- or long-term
+    rate of each lot, paired with a replacement ETF from TAX_LOSS_SWAP_MAP
+    and flagged when shares of the same ticker that would not be sold, or
+    any shares of a swap partner (get_wash_sale_partners), were bought inside
+    the wash-sale window. A replacement bought inside the window is not
+    suggested.
+    
+    Parameters:
+    - lots: open lots from build_tax_lots (Account column optional)
+    - prices: latest price per ticker (Series), or a price DataFrame whose
+      last row is used
+    - as_of: valuation date (default: last price date or today)
+    - tax_rates: dict with 'Short' and 'Long' rates (default HARVEST_TAX_RATES)
+    - min_loss: smallest position loss worth harvesting ($)
+    - include_partners: also treat recent buys of swap partners as wash-sale risk
+    
+    Returns: DataFrame with one row per candidate, best tax savings first
     """
-    # Ensure returns is a Series
-    if isinstance(returns, pd.DataFrame):
-        returns = returns.iloc[:, 0]
-    
-    # Expected return and volatility
-    expected_return = returns.mean() * 252
-    expected_vol = returns.std() * np.sqrt(252)
-    
-    # Value at Risk (VaR)
-    var_95 = returns.quantile(1 - 0.95)
-    var_99 = returns.quantile(1 - 0.99)
-    
-    # Conditional VaR (CVaR / Expected Shortfall)
-    cvar_95 = returns[returns <= var_95].mean()
-    cvar_99 = returns[returns <= var_99].mean()
-    
-    # Probability of daily loss
-    prob_loss = (returns < 0).sum() / len(returns)
-    
-    # Estimated maximum drawdown (based on historical)
-    cum_returns = (1 + returns).cumprod()
-    running_max = cum_returns.expanding().max()
-    drawdowns = (cum_returns - running_max) / running_max
-    estimated_max_dd = drawdowns.min()
-    
-    return {
-        'Expected Annual Return': expected_return,
-        'Expected Volatility': expected_vol,
-        'VaR (95%)': var_95,
-        'VaR (99%)': var_99,
-        'CVaR (95%)': cvar_95,
-        'CVaR (99%)': cvar_99,
-        'Probability of Daily Loss': prob_loss,
-        'Estimated Max Drawdown': estimated_max_dd
-    }
+    tax_rates = tax_rates or HARVEST_TAX_RATES
+    if isinstance(prices, pd.DataFrame):
+        if as_of is None:
+            as_of = prices.index[-1]
+        prices = prices.ffill().iloc[-1]
+    as_of = pd.Timestamp(as_of) if as_of is not None else pd.Timestamp(datetime.now()).normalize()
+    
+    lots = lots.copy()
+    if 'Account' not in lots.columns:
+        lots.insert(0, 'Account', '')
+    recent = pd.to_datetime(lots['Acquired']) > as_of - pd.Timedelta(days=window_days)
+    recent_buys = lots[recent].groupby(['Account', 'Ticker'])['Acquired'].max()
+    
+    lots['Price'] = lots['Ticker'].map(prices).astype(float)
+    lots = lots[lots['Price'].notna()]
+    lots['Market Value'] = lots['Shares'] * lots['Price']
+    lots['Unrealized'] = lots['Market Value'] - lots['Cost Basis']
+    long_term = as_of > pd.to_datetime(lots['Acquired']) + pd.DateOffset(years=1)
+    lots['Short Loss'] = np.where(~long_term, np.minimum(lots['Unrealized'], 0.0), 0.0)
+    lots['Long Loss'] = np.where(long_term, np.minimum(lots['Unrealized'], 0.0), 0.0)
+    
+    # Shares bought inside the window that stay in the account void the loss
+    losing = lots['Unrealized'] < 0
+    lots['Kept Recent Buy'] = lots['Acquired'].where(~losing & recent.reindex(lots.index))
+    
+    loss_lots = lots[losing]
+    candidates = loss_lots.groupby(['Account', 'Ticker']).agg(**{
+        'Lots': ('Lot ID', 'count'),
+        'Shares': ('Shares', 'sum'),
+        'Price': ('Price', 'first'),
+        'Cost Basis': ('Cost Basis', 'sum'),
+        'Market Value': ('Market Value', 'sum'),
+        'Short Loss': ('Short Loss', 'sum'),
+        'Long Loss': ('Long Loss', 'sum')
+    })
+    candidates['Loss'] = candidates['Short Loss'] + candidates['Long Loss']
+    candidates = candidates[candidates['Loss'] <= -abs(min_loss)]
+    
+    columns = ['Rank', 'Account', 'Ticker', 'Lots', 'Shares', 'Price', 'Cost Basis', 'Market Value',
+               'Loss', 'Short Loss', 'Long Loss', 'Tax Savings', 'Replacement', 'Replacement Name',
+               'Wash Sale Risk', 'Harvest After']
+    if candidates.empty:
+        return pd.DataFrame(columns=columns)
+    
+    candidates['Tax Savings'] = -(candidates['Short Loss'] * tax_rates['Short'] +
+                                  candidates['Long Loss'] * tax_rates['Long'])
+    last_recent_buy = lots.groupby(['Account', 'Ticker'])['Kept Recent Buy'].max().reindex(candidates.index)
+    if include_partners:
+        # Latest recent buy of any swap partner in the same account
+        partner_pairs = pd.DataFrame([(account, ticker, partner) for account, ticker in candidates.index
+                                      for partner in get_wash_sale_partners(ticker)],
+                                     columns=['Account', 'Ticker', 'Partner'])
+        partner_pairs['Bought'] = recent_buys.reindex(
+            pd.MultiIndex.from_frame(partner_pairs[['Account', 'Partner']])).values
+        partner_buy = partner_pairs.groupby(['Account', 'Ticker'])['Bought'].max().reindex(candidates.index)
+        last_recent_buy = pd.concat([last_recent_buy, partner_buy], axis=1).max(axis=1)
+    candidates['Wash Sale Risk'] = last_recent_buy.notna()
+    candidates['Harvest After'] = last_recent_buy + pd.Timedelta(days=window_days + 1)
+    
+    candidates = candidates.reset_index()
+    swaps = candidates['Ticker'].map(TAX_LOSS_SWAP_MAP)
+    candidates['Replacement'] = swaps.map(lambda swap: swap['swap_to'] if isinstance(swap, dict) else None)
+    candidates['Replacement Name'] = swaps.map(lambda swap: swap['name'] if isinstance(swap, dict) else None)
+    # Buying back a fund already bought inside the window is no clean replacement
+    recently_bought = pd.MultiIndex.from_frame(candidates[['Account', 'Replacement']]).isin(recent_buys.index)
+    candidates.loc[recently_bought, ['Replacement', 'Replacement Name']] = None
+    
+    # Actionable candidates first, then by tax savings
+    candidates = candidates.sort_values(['Wash Sale Risk', 'Tax Savings'], ascending=[True, False],
+                                        kind='stable').reset_index(drop=True)
+    candidates['Rank'] = np.arange(1, len(candidates) + 1)
+    return candidates[columns]
 
 
 # =============================================================================
@@ -1463,9 +4372,7 @@ def plot_drawdown(returns, title='Drawdown Over Time'):
     if isinstance(returns, pd.DataFrame):
         returns = returns.iloc[:, 0]
     
-    cum_returns = (1 + returns).cumprod()
-    running_max = cum_returns.expanding().max()
-    drawdown = (cum_returns - running_max) / running_max
+    drawdown = get_return_statistics(returns)['Drawdown']
     
     ax.fill_between(drawdown.index, 0, drawdown.values, 
                     color='#dc3545', alpha=0.3, label='Drawdown')
@@ -1492,8 +4399,8 @@ def plot_monthly_returns_heatmap(returns, title='Monthly Returns Heatmap'):
     if isinstance(returns, pd.DataFrame):
         returns = returns.iloc[:, 0]
     
-    # Calculate monthly returns
-    monthly_returns = returns.resample('M').apply(lambda x: (1 + x).prod() - 1)
+    # Monthly returns from the shared calendar aggregation
+    monthly_returns = get_calendar_returns(returns)['M']
     
     # Convert to DataFrame with explicit column name
     monthly_returns_df = pd.DataFrame({'returns': monthly_returns})
@@ -1521,22 +4428,49 @@ def plot_monthly_returns_heatmap(returns, title='Monthly Returns Heatmap'):
     return fig
 
 
-def plot_rolling_metrics(returns, window=60, title='Rolling Metrics'):
+def plot_annual_returns(returns, title='Annual Returns'):
     """
-    Plot rolling Sharpe and Sortino ratios with enhanced styling
+    Plot calendar-year returns as bars, green for gains and red for losses
     """
-    # Ensure returns is a Series
     if isinstance(returns, pd.DataFrame):
         returns = returns.iloc[:, 0]
     
-    rolling_return = returns.rolling(window).mean() * 252
-    rolling_vol = returns.rolling(window).std() * np.sqrt(252)
-    rolling_sharpe = rolling_return / rolling_vol
+    annual_returns = get_calendar_returns(returns)['Y']
+    
+    fig, ax = plt.subplots(figsize=(12, 5))
+    colors = ['#28a745' if r >= 0 else '#dc3545' for r in annual_returns.values]
+    bars = ax.bar(annual_returns.index.year.astype(str), annual_returns.values * 100,
+                  color=colors, alpha=0.8, edgecolor='white', linewidth=1.5)
+    
+    for bar, value in zip(bars, annual_returns.values):
+        ax.text(bar.get_x() + bar.get_width() / 2, bar.get_height(),
+                f'{value:+.1%}', ha='center',
+                va='bottom' if value >= 0 else 'top', fontsize=10, fontweight='bold')
+    
+    ax.axhline(y=0, color='black', linewidth=1)
+    ax.set_title(title, fontsize=16, fontweight='bold', pad=20)
+    ax.set_xlabel('Year', fontsize=12, fontweight='bold')
+    ax.set_ylabel('Return (%)', fontsize=12, fontweight='bold')
+    ax.grid(True, alpha=0.3, linestyle='--', axis='y')
+    ax.set_facecolor('#f8f9fa')
+    fig.patch.set_facecolor('white')
+    
+    plt.tight_layout()
+    return fig
+
+
+def plot_rolling_metrics(returns, window=60, title='Rolling Metrics', rolling=None):
+    """
+    Plot rolling Sharpe and Sortino ratios with enhanced styling
+
+    `rolling` is an optional precomputed result from get_rolling_statistics
+    that includes `window`; otherwise the window is computed on the fly.
+    """
+    if rolling is None or window not in rolling:
+        rolling = get_rolling_statistics(returns, (window,))
     
-    downside_returns = returns.copy()
-    downside_returns[downside_returns > 0] = 0
-    rolling_downside_vol = downside_returns.rolling(window).std() * np.sqrt(252)
-    rolling_sortino = rolling_return / rolling_downside_vol
+    rolling_sharpe = rolling[window]['Rolling Sharpe'].iloc[:, 0]
+    rolling_sortino = rolling[window]['Rolling Sortino'].iloc[:, 0]
     
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10))
     
@@ -1666,14 +4600,32 @@ def plot_monte_carlo_simulation(simulations, title='Monte Carlo Simulation - 1 Y
     return fig
 
 
-def plot_efficient_frontier(results, optimal_weights, portfolio_return, portfolio_std):
+def plot_efficient_frontier(results, optimal_weights, portfolio_return, portfolio_std, frontier=None):
     """
     Plot efficient frontier with enhanced styling
+
+    If `frontier` (from calculate_exact_efficient_frontier) is given, the exact
+    frontier curve and its minimum-variance and tangency portfolios are drawn
+    over the random-portfolio cloud.
     """
     fig, ax = plt.subplots(figsize=(12, 8))
     
+    # Large clouds are drawn as small rasterized points to keep rendering fast
+    dense = results.shape[1] > 5000
     scatter = ax.scatter(results[1,:], results[0,:], c=results[2,:], 
-                        cmap='viridis', marker='o', s=50, alpha=0.6)
+                        cmap='viridis', marker='o', s=2 if dense else 50,
+                        alpha=0.3 if dense else 0.6, linewidths=0, rasterized=dense)
+
+    if frontier is not None:
+        ax.plot(frontier['volatilities'], frontier['returns'], color='#2c3e50',
+                linewidth=2.5, label='Efficient Frontier')
+        ax.scatter(frontier['min_variance']['volatility'], frontier['min_variance']['return'],
+                  marker='D', color='#3498db', s=200, label='Minimum Variance',
+                  edgecolors='black', linewidths=1.5, zorder=5)
+        ax.scatter(frontier['tangency']['volatility'], frontier['tangency']['return'],
+                  marker='P', color='#f39c12', s=300, label='Tangency (Max Sharpe)',
+                  edgecolors='black', linewidths=1.5, zorder=5)
+
     ax.scatter(portfolio_std, portfolio_return, marker='*', color='red', 
               s=500, label='Current Portfolio', edgecolors='black', linewidths=2)
     
@@ -1907,6 +4859,67 @@ if st.session_state.portfolios:
         st.sidebar.success("Portfolio deleted!")
         st.rerun()
     
+    # Append new closes without reprocessing the full history
+    if st.sidebar.button("🔄 Update to Latest Close"):
+        portfolio = st.session_state.portfolios[selected_portfolio]
+        columns = portfolio['prices'].columns
+        last_date = portfolio['prices'].index[-1]
+        # Date-level end (exclusive) so repeated clicks on one day share a cache entry
+        update_end = pd.Timestamp.now().normalize() + pd.Timedelta(days=1)
+        latest_prices = download_ticker_data(portfolio['tickers'], last_date, update_end)
+        
+        if latest_prices is not None and not latest_prices.empty:
+            latest_prices = latest_prices[columns].dropna()
+            new_rows = latest_prices[latest_prices.index > last_date]
+        else:
+            new_rows = pd.DataFrame()
+        
+        if new_rows.empty:
+            st.sidebar.info("Already up to date - no new closes available.")
+        else:
+            weights_array = np.array([portfolio['weights'][ticker] for ticker in columns])
+            
+            if last_date in latest_prices.index:
+                # A dividend since the last download rescales all earlier adjusted closes; apply the
+                # same factor to the stored history so it joins the new closes seamlessly
+                portfolio['prices'] = portfolio['prices'] * (latest_prices.loc[last_date] / portfolio['prices'].iloc[-1])
+                new_returns = calculate_portfolio_returns(
+                    pd.concat([portfolio['prices'].iloc[[-1]], new_rows]), weights_array
+                )
+                state = portfolio.get('incremental_metrics') or create_incremental_metrics(portfolio['returns'])
+                portfolio['incremental_metrics'] = update_incremental_metrics(state, new_returns)
+                portfolio['prices'] = pd.concat([portfolio['prices'], new_rows])
+                portfolio['returns'] = pd.concat([portfolio['returns'], new_returns])
+            else:
+                # No overlapping close to rescale against: reload the full range
+                full_prices = download_ticker_data(portfolio['tickers'], portfolio['start_date'], update_end)
+                if full_prices is not None and not full_prices.empty:
+                    portfolio['prices'] = full_prices[columns].dropna()
+                    portfolio['returns'] = calculate_portfolio_returns(portfolio['prices'], weights_array)
+                    portfolio.pop('incremental_metrics', None)
+            portfolio['end_date'] = portfolio['prices'].index[-1].to_pydatetime()
+            
+            st.sidebar.success(f"✅ Added {len(new_rows)} new day(s) through {portfolio['end_date'].strftime('%Y-%m-%d')}")
+    
+    # Risk model shared by the optimization, frontier and correlation views
+    st.sidebar.markdown("---")
+    st.sidebar.markdown("### 🧮 Risk Model")
+    
+    covariance_estimator = st.sidebar.selectbox(
+        "Covariance Estimator",
+        list(MOMENT_ESTIMATORS.keys()),
+        format_func=lambda e: MOMENT_ESTIMATORS[e],
+        help="Shrinkage estimators stabilize the covariance matrix for many assets or short histories; "
+             "EWMA emphasizes recent market behavior"
+    )
+    
+    estimation_windows = {"Full History": None, "Last 1 Year": 252, "Last 3 Years": 756, "Last 5 Years": 1260}
+    estimation_window = estimation_windows[st.sidebar.selectbox(
+        "Estimation Window",
+        list(estimation_windows.keys()),
+        help="Period of daily returns used to estimate expected returns and covariance"
+    )]
+    
     # Export/Import
     st.sidebar.markdown("---")
     st.sidebar.markdown("### 💾 Export/Import")
@@ -1972,8 +4985,14 @@ prices = current['prices']
 weights = current['weights']
 tickers = current['tickers']
 
-# Calculate metrics for current portfolio
-metrics = calculate_portfolio_metrics(portfolio_returns)
+# Shared return moments for optimization, frontier and correlation views
+moments = estimate_moments(prices, window=estimation_window, estimator=covariance_estimator)
+
+# Calculate metrics for current portfolio - reuse the incremental state when it covers the full history
+if 'incremental_metrics' in current and current['incremental_metrics']['count'] == len(portfolio_returns.dropna()):
+    metrics = incremental_metrics_summary(current['incremental_metrics'])
+else:
+    metrics = calculate_portfolio_metrics(portfolio_returns)
 
 # =============================================================================
 # TABS STRUCTURE - 7 TABS
@@ -2104,6 +5123,60 @@ with tab1:
         ax.set_title('Portfolio Allocation', fontsize=14, fontweight='bold', pad=20)
         st.pyplot(fig)
     
+    # What-if allocation: reprice from the in-memory price history
+    overview_returns = portfolio_returns
+    overview_metrics = metrics
+    
+    with st.expander("🎚️ What-If Allocation - try different weights instantly"):
+        st.caption("Adjust weights to see every metric below update live. Uses the prices already loaded - "
+                   "no re-download. Weights are scaled to sum to 100%.")
+        
+        whatif_cols = st.columns(min(4, len(weights)))
+        whatif_raw = {}
+        whatif_defaults = {ticker: float(round(weights.get(ticker, 0.0) * 100, 1)) for ticker in prices.columns}
+        for i, ticker in enumerate(prices.columns):
+            with whatif_cols[i % len(whatif_cols)]:
+                whatif_raw[ticker] = st.slider(
+                    ticker,
+                    min_value=0.0,
+                    max_value=100.0,
+                    value=whatif_defaults[ticker],
+                    step=0.5,
+                    format="%.1f%%",
+                    key=f"whatif_{st.session_state.current_portfolio}_{ticker}"
+                )
+        
+        whatif_total = sum(whatif_raw.values())
+        if whatif_total <= 0:
+            st.warning("⚠️ Set at least one weight above 0%")
+        else:
+            whatif_weights = {ticker: w / whatif_total for ticker, w in whatif_raw.items()}
+            
+            # Compare with the slider defaults: saved weights are rounded to 0.1% on the sliders
+            if any(abs(whatif_raw[t] - whatif_defaults[t]) > 1e-9 for t in whatif_raw):
+                whatif = reprice_portfolio(get_asset_returns(prices), whatif_weights)
+                overview_returns = whatif['returns']
+                overview_metrics = whatif['metrics']
+                
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Annual Return", f"{overview_metrics['Annual Return']:.2%}",
+                              f"{overview_metrics['Annual Return'] - metrics['Annual Return']:+.2%}")
+                with col2:
+                    st.metric("Sharpe Ratio", f"{overview_metrics['Sharpe Ratio']:.2f}",
+                              f"{overview_metrics['Sharpe Ratio'] - metrics['Sharpe Ratio']:+.2f}")
+                with col3:
+                    st.metric("Max Drawdown", f"{overview_metrics['Max Drawdown']:.2%}",
+                              f"{overview_metrics['Max Drawdown'] - metrics['Max Drawdown']:+.2%}")
+                
+                st.info("📊 Showing **what-if** metrics and charts below. Reset the sliders to return to the saved allocation.")
+                
+                if st.button("✅ Apply What-If Weights", key="apply_whatif"):
+                    current['weights'] = whatif_weights
+                    current['returns'] = overview_returns
+                    current.pop('incremental_metrics', None)
+                    st.success("✅ What-if weights applied to this portfolio.")
+    
     # Key Metrics
     st.markdown("---")
     st.markdown("### 🎯 Key Performance Metrics vs S&P 500")
@@ -2147,56 +5220,56 @@ with tab1:
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        metric_class = get_metric_color_class('annual_return', metrics['Annual Return'])
-        arrow, color = get_comparison_indicator(metrics['Annual Return'], 
+        metric_class = get_metric_color_class('annual_return', overview_metrics['Annual Return'])
+        arrow, color = get_comparison_indicator(overview_metrics['Annual Return'], 
                                                spy_metrics['Annual Return'] if spy_metrics else 0, 
                                                'higher_better')
         st.markdown(f"""
             <div class="{metric_class}">
                 <h4>Annual Return {arrow}</h4>
-                <h2>{metrics['Annual Return']:.2%}</h2>
+                <h2>{overview_metrics['Annual Return']:.2%}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Annual Return']:.2%}</p>
             </div>
         """, unsafe_allow_html=True)
         render_metric_explanation('annual_return')
     
     with col2:
-        metric_class = get_metric_color_class('sharpe_ratio', metrics['Sharpe Ratio'])
-        arrow, color = get_comparison_indicator(metrics['Sharpe Ratio'], 
+        metric_class = get_metric_color_class('sharpe_ratio', overview_metrics['Sharpe Ratio'])
+        arrow, color = get_comparison_indicator(overview_metrics['Sharpe Ratio'], 
                                                spy_metrics['Sharpe Ratio'] if spy_metrics else 0, 
                                                'higher_better')
         st.markdown(f"""
             <div class="{metric_class}">
                 <h4>Sharpe Ratio {arrow}</h4>
-                <h2>{metrics['Sharpe Ratio']:.2f}</h2>
+                <h2>{overview_metrics['Sharpe Ratio']:.2f}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Sharpe Ratio']:.2f}</p>
             </div>
         """, unsafe_allow_html=True)
         render_metric_explanation('sharpe_ratio')
     
     with col3:
-        metric_class = get_metric_color_class('max_drawdown', metrics['Max Drawdown'])
-        arrow, color = get_comparison_indicator(metrics['Max Drawdown'], 
+        metric_class = get_metric_color_class('max_drawdown', overview_metrics['Max Drawdown'])
+        arrow, color = get_comparison_indicator(overview_metrics['Max Drawdown'], 
                                                spy_metrics['Max Drawdown'] if spy_metrics else 0, 
                                                'lower_better')
         st.markdown(f"""
             <div class="{metric_class}">
                 <h4>Max Drawdown {arrow}</h4>
-                <h2>{metrics['Max Drawdown']:.2%}</h2>
+                <h2>{overview_metrics['Max Drawdown']:.2%}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Max Drawdown']:.2%}</p>
             </div>
         """, unsafe_allow_html=True)
         render_metric_explanation('max_drawdown')
     
     with col4:
-        metric_class = get_metric_color_class('volatility', metrics['Annual Volatility'])
-        arrow, color = get_comparison_indicator(metrics['Annual Volatility'], 
+        metric_class = get_metric_color_class('volatility', overview_metrics['Annual Volatility'])
+        arrow, color = get_comparison_indicator(overview_metrics['Annual Volatility'], 
                                                spy_metrics['Annual Volatility'] if spy_metrics else 0, 
                                                'lower_better')
         st.markdown(f"""
             <div class="{metric_class}">
                 <h4>Volatility {arrow}</h4>
-                <h2>{metrics['Annual Volatility']:.2%}</h2>
+                <h2>{overview_metrics['Annual Volatility']:.2%}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Annual Volatility']:.2%}</p>
             </div>
         """, unsafe_allow_html=True)
@@ -2219,55 +5292,55 @@ with tab1:
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        metric_class = get_metric_color_class('sortino_ratio', metrics['Sortino Ratio'])
-        arrow, color = get_comparison_indicator(metrics['Sortino Ratio'], 
+        metric_class = get_metric_color_class('sortino_ratio', overview_metrics['Sortino Ratio'])
+        arrow, color = get_comparison_indicator(overview_metrics['Sortino Ratio'], 
                                                spy_metrics['Sortino Ratio'] if spy_metrics else 0, 
                                                'higher_better')
         st.markdown(f"""
             <div class="{metric_class}">
                 <h4>Sortino Ratio {arrow}</h4>
-                <h2>{metrics['Sortino Ratio']:.2f}</h2>
+                <h2>{overview_metrics['Sortino Ratio']:.2f}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Sortino Ratio']:.2f}</p>
             </div>
         """, unsafe_allow_html=True)
         render_metric_explanation('sortino_ratio')
     
     with col2:
-        metric_class = get_metric_color_class('calmar_ratio', metrics['Calmar Ratio'])
-        arrow, color = get_comparison_indicator(metrics['Calmar Ratio'], 
+        metric_class = get_metric_color_class('calmar_ratio', overview_metrics['Calmar Ratio'])
+        arrow, color = get_comparison_indicator(overview_metrics['Calmar Ratio'], 
                                                spy_metrics['Calmar Ratio'] if spy_metrics else 0, 
                                                'higher_better')
         st.markdown(f"""
             <div class="{metric_class}">
                 <h4>Calmar Ratio {arrow}</h4>
-                <h2>{metrics['Calmar Ratio']:.2f}</h2>
+                <h2>{overview_metrics['Calmar Ratio']:.2f}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Calmar Ratio']:.2f}</p>
             </div>
         """, unsafe_allow_html=True)
         render_metric_explanation('calmar_ratio')
     
     with col3:
-        metric_class = get_metric_color_class('win_rate', metrics['Win Rate'])
-        arrow, color = get_comparison_indicator(metrics['Win Rate'], 
+        metric_class = get_metric_color_class('win_rate', overview_metrics['Win Rate'])
+        arrow, color = get_comparison_indicator(overview_metrics['Win Rate'], 
                                                spy_metrics['Win Rate'] if spy_metrics else 0, 
                                                'higher_better')
         st.markdown(f"""
             <div class="{metric_class}">
                 <h4>Win Rate {arrow}</h4>
-                <h2>{metrics['Win Rate']:.2%}</h2>
+                <h2>{overview_metrics['Win Rate']:.2%}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Win Rate']:.2%}</p>
             </div>
         """, unsafe_allow_html=True)
         render_metric_explanation('win_rate')
     
     with col4:
-        arrow, color = get_comparison_indicator(metrics['Total Return'], 
+        arrow, color = get_comparison_indicator(overview_metrics['Total Return'], 
                                                spy_metrics['Total Return'] if spy_metrics else 0, 
                                                'higher_better')
         st.markdown(f"""
             <div class="metric-card">
                 <h4>Total Return {arrow}</h4>
-                <h2>{metrics['Total Return']:.2%}</h2>
+                <h2>{overview_metrics['Total Return']:.2%}</h2>
                 <p style="font-size: 0.9em; color: #888;">SPY: {spy_metrics['Total Return']:.2%}</p>
             </div>
         """, unsafe_allow_html=True)
@@ -2275,7 +5348,7 @@ with tab1:
     # Performance Chart
     st.markdown("---")
     st.markdown("### 📈 Performance Over Time")
-    fig = plot_cumulative_returns(portfolio_returns, f'{st.session_state.current_portfolio} - Cumulative Returns')
+    fig = plot_cumulative_returns(overview_returns, f'{st.session_state.current_portfolio} - Cumulative Returns')
     st.pyplot(fig)
     
     # Chart interpretation
@@ -2294,9 +5367,20 @@ with tab1:
     # Drawdown Chart
     st.markdown("---")
     st.markdown("### 📉 Drawdown Analysis")
-    fig = plot_drawdown(portfolio_returns, 'Portfolio Drawdown')
+    fig = plot_drawdown(overview_returns, 'Portfolio Drawdown')
     st.pyplot(fig)
     
+    drawdown_episodes = get_return_statistics(overview_returns)['Drawdown Episodes']
+    if not drawdown_episodes.empty:
+        latest_episode = drawdown_episodes.iloc[-1]
+        if latest_episode['Open']:
+            st.warning(f"⏳ **Currently in drawdown:** {latest_episode['Depth']:.2%} at the trough, "
+                       f"{latest_episode['Duration (Days)']} days since the peak on "
+                       f"{latest_episode['Peak Date'].strftime('%Y-%m-%d')}")
+        
+        st.markdown("#### 🕳️ Worst Drawdown Episodes")
+        st.dataframe(format_drawdown_episodes(drawdown_episodes), use_container_width=True, hide_index=True)
+    
     # Drawdown interpretation
     st.markdown("""
         <div class="interpretation-box">
@@ -2322,6 +5406,10 @@ with tab2:
     fig = plot_monthly_returns_heatmap(portfolio_returns, 'Monthly Returns (%)')
     st.pyplot(fig)
     
+    st.markdown("### 📆 Annual Returns")
+    fig = plot_annual_returns(portfolio_returns, 'Calendar Year Returns')
+    st.pyplot(fig)
+    
     # Heatmap interpretation
     st.markdown("""
         <div class="interpretation-box">
@@ -2364,45 +5452,12 @@ with tab2:
     
     # Calculate monthly dollar gains with dividend breakdown
     returns_series = portfolio_returns if isinstance(portfolio_returns, pd.Series) else portfolio_returns.iloc[:, 0]
-    monthly_returns = returns_series.resample('M').apply(lambda x: (1 + x).prod() - 1)
+    monthly_returns = get_calendar_returns(returns_series)['M']
     
     # Estimate dividend component (approximate - based on typical dividend yields)
     # For more accuracy, would need separate dividend data
-    # Rough estimate: ~2% annual dividend yield for typical stock portfolio
-    # Distributed across months based on return
-    monthly_data = []
-    cumulative_value = initial_capital
-    annual_dividend_yield = 0.018  # Approximate 1.8% annual yield for diversified portfolio
-    monthly_dividend_rate = annual_dividend_yield / 12
-    
-    for date, monthly_return in monthly_returns.items():
-        month_start_value = cumulative_value
-        
-        # Estimate dividend portion (rough approximation)
-        # Dividends are roughly consistent, capital gains vary
-        estimated_dividend = month_start_value * monthly_dividend_rate
-        
-        # Total dollar gain
-        total_dollar_gain = month_start_value * monthly_return
-        
-        # Capital gain = Total gain - Dividends
-        capital_gain = total_dollar_gain - estimated_dividend
-        
-        # Update cumulative value
-        cumulative_value = month_start_value + total_dollar_gain
-        
-        monthly_data.append({
-            'Date': date.strftime('%Y-%m'),
-            'Month': date.strftime('%B'),
-            'Year': date.year,
-            'Return %': monthly_return * 100,
-            'Total Gain/Loss': total_dollar_gain,
-            'Capital Gain/Loss': capital_gain,
-            'Dividend Income': estimated_dividend,
-            'Portfolio Value': cumulative_value
-        })
-    
-    monthly_df = pd.DataFrame(monthly_data)
+    # Approximate 1.8% annual yield for diversified portfolio, accrued on each month's opening value
+    monthly_df = calculate_monthly_dollar_gains(monthly_returns, initial_capital, annual_dividend_yield=0.018)
     
     # Add note about dividend estimation
     st.info("""
@@ -2554,7 +5609,10 @@ with tab2:
     st.markdown("---")
     st.markdown("### 📈 Rolling Risk-Adjusted Performance")
     window = st.slider("Rolling Window (days)", min_value=20, max_value=252, value=60, step=10)
-    fig = plot_rolling_metrics(portfolio_returns, window=window)
+    
+    # Every slider position is precomputed in one cached pass, so moving it is a lookup
+    portfolio_rolling = get_rolling_statistics(portfolio_returns, tuple(range(20, 253, 10)))
+    fig = plot_rolling_metrics(portfolio_returns, window=window, rolling=portfolio_rolling)
     st.pyplot(fig)
     
     # Rolling metrics interpretation
@@ -2582,6 +5640,37 @@ with tab2:
         </div>
     """, unsafe_allow_html=True)
     
+    # Drawdown episodes for every holding in one pass
+    st.markdown("---")
+    st.markdown("### 🕳️ Drawdown Episodes by Holding")
+    
+    holding_episodes = calculate_drawdown_episodes(prices.pct_change().dropna())
+    portfolio_episodes = get_return_statistics(portfolio_returns)['Drawdown Episodes'].assign(Series='Portfolio')
+    all_episodes = pd.concat([portfolio_episodes, holding_episodes])
+    
+    if not all_episodes.empty:
+        episode_summary = all_episodes.groupby('Series', sort=False).agg(
+            Episodes=('Depth', 'size'),
+            Worst=('Depth', 'min'),
+            Longest=('Duration (Days)', 'max'),
+            AvgRecover=('Days to Recover', 'mean'),
+            Underwater=('Open', 'last')
+        )
+        st.dataframe(pd.DataFrame({
+            'Series': episode_summary.index,
+            'Episodes': episode_summary['Episodes'].values,
+            'Worst Depth': episode_summary['Worst'].map('{:.2%}'.format).values,
+            'Longest (Days)': episode_summary['Longest'].values,
+            'Avg Days to Recover': episode_summary['AvgRecover'].map(lambda d: f"{d:.0f}" if pd.notna(d) else '-').values,
+            'Currently Underwater': episode_summary['Underwater'].map({True: '⏳ Yes', False: '✅ No'}).values
+        }), use_container_width=True, hide_index=True)
+        
+        with st.expander("📋 All Drawdown Episodes"):
+            selected_series = st.selectbox("Series", list(episode_summary.index), key='drawdown_episode_series')
+            st.dataframe(format_drawdown_episodes(all_episodes[all_episodes['Series'] == selected_series],
+                                                  top_n=len(all_episodes)),
+                         use_container_width=True, hide_index=True)
+    
     # Distribution Analysis
     st.markdown("---")
     st.markdown("### 📊 Returns Distribution")
@@ -2635,6 +5724,125 @@ with tab2:
             If your returns aren't normal, you might have more risk than you think!</p>
         </div>
     """, unsafe_allow_html=True)
+    
+    # Factor exposure panel
+    st.markdown("---")
+    st.markdown("### 🧬 Factor Exposures")
+    st.markdown("""
+        **What is really driving your returns?** Regresses your portfolio, each holding and your other 
+        saved portfolios on Fama-French style factors (market, size, value, momentum) in one pass.
+    """)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        local_factor_files = list_local_factor_files()
+        for path in local_factor_files:
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name not in st.session_state.factor_data:
+                try:
+                    st.session_state.factor_data[name] = load_factor_returns(path)
+                except (ValueError, OSError) as e:
+                    st.warning(f"Could not read factor file {path}: {str(e)}")
+        
+        uploaded_factors = st.file_uploader(
+            "Upload factor returns (CSV)",
+            type=['csv'],
+            help="Ken French data library format works as-is: a date column (YYYYMMDD or YYYYMM) "
+                 f"followed by one column per factor, with an optional RF column. Files in ./{FACTOR_DATA_DIR}/ load automatically.",
+            key="factor_upload"
+        )
+        if uploaded_factors is not None:
+            name = os.path.splitext(uploaded_factors.name)[0]
+            if name not in st.session_state.factor_data:
+                try:
+                    st.session_state.factor_data[name] = load_factor_returns(uploaded_factors)
+                except ValueError as e:
+                    st.error(f"Could not parse factor file: {str(e)}")
+    
+    with col2:
+        factor_sets = list(st.session_state.factor_data.keys())
+        selected_factor_set = st.selectbox("Factor Set", factor_sets, key="factor_set") if factor_sets else None
+        
+        # Rolling windows count observations, so monthly factor files need monthly windows
+        factor_index = st.session_state.factor_data[selected_factor_set].index if selected_factor_set else None
+        monthly_factors = (factor_index is not None and len(factor_index) > 1 and
+                           np.median(np.diff(factor_index.values).astype('timedelta64[D]').astype(float)) > 20)
+        window_unit = 'months' if monthly_factors else 'days'
+        factor_window = st.select_slider(
+            f"Rolling Window ({window_unit})",
+            options=[12, 24, 36, 60] if monthly_factors else [63, 126, 252, 504],
+            value=36 if monthly_factors else 252,
+            key=f"factor_window_{window_unit}"
+        )
+    
+    if selected_factor_set is None:
+        st.info(f"📁 No factor data loaded. Upload a CSV above or place files in ./{FACTOR_DATA_DIR}/ "
+                "(e.g. F-F_Research_Data_Factors_daily.CSV from the Ken French data library).")
+    else:
+        factor_returns = st.session_state.factor_data[selected_factor_set]
+        
+        # Portfolio, its holdings and every other saved portfolio in one regression panel;
+        # portfolio columns are labelled so a portfolio named like a ticker cannot collide
+        portfolio_column = f"{st.session_state.current_portfolio} (portfolio)"
+        exposure_returns = pd.concat(
+            [portfolio_returns.rename(portfolio_column), get_asset_returns(prices)] +
+            [other['returns'].rename(f"{name} (portfolio)") for name, other in st.session_state.portfolios.items()
+             if name != st.session_state.current_portfolio],
+            axis=1
+        )
+        
+        try:
+            exposures = get_factor_exposures(exposure_returns, factor_returns, factor_window)
+        except ValueError as e:
+            st.warning(f"⚠️ {str(e)}")
+            exposures = None
+        
+        if exposures is not None:
+            static = exposures['static']
+            exposure_table = static['betas'].round(2)
+            exposure_table.insert(0, 'Alpha (ann.)', static['alpha'].map(lambda x: f"{x:+.2%}"))
+            exposure_table.insert(1, 'Alpha t-stat', static['t_stats']['Alpha'].round(2))
+            exposure_table['R²'] = static['r_squared'].map(lambda x: f"{x:.1%}")
+            exposure_table['Residual Vol'] = static['residual_vol'].map(lambda x: f"{x:.2%}")
+            st.dataframe(exposure_table, use_container_width=True)
+            portfolio_observations = static['observations'][portfolio_column]
+            st.caption(f"Based on {portfolio_observations} overlapping {window_unit} of "
+                       "data for this portfolio. "
+                       "|t-stat| above 2 means the exposure is statistically meaningful.")
+            
+            rolling_betas = exposures['rolling']
+            if not rolling_betas or portfolio_column not in rolling_betas['Alpha'].columns:
+                st.info(f"📉 Rolling betas need at least {factor_window} {window_unit} of overlapping data - "
+                        f"this portfolio has {portfolio_observations}. Choose a shorter window.")
+            else:
+                fig, ax = plt.subplots(figsize=(12, 6))
+                for factor in static['betas'].columns:
+                    beta_path = rolling_betas[factor][portfolio_column]
+                    ax.plot(beta_path.index, beta_path.values, linewidth=2, label=factor)
+                ax.axhline(y=0, color='black', linewidth=1)
+                ax.set_title(f'Rolling {factor_window}-{window_unit[:-1].title()} Factor Betas - {st.session_state.current_portfolio}',
+                             fontsize=14, fontweight='bold', pad=15)
+                ax.set_xlabel('Date', fontsize=12, fontweight='bold')
+                ax.set_ylabel('Beta', fontsize=12, fontweight='bold')
+                ax.legend(loc='best', frameon=True, shadow=True, fontsize=10)
+                ax.grid(True, alpha=0.3, linestyle='--')
+                ax.set_facecolor('#f8f9fa')
+                fig.patch.set_facecolor('white')
+                plt.tight_layout()
+                st.pyplot(fig)
+            
+            st.markdown("""
+                <div class="interpretation-box">
+                    <div class="interpretation-title">💡 Reading Factor Exposures</div>
+                    <ul>
+                        <li><strong>Mkt-RF:</strong> sensitivity to the overall market (1.0 = moves with the market)</li>
+                        <li><strong>SMB:</strong> positive = tilted to small companies, negative = large caps</li>
+                        <li><strong>HML:</strong> positive = value tilt, negative = growth tilt</li>
+                        <li><strong>Mom:</strong> positive = owns recent winners</li>
+                        <li><strong>Alpha:</strong> return not explained by the factors - only meaningful with a large t-stat</li>
+                    </ul>
+                </div>
+            """, unsafe_allow_html=True)
 
 
 # =============================================================================
@@ -2937,39 +6145,16 @@ with tab3:
     def calculate_all_metrics(returns, benchmark_returns=None):
         """Calculate all metrics needed for grading"""
         metrics = calculate_portfolio_metrics(returns, benchmark_returns)
+        stats = get_return_statistics(returns)
         
         # Add additional metrics for grading
         returns_series = returns if isinstance(returns, pd.Series) else returns.iloc[:, 0]
         
-        # Win rate
-        win_rate = (returns_series > 0).sum() / len(returns_series)
-        
         # Best and worst month
-        monthly_returns = returns_series.resample('M').apply(lambda x: (1 + x).prod() - 1)
+        monthly_returns = get_calendar_returns(returns_series)['M']
         best_month = monthly_returns.max() if len(monthly_returns) > 0 else 0
         worst_month = monthly_returns.min() if len(monthly_returns) > 0 else 0
         
-        # Recovery time (average days to recover from drawdown)
-        cum_returns = (1 + returns_series).cumprod()
-        running_max = cum_returns.expanding().max()
-        drawdown = (cum_returns - running_max) / running_max
-        
-        # Find drawdown periods
-        in_drawdown = drawdown < 0
-        if in_drawdown.any():
-            # Calculate average recovery time
-            recovery_periods = []
-            start_dd = None
-            for i, (date, is_dd) in enumerate(in_drawdown.items()):
-                if is_dd and start_dd is None:
-                    start_dd = date
-                elif not is_dd and start_dd is not None:
-                    recovery_periods.append((date - start_dd).days)
-                    start_dd = None
-            avg_recovery_days = np.mean(recovery_periods) if recovery_periods else 0
-        else:
-            avg_recovery_days = 0
-        
         return {
             'Annual Return': metrics['Annual Return'],
             'Sharpe Ratio': metrics['Sharpe Ratio'],
@@ -2977,12 +6162,12 @@ with tab3:
             'Max Drawdown': metrics['Max Drawdown'],
             'Volatility': metrics['Annual Volatility'],
             'Calmar Ratio': metrics['Calmar Ratio'],
-            'Win Rate': win_rate,
+            'Win Rate': stats['Win Rate'],
             'Best Month': best_month,
             'Worst Month': worst_month,
             'Alpha': metrics.get('Alpha', 0),
             'Beta': metrics.get('Beta', 1),
-            'Avg Recovery Days': avg_recovery_days
+            'Avg Recovery Days': stats['Avg Recovery Days']
         }
     
     def grade_metric(metric_name, value):
@@ -3275,6 +6460,17 @@ with tab3:
                 </div>
             """, unsafe_allow_html=True)
         
+        # Drawdown episodes behind the recovery grade
+        st.markdown("---")
+        st.markdown("#### 🕳️ Drawdown Episodes Behind Your Recovery Grade")
+        
+        graded_episodes = get_return_statistics(portfolio_returns)['Drawdown Episodes']
+        if not graded_episodes.empty:
+            st.dataframe(format_drawdown_episodes(graded_episodes), use_container_width=True, hide_index=True)
+            if graded_episodes['Open'].iloc[-1]:
+                st.caption("⏳ The current drawdown is still open and counts toward Avg Recovery Days "
+                           "with the days elapsed so far.")
+        
         # Grade interpretation
         st.markdown("---")
         st.markdown("#### 📖 Understanding Your Grades")
@@ -3519,15 +6715,71 @@ with tab4:
         </div>
     """, unsafe_allow_html=True)
     
-    # Detect regimes
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        regime_method = st.radio(
+            "Detection Method",
+            ["Threshold Rules", "Hidden Markov Model"],
+            horizontal=True,
+            help="Threshold Rules: rolling return above/below ±2% and volatility above/below its median. "
+                 "Hidden Markov Model: learns hidden market states and their switching probabilities from the data."
+        )
+    
+    with col2:
+        if regime_method == "Threshold Rules":
+            regime_lookback = st.select_slider(
+                "Regime Lookback (trading days)",
+                options=list(REGIME_LOOKBACKS),
+                value=60,
+                help="Shorter lookbacks react faster to market changes; longer ones show the bigger trend"
+            )
+        else:
+            hmm_states = st.slider("Hidden States", min_value=2, max_value=5, value=3,
+                                   help="Number of distinct market states the model looks for")
+    
+    # Detect regimes for every lookback in one cached pass
     with st.spinner("Analyzing market regimes..."):
-        regimes = detect_market_regimes(portfolio_returns, lookback=60)
+        all_regimes = get_market_regimes(portfolio_returns, REGIME_LOOKBACKS)
+        
+        if regime_method == "Threshold Rules":
+            regimes = all_regimes[regime_lookback]
+        else:
+            # Reuse the stored fit: filter a few new days incrementally, otherwise warm-start a refit
+            hmm_returns = portfolio_returns.dropna()
+            hmm_key = (st.session_state.current_portfolio, hmm_states)
+            stored_hmm = st.session_state.hmm_models.get(hmm_key)
+            # Weights or tickers edited under the same name: the stored fit describes other returns
+            if stored_hmm is not None and (stored_hmm['last_date'] not in hmm_returns.index or
+                                           stored_hmm.get('fingerprint') != returns_fingerprint(
+                                               hmm_returns.loc[:stored_hmm['last_date']])):
+                stored_hmm = None
+            
+            if stored_hmm is not None and stored_hmm['last_date'] == hmm_returns.index[-1]:
+                hmm_params = stored_hmm['params']
+            elif (stored_hmm is not None
+                  and (hmm_returns.index > stored_hmm['last_date']).sum() < 21):
+                hmm_params = stored_hmm['params']
+                for new_return in hmm_returns[hmm_returns.index > stored_hmm['last_date']]:
+                    hmm_filter_step(hmm_params, new_return)
+            else:
+                hmm_params = fit_gaussian_hmm(hmm_returns, hmm_states,
+                                              init_params=stored_hmm['params'] if stored_hmm else None)
+            
+            st.session_state.hmm_models[hmm_key] = {'params': hmm_params, 'last_date': hmm_returns.index[-1],
+                                                    'fingerprint': returns_fingerprint(hmm_returns)}
+            regimes = hmm_regimes(hmm_returns, hmm_params)
+        
         regime_stats = analyze_regime_performance(portfolio_returns, regimes)
     
     # Current Regime
     st.markdown("---")
     st.markdown("### 🎯 Current Market Regime")
-    current_regime = regimes.iloc[-1]
+    if regime_method == "Hidden Markov Model":
+        # Today's regime from the filtered state probabilities, which include any newly filtered days
+        current_regime = hmm_params['labels'][int(np.argmax(hmm_params['log_alpha']))]
+    else:
+        current_regime = regimes.iloc[-1]
     
     regime_colors = {
         'Bull Market (Low Vol)': '#28a745',
@@ -3583,6 +6835,37 @@ with tab4:
         </div>
     """, unsafe_allow_html=True)
     
+    # Current regime across lookbacks
+    lookback_cols = st.columns(len(REGIME_LOOKBACKS))
+    for col, lookback in zip(lookback_cols, REGIME_LOOKBACKS):
+        with col:
+            lookback_regime = all_regimes[lookback].iloc[-1]
+            st.metric(f"{lookback}-Day Rules View", f"{regime_descriptions[lookback_regime]['emoji']} {lookback_regime}")
+    
+    if regime_method == "Hidden Markov Model":
+        st.markdown("#### 🧬 Hidden Market States")
+        
+        state_probs = np.exp(hmm_params['log_alpha'])
+        expected_days = 1 / np.maximum(1 - np.diag(hmm_params['transition']), 1e-12)
+        
+        hmm_state_df = pd.DataFrame({
+            'State': [f"State {k + 1}" for k in range(len(hmm_params['means']))],
+            'Regime Label': hmm_params['labels'],
+            'Annual Return': [f"{m * 252:.2%}" for m in hmm_params['means']],
+            'Annual Volatility': [f"{s * np.sqrt(252):.2%}" for s in hmm_params['stds']],
+            'Typical Duration': [f"{d:.0f} days" for d in expected_days],
+            'Probability Today': [f"{p:.1%}" for p in state_probs]
+        })
+        st.dataframe(hmm_state_df, use_container_width=True, hide_index=True)
+        
+        with st.expander("📊 State Switching Probabilities"):
+            st.dataframe(pd.DataFrame(hmm_params['transition'],
+                                      index=hmm_state_df['State'], columns=hmm_state_df['State'])
+                         .style.format('{:.1%}'), use_container_width=True)
+        
+        st.caption(f"Fitted in {hmm_params['iterations']} EM iteration(s); refits start from the previous fit, "
+                   "and new closes are filtered in without refitting until 21 new days accumulate.")
+    
     # Regime Timeline
     st.markdown("---")
     st.markdown("### 📊 Regime Timeline & Performance")
@@ -3832,11 +7115,51 @@ with tab5:
         </div>
     """, unsafe_allow_html=True)
     
+    sim_engine = st.radio(
+        "Simulation Engine",
+        ["Historical (Constant Volatility)", "Regime-Switching", "GARCH(1,1)"],
+        horizontal=True,
+        help="Historical = one average return/volatility. Regime-Switching = paths move between "
+             "the 5 market regimes. GARCH = volatility starts from today's level and clusters."
+    )
+
     with st.spinner("Running Monte Carlo simulation (this may take a moment)..."):
-        simulations = monte_carlo_simulation(portfolio_returns, days_forward=252, num_simulations=1000)
-    
-    fig = plot_monte_carlo_simulation(simulations)
+        if sim_engine == "Regime-Switching":
+            sim_regimes = get_market_regimes(portfolio_returns, REGIME_LOOKBACKS)[60]
+            simulations = regime_switching_simulation(portfolio_returns, sim_regimes,
+                                                      days_forward=252, num_simulations=1000)
+        elif sim_engine == "GARCH(1,1)":
+            simulations = garch_simulation(portfolio_returns, days_forward=252, num_simulations=1000)
+        else:
+            simulations = monte_carlo_simulation(portfolio_returns, days_forward=252, num_simulations=1000)
+
+    fig = plot_monte_carlo_simulation(simulations, title=f'Monte Carlo Simulation - 1 Year Forward ({sim_engine})')
     st.pyplot(fig)
+
+    if sim_engine == "Regime-Switching":
+        regime_model = estimate_regime_transition_matrix(portfolio_returns, sim_regimes)
+        with st.expander("🔄 Regime Transition Probabilities"):
+            transition_df = pd.DataFrame(
+                regime_model['transition_matrix'],
+                index=regime_model['regimes'],
+                columns=regime_model['regimes']
+            )
+            st.dataframe(transition_df.style.format("{:.1%}"), use_container_width=True)
+            st.caption(f"Simulations start in today's regime: "
+                       f"**{regime_model['regimes'][regime_model['current_regime']]}**. "
+                       f"Each row shows the chance of moving to each regime the next day.")
+    elif sim_engine == "GARCH(1,1)":
+        garch_params = fit_garch_11(portfolio_returns)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("Current Volatility", f"{np.sqrt(garch_params['next_variance'] * 252):.2%}",
+                      help="Annualized conditional volatility for tomorrow")
+        with col2:
+            st.metric("Long-Run Volatility", f"{np.sqrt(garch_params['long_run_variance'] * 252):.2%}",
+                      help="Level volatility reverts to over time")
+        with col3:
+            st.metric("Persistence (α+β)", f"{garch_params['alpha'] + garch_params['beta']:.3f}",
+                      help="Closer to 1.0 = volatility shocks fade more slowly")
     
     # Monte Carlo interpretation
     st.markdown("""
@@ -3932,6 +7255,345 @@ with tab5:
         </div>
     """, unsafe_allow_html=True)
 
+    # Goal-Based Planning
+    st.markdown("---")
+    st.markdown("### 🎯 Goal Planning (Contributions & Withdrawals)")
+    st.markdown("""
+        <div class="info-box">
+            <p><strong>Will my plan work?</strong> Simulate 100,000 possible futures for your portfolio
+            including regular monthly contributions (saving) or withdrawals (retirement income),
+            adjusted for inflation.</p>
+        </div>
+    """, unsafe_allow_html=True)
+
+    col1, col2, col3 = st.columns(3)
+
+    with col1:
+        plan_start_value = st.number_input(
+            "Starting Value ($)",
+            min_value=0,
+            max_value=100000000,
+            value=100000,
+            step=10000,
+            key="plan_start_value"
+        )
+        plan_cash_flow = st.number_input(
+            "Monthly Contribution (+) / Withdrawal (-) ($)",
+            min_value=-1000000,
+            max_value=1000000,
+            value=1000,
+            step=100,
+            key="plan_cash_flow",
+            help="Entered in today's dollars - grows with inflation each month"
+        )
+
+    with col2:
+        plan_years = st.slider("Horizon (years)", min_value=1, max_value=40, value=25, key="plan_years")
+        plan_inflation = st.slider("Inflation (%/year)", min_value=0.0, max_value=8.0,
+                                   value=2.5, step=0.5, key="plan_inflation") / 100
+
+    with col3:
+        plan_target = st.number_input(
+            "Goal at End (today's $)",
+            min_value=0,
+            max_value=1000000000,
+            value=1000000,
+            step=50000,
+            key="plan_target",
+            help="Set to 0 to only require that the money never runs out"
+        )
+
+    plan_results = goal_based_simulation(
+        portfolio_returns,
+        initial_value=plan_start_value,
+        periodic_cash_flow=plan_cash_flow,
+        years=plan_years,
+        periods_per_year=12,
+        inflation=plan_inflation,
+        target_value=plan_target if plan_target > 0 else None,
+        num_simulations=100000
+    )
+
+    col1, col2, col3 = st.columns(3)
+
+    with col1:
+        success_prob = plan_results['success_probability']
+        color_class = 'metric-excellent' if success_prob >= 0.85 else 'metric-good' if success_prob >= 0.70 else 'metric-fair' if success_prob >= 0.50 else 'metric-poor'
+        st.markdown(f"""
+            <div class="{color_class}">
+                <h4>Success Probability</h4>
+                <h2>{success_prob:.1%}</h2>
+                <p style="margin-top: 0.5rem;">Goal reached, money never ran out</p>
+            </div>
+        """, unsafe_allow_html=True)
+
+    with col2:
+        median_real = np.median(plan_results['terminal_real'])
+        st.markdown(f"""
+            <div class="metric-card">
+                <h4>Median Ending Value</h4>
+                <h2>${median_real:,.0f}</h2>
+                <p style="margin-top: 0.5rem;">In today's dollars</p>
+            </div>
+        """, unsafe_allow_html=True)
+
+    with col3:
+        depletion_prob = plan_results['depletion_probability']
+        st.markdown(f"""
+            <div class="{'metric-poor' if depletion_prob > 0.10 else 'metric-good'}">
+                <h4>Chance of Running Out</h4>
+                <h2>{depletion_prob:.1%}</h2>
+                <p style="margin-top: 0.5rem;">Portfolio hits $0 before the end</p>
+            </div>
+        """, unsafe_allow_html=True)
+
+    col1, col2 = st.columns(2)
+
+    with col1:
+        plan_pct = plan_results['percentiles']
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.fill_between(plan_pct.index, plan_pct['5th'], plan_pct['95th'],
+                        color='#667eea', alpha=0.15, label='5th-95th %ile')
+        ax.fill_between(plan_pct.index, plan_pct['25th'], plan_pct['75th'],
+                        color='#667eea', alpha=0.35, label='25th-75th %ile')
+        ax.plot(plan_pct.index, plan_pct['50th'], color='#28a745', linewidth=2.5, label='Median')
+        if plan_target > 0:
+            ax.axhline(y=plan_target, color='#dc3545', linestyle='--', linewidth=1.5, label='Goal')
+        ax.set_title('Projected Wealth (Today\'s Dollars)', fontsize=14, fontweight='bold', pad=20)
+        ax.set_xlabel('Years', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Portfolio Value ($)', fontsize=12, fontweight='bold')
+        ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda y, _: f'${y:,.0f}'))
+        ax.legend(loc='best', frameon=True, shadow=True)
+        ax.grid(True, alpha=0.3, linestyle='--')
+        ax.set_facecolor('#f8f9fa')
+        fig.patch.set_facecolor('white')
+        plt.tight_layout()
+        st.pyplot(fig)
+
+    with col2:
+        terminal_real = plan_results['terminal_real']
+        fig, ax = plt.subplots(figsize=(10, 6))
+        upper = np.percentile(terminal_real, 99)
+        ax.hist(np.clip(terminal_real, 0, upper), bins=60, color='#764ba2', alpha=0.7, edgecolor='black')
+        if plan_target > 0:
+            ax.axvline(plan_target, color='#dc3545', linestyle='--', linewidth=2, label='Goal')
+        ax.axvline(np.median(terminal_real), color='#28a745', linestyle='--', linewidth=2, label='Median')
+        ax.set_title('Distribution of Ending Wealth', fontsize=14, fontweight='bold', pad=20)
+        ax.set_xlabel('Ending Value (Today\'s $)', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Number of Simulations', fontsize=12, fontweight='bold')
+        ax.xaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'${x/1e6:.1f}M'))
+        ax.legend(loc='best', frameon=True, shadow=True)
+        ax.grid(True, alpha=0.3, linestyle='--')
+        ax.set_facecolor('#f8f9fa')
+        fig.patch.set_facecolor('white')
+        plt.tight_layout()
+        st.pyplot(fig)
+
+    st.markdown("""
+        <div class="interpretation-box">
+            <div class="interpretation-title">💡 Reading Your Plan</div>
+            <ul>
+                <li><strong>85%+ success:</strong> Plan is robust - most futures reach the goal</li>
+                <li><strong>70-85%:</strong> Reasonable, but have a backup (work longer, spend less)</li>
+                <li><strong>Below 70%:</strong> Plan needs changes - higher savings, lower withdrawals, or a longer horizon</li>
+                <li><strong>Retirees:</strong> Focus on "Chance of Running Out" - keep it under 10%</li>
+            </ul>
+        </div>
+    """, unsafe_allow_html=True)
+    
+    # Historical stress tests
+    st.markdown("---")
+    st.markdown("### 🧨 Historical Stress Tests")
+    st.markdown("""
+        **How would your portfolios have held up in real crises?** Replays every saved portfolio and 
+        key benchmarks through past market crashes. Holdings that did not exist yet are represented 
+        by an older fund with similar exposure.
+    """)
+    
+    if st.checkbox("Run historical stress tests", value=False, key="run_stress_tests"):
+        stress_portfolios = {name: p['weights'] for name, p in st.session_state.portfolios.items()}
+        stress_portfolios.update({
+            'SPY (S&P 500)': {'SPY': 1.0},
+            '60/40 (SPY/AGG)': {'SPY': 0.6, 'AGG': 0.4},
+            'QQQ (Nasdaq 100)': {'QQQ': 1.0},
+            'AGG (Total Bond)': {'AGG': 1.0}
+        })
+        
+        with st.spinner("Replaying crisis windows..."):
+            try:
+                stress_results = get_stress_tests(stress_portfolios)
+            except ValueError as e:
+                st.warning(f"⚠️ {str(e)}")
+                stress_results = None
+        
+        if stress_results is not None:
+            drawdown_grid = stress_results['Max Drawdown'].unstack('Portfolio').reindex(
+                index=list(STRESS_SCENARIOS), columns=list(stress_portfolios)
+            )
+            st.markdown("#### 📉 Maximum Drawdown by Crisis")
+            st.dataframe(
+                drawdown_grid.style.format(lambda x: "N/A" if pd.isna(x) else f"{x:.1%}")
+                .background_gradient(cmap='RdYlGn', vmin=-0.5, vmax=0, axis=None),
+                use_container_width=True
+            )
+            
+            selected_scenario = st.selectbox("Scenario details", list(STRESS_SCENARIOS), key="stress_scenario")
+            scenario_rows = stress_results.loc[selected_scenario].reindex(list(stress_portfolios))
+            start, end = STRESS_SCENARIOS[selected_scenario]
+            st.caption(f"Window: {start} to {end}")
+            
+            scenario_display = pd.DataFrame({
+                'Portfolio': scenario_rows.index,
+                'Return': scenario_rows['Return'].map(lambda x: "N/A" if pd.isna(x) else f"{x:+.1%}"),
+                'Max Drawdown': scenario_rows['Max Drawdown'].map(lambda x: "N/A" if pd.isna(x) else f"{x:.1%}"),
+                'Worst Day': scenario_rows['Worst Day'].map(lambda x: "N/A" if pd.isna(x) else f"{x:.1%}"),
+                'Worst Day Date': scenario_rows['Worst Day Date'].map(lambda d: "" if pd.isna(d) else d.strftime('%Y-%m-%d')),
+                'Days to Recover': scenario_rows['Days to Recover'].map(
+                    lambda x: "Not yet" if pd.isna(x) else f"{int(x)}"
+                ).where(scenario_rows['Covered'], "N/A"),
+                'Proxies Used': scenario_rows['Proxies Used']
+            })
+            st.dataframe(scenario_display, use_container_width=True, hide_index=True)
+            
+            current_name = st.session_state.current_portfolio
+            fig, ax = plt.subplots(figsize=(12, 6))
+            positions = np.arange(len(drawdown_grid))
+            ax.barh(positions - 0.2, drawdown_grid[current_name] * 100, height=0.4, color='#667eea', label=current_name)
+            ax.barh(positions + 0.2, drawdown_grid['SPY (S&P 500)'] * 100, height=0.4, color='#dc3545', label='SPY (S&P 500)')
+            ax.set_yticks(positions)
+            ax.set_yticklabels(drawdown_grid.index)
+            ax.invert_yaxis()
+            ax.set_title('Crisis Drawdowns: Your Portfolio vs S&P 500', fontsize=14, fontweight='bold', pad=15)
+            ax.set_xlabel('Maximum Drawdown (%)', fontsize=12, fontweight='bold')
+            ax.legend(loc='best', frameon=True, shadow=True, fontsize=10)
+            ax.grid(True, alpha=0.3, linestyle='--', axis='x')
+            ax.set_facecolor('#f8f9fa')
+            fig.patch.set_facecolor('white')
+            plt.tight_layout()
+            st.pyplot(fig)
+            
+            st.markdown("""
+                <div class="interpretation-box">
+                    <div class="interpretation-title">💡 Using Stress Tests</div>
+                    <p><strong>Max Drawdown</strong> is the worst peak-to-trough loss inside the crisis window; 
+                    <strong>Days to Recover</strong> counts trading days from the bottom until the prior peak was regained.</p>
+                    <p>Unlike Monte Carlo, these are real sequences of losses - correlations that broke down, 
+                    bonds that did (2008) or did not (2022) protect you. Ask yourself whether you would have 
+                    stayed invested through each one.</p>
+                </div>
+            """, unsafe_allow_html=True)
+    
+    # Hypothetical factor shocks
+    st.markdown("---")
+    st.markdown("### 🎛️ Factor Shock Scenarios")
+    st.markdown("""
+        **What if rates jump 200bp and stocks fall 20%?** Each holding's historical sensitivity to 
+        equities, rates, credit, gold, the dollar and oil is estimated once; any shock is then an instant, 
+        deterministic P&L estimate - a complement to the random Monte Carlo paths above.
+    """)
+    
+    try:
+        macro_sensitivities = get_macro_sensitivities(prices, current['start_date'], current['end_date'])
+    except ValueError as e:
+        st.warning(f"⚠️ {str(e)}")
+        macro_sensitivities = None
+    
+    if macro_sensitivities is not None:
+        shock_betas = macro_sensitivities['betas']
+        shock_factors = list(shock_betas.columns)
+        
+        propagate_shocks = st.checkbox(
+            "Let unshocked factors move with their historical correlation",
+            value=True,
+            help="E.g. an equity shock also widens credit spreads by the amount history suggests",
+            key="propagate_shocks"
+        )
+        shock_cov = macro_sensitivities['factor_cov'] if propagate_shocks else None
+        
+        # Preset scenarios, all evaluated in one matrix product
+        presets = pd.DataFrame(list(SHOCK_PRESETS.values()), index=list(SHOCK_PRESETS))
+        preset_results = apply_factor_shocks(shock_betas, weights, presets, shock_cov)
+        preset_display = pd.DataFrame({
+            'Scenario': presets.index,
+            'Shocks': [', '.join(f"{f} {v:+g}{MACRO_SHOCK_FACTORS[f]['unit']}"
+                                 for f, v in SHOCK_PRESETS[scenario].items())
+                       for scenario in presets.index],
+            'Portfolio P&L': preset_results['portfolio'].map(lambda x: f"{x:+.2%}").values
+        })
+        st.markdown("#### 📋 Preset Scenarios")
+        st.dataframe(preset_display, use_container_width=True, hide_index=True)
+        
+        # Custom scenario
+        st.markdown("#### ✏️ Custom Scenario")
+        shock_cols = st.columns(3)
+        custom_shocks = {}
+        for i, factor in enumerate(shock_factors):
+            unit = MACRO_SHOCK_FACTORS[factor]['unit']
+            with shock_cols[i % 3]:
+                value = st.slider(
+                    f"{factor} ({unit})",
+                    min_value=-300 if unit == 'bp' else -50,
+                    max_value=300 if unit == 'bp' else 50,
+                    value=0,
+                    step=25 if unit == 'bp' else 5,
+                    key=f"shock_{factor}"
+                )
+                if value != 0:
+                    custom_shocks[factor] = value
+        
+        if custom_shocks:
+            custom_result = apply_factor_shocks(shock_betas, weights, pd.DataFrame([custom_shocks]), shock_cov)
+            custom_pnl = custom_result['portfolio'].iloc[0]
+            
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                st.metric("Estimated Portfolio P&L", f"{custom_pnl:+.2%}")
+                st.caption("Factor moves used (proxy returns):")
+                st.dataframe(custom_result['factor_moves'].T.rename(columns={0: 'Move'})
+                             .style.format('{:+.2%}'), use_container_width=True)
+            with col2:
+                holding_pnl = custom_result['holdings'].iloc[0].sort_values()
+                fig, ax = plt.subplots(figsize=(10, 5))
+                colors = ['#28a745' if x >= 0 else '#dc3545' for x in holding_pnl.values]
+                ax.barh(holding_pnl.index, holding_pnl.values * 100, color=colors, alpha=0.8)
+                ax.axvline(x=0, color='black', linewidth=1)
+                ax.set_title('P&L Contribution by Holding', fontsize=14, fontweight='bold', pad=15)
+                ax.set_xlabel('Contribution to Portfolio Return (%)', fontsize=12, fontweight='bold')
+                ax.grid(True, alpha=0.3, linestyle='--', axis='x')
+                ax.set_facecolor('#f8f9fa')
+                fig.patch.set_facecolor('white')
+                plt.tight_layout()
+                st.pyplot(fig)
+        else:
+            st.caption("Move any slider to evaluate a custom scenario.")
+        
+        # Equities x rates grid
+        if {'Equities', 'Rates'} <= set(shock_factors):
+            st.markdown("#### 🗺️ Equity x Rate Shock Map")
+            equity_shocks = np.arange(-40, 25, 5)
+            rate_shocks = np.arange(-200, 325, 50)
+            shock_map = factor_shock_grid(shock_betas, weights, 'Equities', equity_shocks,
+                                          'Rates', rate_shocks, shock_cov)
+            fig, ax = plt.subplots(figsize=(12, 7))
+            sns.heatmap(shock_map * 100, annot=True, fmt='.1f', cmap='RdYlGn', center=0, ax=ax,
+                        xticklabels=[f"{x:+d}%" for x in equity_shocks],
+                        yticklabels=[f"{y:+d}bp" for y in rate_shocks],
+                        cbar_kws={'label': 'Portfolio P&L (%)'})
+            ax.set_title('Portfolio P&L (%) under Combined Equity and Rate Shocks', fontsize=14, fontweight='bold', pad=15)
+            ax.set_xlabel('Equity Shock', fontsize=12, fontweight='bold')
+            ax.set_ylabel('Rate Shock', fontsize=12, fontweight='bold')
+            plt.tight_layout()
+            st.pyplot(fig)
+        
+        st.markdown("""
+            <div class="interpretation-box">
+                <div class="interpretation-title">💡 About Factor Shocks</div>
+                <p>Sensitivities come from daily history, so they describe typical co-movement - real crises 
+                can be worse when correlations jump (see the historical stress tests above). Rate and 
+                spread shocks are translated into bond-fund returns using approximate durations.</p>
+            </div>
+        """, unsafe_allow_html=True)
+
 
 # =============================================================================
 # TAB 6: COMPARE BENCHMARKS (ENHANCED WITH SMART SELECTION)
@@ -4000,7 +7662,6 @@ with tab6:
                 
                 portfolio_6040 = calculate_portfolio_returns(combined_data, np.array([0.6, 0.4]))
                 benchmarks_data['60/40'] = portfolio_6040
-                benchmarks_metrics['60/40'] = calculate_portfolio_metrics(portfolio_6040)
         else:
             # Download single benchmark
             bench_data = get_benchmark_data_openbb(benchmark_symbol, current['start_date'], current['end_date'])
@@ -4008,7 +7669,10 @@ with tab6:
                 bench_returns = bench_data.pct_change().dropna()
                 bench_returns_series = bench_returns.iloc[:, 0] if isinstance(bench_returns, pd.DataFrame) else bench_returns
                 benchmarks_data[benchmark_symbol] = bench_returns_series
-                benchmarks_metrics[benchmark_symbol] = calculate_portfolio_metrics(bench_returns_series)
+    
+    # Metrics for all benchmarks in one batch
+    if benchmarks_data:
+        benchmarks_metrics = calculate_batch_metrics(pd.DataFrame(benchmarks_data)).to_dict('index')
     
     if not benchmarks_data:
         st.warning("⚠️ Could not load benchmark data. Please check your internet connection.")
@@ -4198,15 +7862,18 @@ with tab6:
         st.markdown("### 📈 Rolling Sharpe Ratio (Risk-Adjusted Performance Over Time)")
         
         window = 60
-        portfolio_rolling_sharpe = (portfolio_returns.rolling(window).mean() * 252) / (portfolio_returns.rolling(window).std() * np.sqrt(252))
+        
+        # Portfolio and every benchmark in one rolling pass; correlation is measured against the portfolio
+        comparison_returns = pd.DataFrame({'Your Portfolio': portfolio_returns, **benchmarks_data})
+        comparison_rolling = get_rolling_statistics(comparison_returns, (window,), benchmark=portfolio_returns)[window]
+        rolling_sharpes = comparison_rolling['Rolling Sharpe']
         
         fig, ax = plt.subplots(figsize=(14, 8))
-        portfolio_rolling_sharpe.plot(ax=ax, linewidth=3, label='Your Portfolio', color='#667eea')
+        rolling_sharpes['Your Portfolio'].plot(ax=ax, linewidth=3, label='Your Portfolio', color='#667eea')
         
-        for i, (name, returns) in enumerate(benchmarks_data.items()):
-            bench_rolling_sharpe = (returns.rolling(window).mean() * 252) / (returns.rolling(window).std() * np.sqrt(252))
-            bench_rolling_sharpe.plot(ax=ax, linewidth=2, label=name,
-                                     color=colors[i % len(colors)], linestyle='--', alpha=0.8)
+        for i, name in enumerate(benchmarks_data.keys()):
+            rolling_sharpes[name].plot(ax=ax, linewidth=2, label=name,
+                                       color=colors[i % len(colors)], linestyle='--', alpha=0.8)
         
         ax.axhline(y=1, color='#28a745', linestyle=':', linewidth=1.5, alpha=0.7, label='Good (1.0)')
         ax.axhline(y=0, color='#dc3545', linestyle=':', linewidth=1.5, alpha=0.7)
@@ -4235,6 +7902,30 @@ with tab6:
                 </ul>
             </div>
         """, unsafe_allow_html=True)
+        
+        # Rolling correlation with the portfolio (from the same rolling pass)
+        st.markdown("#### 🔗 Rolling Correlation with Your Portfolio")
+        
+        fig, ax = plt.subplots(figsize=(14, 6))
+        for i, name in enumerate(benchmarks_data.keys()):
+            comparison_rolling['Rolling Correlation'][name].plot(ax=ax, linewidth=2, label=name,
+                                                                 color=colors[i % len(colors)], alpha=0.8)
+        
+        ax.axhline(y=0, color='#dc3545', linestyle=':', linewidth=1.5, alpha=0.7)
+        ax.set_title(f'Rolling {window}-Day Correlation vs Your Portfolio', fontsize=14, fontweight='bold')
+        ax.set_xlabel('Date', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Correlation', fontsize=12, fontweight='bold')
+        ax.set_ylim(-1.05, 1.05)
+        ax.legend(loc='best', frameon=True, shadow=True, fontsize=10)
+        ax.grid(True, alpha=0.3, linestyle='--')
+        ax.set_facecolor('#f8f9fa')
+        fig.patch.set_facecolor('white')
+        
+        plt.tight_layout()
+        st.pyplot(fig)
+        
+        st.caption("High correlation means the benchmark is a fair yardstick; "
+                   "falling correlation shows when your strategy behaves differently.")
 
 
 
@@ -4511,12 +8202,54 @@ with tab7:
     st.markdown("---")
     st.markdown("### 📊 Current vs Optimal Allocation")
     
+    col1, col2, col3 = st.columns(3)
+    
+    with col1:
+        optimization_method = st.selectbox(
+            "Objective",
+            list(OPTIMIZATION_METHODS.keys()),
+            format_func=lambda m: OPTIMIZATION_METHODS[m],
+            help="Max Sharpe = best risk-adjusted return; Risk Parity = equal risk contribution; "
+                 "Min CVaR = smallest average loss on the worst 5% of days"
+        )
+    
+    with col2:
+        max_weight = st.slider(
+            "Max Weight per Asset",
+            min_value=min(95, int(np.ceil(20 / len(prices.columns))) * 5),
+            max_value=100,
+            value=100,
+            step=5,
+            format="%d%%",
+            help="Cap any single holding to limit concentration"
+        ) / 100
+    
+    with col3:
+        target_vol = st.slider(
+            "Target Volatility",
+            min_value=2,
+            max_value=40,
+            value=10,
+            format="%d%%",
+            disabled=optimization_method != 'target_volatility',
+            help="Used by the Target Volatility objective: highest return with volatility at or below this level"
+        ) / 100
+    
     # Calculate optimal weights
     with st.spinner("Optimizing portfolio..."):
-        optimal_weights = optimize_portfolio(prices, method='max_sharpe')
+        optimal_weights = optimize_portfolio(prices, method=optimization_method,
+                                             bounds=(0, max_weight), target_volatility=target_vol,
+                                             moments=moments)
         optimal_returns = calculate_portfolio_returns(prices, optimal_weights)
         optimal_metrics = calculate_portfolio_metrics(optimal_returns)
     
+    if optimization_method == 'target_volatility':
+        model_vol = np.sqrt(optimal_weights @ moments['cov_matrix'].values @ optimal_weights)
+        if model_vol > target_vol + 1e-4:
+            st.warning(f"⚠️ A {target_vol:.0%} target is below the lowest volatility these holdings can reach "
+                       f"with a {max_weight:.0%} weight cap ({model_vol:.1%}). Showing the minimum-variance "
+                       "portfolio instead - raise the target or add lower-risk assets.")
+    
     col1, col2 = st.columns(2)
     
     with col1:
@@ -4535,7 +8268,7 @@ with tab7:
         st.pyplot(fig)
     
     with col2:
-        st.markdown("#### Optimal Allocation (Max Sharpe)")
+        st.markdown(f"#### Optimal Allocation ({OPTIMIZATION_METHODS[optimization_method]})")
         optimal_weights_dict = {ticker: w for ticker, w in zip(prices.columns, optimal_weights)}
         optimal_weights_df = pd.DataFrame({
             'Ticker': list(optimal_weights_dict.keys()),
@@ -4611,7 +8344,8 @@ with tab7:
     st.markdown("### 📊 Efficient Frontier")
     
     with st.spinner("Calculating efficient frontier..."):
-        results, weights_array = calculate_efficient_frontier(prices, num_portfolios=500)
+        results, weights_array = calculate_efficient_frontier(prices, num_portfolios=100000, moments=moments)
+        exact_frontier = calculate_exact_efficient_frontier(prices, num_points=50, moments=moments)
         
         # Current and optimal portfolio metrics
         current_annual_return = metrics['Annual Return']
@@ -4620,7 +8354,8 @@ with tab7:
         optimal_annual_return = optimal_metrics['Annual Return']
         optimal_annual_vol = optimal_metrics['Annual Volatility']
     
-    fig = plot_efficient_frontier(results, optimal_weights, optimal_annual_return, optimal_annual_vol)
+    fig = plot_efficient_frontier(results, optimal_weights, optimal_annual_return, optimal_annual_vol,
+                                  frontier=exact_frontier)
     
     # Add current portfolio to plot
     ax = fig.axes[0]
@@ -4632,6 +8367,27 @@ with tab7:
     
     st.pyplot(fig)
     
+    col1, col2 = st.columns(2)
+    for col, (label, point) in zip([col1, col2], [("Minimum Variance", exact_frontier['min_variance']),
+                                                  ("Tangency (Max Sharpe)", exact_frontier['tangency'])]):
+        with col:
+            st.markdown(f"#### {label}")
+            st.markdown(f"Return: **{point['return']:.2%}** · Volatility: **{point['volatility']:.2%}** · "
+                       f"Sharpe: **{point['sharpe']:.2f}**")
+            held = point['weights'][point['weights'] > 0.0001].sort_values(ascending=False)
+            st.dataframe(pd.DataFrame({
+                'Ticker': held.index,
+                'Weight': [f"{w*100:.2f}%" for w in held.values]
+            }), use_container_width=True, hide_index=True)
+    
+    with st.expander("📋 Frontier Portfolios"):
+        frontier_df = exact_frontier['weights'].copy()
+        frontier_df.insert(0, 'Sharpe', exact_frontier['sharpe'])
+        frontier_df.insert(0, 'Volatility', exact_frontier['volatilities'])
+        frontier_df.insert(0, 'Return', exact_frontier['returns'])
+        st.dataframe(frontier_df.style.format('{:.2%}', subset=[c for c in frontier_df.columns if c != 'Sharpe'])
+                     .format('{:.2f}', subset=['Sharpe']), use_container_width=True)
+    
     # Efficient frontier interpretation
     st.markdown("""
         <div class="interpretation-box">
@@ -4647,7 +8403,8 @@ with tab7:
             <ul>
                 <li><strong>Blue circle:</strong> Your current portfolio</li>
                 <li><strong>Red star:</strong> Optimal portfolio (highest Sharpe)</li>
-                <li><strong>Upper edge:</strong> "Efficient frontier" - best return for each risk level</li>
+                <li><strong>Dark line:</strong> The exact efficient frontier - best return for each risk level</li>
+                <li><strong>Blue diamond / orange cross:</strong> Minimum-variance and tangency (max Sharpe) portfolios on the frontier</li>
             </ul>
             <p><strong>How to Read Your Position:</strong></p>
             <ul>
@@ -4665,6 +8422,212 @@ with tab7:
         </div>
     """, unsafe_allow_html=True)
     
+    # Risk attribution: who drives the risk, current vs optimal
+    st.markdown("---")
+    st.markdown("### 🧩 Risk Attribution")
+    st.markdown("""
+        **Which holdings are driving your risk?** A holding's share of risk is often very different from 
+        its share of capital. Contributions add up exactly to the portfolio total.
+    """)
+    
+    asset_returns = get_asset_returns(prices)
+    current_risk = calculate_risk_contributions(asset_returns, weights, cov_matrix=moments['cov_matrix'].values)
+    optimal_risk = calculate_risk_contributions(asset_returns, optimal_weights, cov_matrix=moments['cov_matrix'].values)
+    
+    risk_display = pd.DataFrame({
+        'Ticker': current_risk['contributions'].index,
+        'Weight': current_risk['contributions']['Weight'].map(lambda x: f"{x:.1%}"),
+        '% of Volatility': current_risk['contributions']['% of Vol'].map(lambda x: f"{x:.1%}"),
+        '% of VaR (95%)': current_risk['contributions']['% of VaR'].map(lambda x: f"{x:.1%}"),
+        '% of CVaR (95%)': current_risk['contributions']['% of CVaR'].map(lambda x: f"{x:.1%}"),
+        'Optimal Weight': optimal_risk['contributions']['Weight'].map(lambda x: f"{x:.1%}"),
+        'Optimal % of Vol': optimal_risk['contributions']['% of Vol'].map(lambda x: f"{x:.1%}")
+    })
+    
+    col1, col2 = st.columns([3, 2])
+    
+    with col1:
+        st.dataframe(risk_display, use_container_width=True, hide_index=True)
+        st.caption(f"Current portfolio: volatility {current_risk['volatility']:.2%} (annual), "
+                   f"VaR {current_risk['var']:.2%} and CVaR {current_risk['cvar']:.2%} (daily, 95%)")
+    
+    with col2:
+        contributions = current_risk['contributions']
+        fig, ax = plt.subplots(figsize=(8, 6))
+        positions = np.arange(len(contributions))
+        ax.barh(positions - 0.2, contributions['Weight'] * 100, height=0.4, color='#667eea', label='Capital Weight')
+        ax.barh(positions + 0.2, contributions['% of Vol'] * 100, height=0.4, color='#dc3545', label='Risk Contribution')
+        ax.set_yticks(positions)
+        ax.set_yticklabels(contributions.index)
+        ax.set_title('Capital vs Risk Allocation', fontsize=14, fontweight='bold', pad=15)
+        ax.set_xlabel('Share of Portfolio (%)', fontsize=12, fontweight='bold')
+        ax.legend(loc='best', frameon=True, shadow=True, fontsize=10)
+        ax.grid(True, alpha=0.3, linestyle='--', axis='x')
+        ax.set_facecolor('#f8f9fa')
+        fig.patch.set_facecolor('white')
+        plt.tight_layout()
+        st.pyplot(fig)
+    
+    top_risk = contributions['% of Vol'].idxmax()
+    st.markdown(f"""
+        <div class="interpretation-box">
+            <div class="interpretation-title">💡 Risk Concentration</div>
+            <p><strong>{top_risk}</strong> is {contributions.loc[top_risk, 'Weight']:.1%} of your capital but 
+            {contributions.loc[top_risk, '% of Vol']:.1%} of your volatility.</p>
+            <p>Holdings whose risk share is far above their weight are where trimming reduces risk the most; 
+            a negative contribution means the holding is hedging the rest of the portfolio.</p>
+        </div>
+    """, unsafe_allow_html=True)
+    
+    # Brinson return attribution against a benchmark
+    st.markdown("#### 📐 Return Attribution vs Benchmark")
+    attribution_benchmarks = ['SPY (S&P 500)'] + [name for name in st.session_state.portfolios
+                                                 if name != st.session_state.current_portfolio]
+    attribution_benchmark = st.selectbox("Benchmark", attribution_benchmarks, key="attribution_benchmark")
+    
+    if attribution_benchmark == 'SPY (S&P 500)':
+        benchmark_prices = download_ticker_data(['SPY'], current['start_date'], current['end_date'])
+        benchmark_weights = {'SPY': 1.0}
+    else:
+        benchmark_prices = st.session_state.portfolios[attribution_benchmark]['prices']
+        benchmark_weights = st.session_state.portfolios[attribution_benchmark]['weights']
+    
+    if benchmark_prices is None or benchmark_prices.empty:
+        st.warning("⚠️ Benchmark prices unavailable")
+    else:
+        attribution = calculate_brinson_attribution(weights, asset_returns, benchmark_weights,
+                                                    get_asset_returns(benchmark_prices))
+        attribution_display = attribution.copy()
+        for column in attribution_display.columns:
+            attribution_display[column] = attribution_display[column].map(
+                lambda x: "—" if pd.isna(x) else f"{x:+.2%}" if column in ('Allocation', 'Selection', 'Interaction', 'Total') else f"{x:.2%}"
+            )
+        st.dataframe(attribution_display, use_container_width=True)
+        
+        total_effects = attribution.loc['Total']
+        st.markdown(f"""
+            <div class="interpretation-box">
+                <div class="interpretation-title">💡 Where Your Active Return Comes From</div>
+                <p><strong>Active return: {total_effects['Total']:+.2%} per year</strong> 
+                (portfolio {total_effects['Portfolio Return']:.2%} vs benchmark {total_effects['Benchmark Return']:.2%})</p>
+                <ul>
+                    <li><strong>Allocation ({total_effects['Allocation']:+.2%}):</strong> from over/underweighting categories</li>
+                    <li><strong>Selection ({total_effects['Selection']:+.2%}):</strong> from picking different funds within a category</li>
+                    <li><strong>Interaction ({total_effects['Interaction']:+.2%}):</strong> from over/underweighting categories the benchmark also holds, where your picks also did better or worse. Categories outside the benchmark count fully as allocation</li>
+                </ul>
+            </div>
+        """, unsafe_allow_html=True)
+    
+    # Walk-forward validation of the chosen objective
+    st.markdown("---")
+    st.markdown("### 🚶 Walk-Forward Validation")
+    st.markdown("""
+        **Would this optimizer have worked in real time?** The optimal weights above are fitted on the 
+        same history they are scored on. Walk-forward analysis refits the objective on past data only, 
+        holds the weights until the next refit, and stitches together the truly out-of-sample results.
+    """)
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        wf_train_years = st.select_slider(
+            "Training Window",
+            options=[1, 2, 3, 5],
+            value=3,
+            format_func=lambda y: f"{y} year{'s' if y > 1 else ''}",
+            key="wf_train_years"
+        )
+    with col2:
+        wf_refit = st.selectbox(
+            "Refit Frequency",
+            ['monthly', 'quarterly', 'annual'],
+            index=1,
+            format_func=str.title,
+            key="wf_refit"
+        )
+    with col3:
+        wf_window_type = st.radio(
+            "Window",
+            ['rolling', 'expanding'],
+            format_func=str.title,
+            horizontal=True,
+            key="wf_window_type"
+        )
+    
+    if len(portfolio_returns) <= wf_train_years * 252 + 21:
+        st.warning(f"⚠️ Need more than {wf_train_years} year(s) of history for walk-forward analysis")
+    elif st.checkbox("Run walk-forward backtest", value=False, key="run_walk_forward"):
+        with st.spinner("Refitting across walk-forward folds..."):
+            walk_forward = get_walk_forward(
+                prices, optimization_method, wf_train_years * 252, wf_refit, wf_window_type,
+                covariance_estimator, bounds=(0, max_weight), target_volatility=target_vol
+            )
+        
+        oos_returns = walk_forward['returns']
+        comparison = pd.DataFrame({
+            'Walk-Forward (Out-of-Sample)': oos_returns,
+            'Full-History Optimal (In-Sample)': optimal_returns.reindex(oos_returns.index),
+            'Current Portfolio': portfolio_returns.reindex(oos_returns.index)
+        })
+        comparison_metrics = calculate_batch_metrics(comparison)
+        
+        comparison_display = pd.DataFrame({
+            'Strategy': comparison_metrics.index,
+            'Annual Return': comparison_metrics['Annual Return'].map(lambda x: f"{x:.2%}"),
+            'Volatility': comparison_metrics['Annual Volatility'].map(lambda x: f"{x:.2%}"),
+            'Sharpe Ratio': comparison_metrics['Sharpe Ratio'].map(lambda x: f"{x:.2f}"),
+            'Max Drawdown': comparison_metrics['Max Drawdown'].map(lambda x: f"{x:.2%}")
+        })
+        st.dataframe(comparison_display, use_container_width=True, hide_index=True)
+        
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            fig, ax = plt.subplots(figsize=(10, 6))
+            for (name, series), color in zip(comparison.items(), ['#667eea', '#dc3545', '#28a745']):
+                ax.plot(series.index, (1 + series.fillna(0)).cumprod(), linewidth=2, label=name, color=color)
+            ax.set_title(f'Out-of-Sample Growth since {oos_returns.index[0].strftime("%Y-%m-%d")}',
+                         fontsize=14, fontweight='bold', pad=15)
+            ax.set_xlabel('Date', fontsize=12, fontweight='bold')
+            ax.set_ylabel('Growth of $1', fontsize=12, fontweight='bold')
+            ax.legend(loc='best', frameon=True, shadow=True, fontsize=10)
+            ax.grid(True, alpha=0.3, linestyle='--')
+            ax.set_facecolor('#f8f9fa')
+            fig.patch.set_facecolor('white')
+            plt.tight_layout()
+            st.pyplot(fig)
+        
+        with col2:
+            wf_weights = walk_forward['weights']
+            fig, ax = plt.subplots(figsize=(10, 6))
+            ax.stackplot(wf_weights.index, (wf_weights.clip(lower=0) * 100).T.values,
+                         labels=wf_weights.columns, alpha=0.85, step='post')
+            ax.set_title('Fitted Weights at Each Refit', fontsize=14, fontweight='bold', pad=15)
+            ax.set_xlabel('Refit Date', fontsize=12, fontweight='bold')
+            ax.set_ylabel('Weight (%)', fontsize=12, fontweight='bold')
+            ax.set_ylim(0, 100)
+            ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize=9)
+            ax.set_facecolor('#f8f9fa')
+            fig.patch.set_facecolor('white')
+            plt.tight_layout()
+            st.pyplot(fig)
+        
+        sharpe_gap = (comparison_metrics.loc['Full-History Optimal (In-Sample)', 'Sharpe Ratio'] -
+                      comparison_metrics.loc['Walk-Forward (Out-of-Sample)', 'Sharpe Ratio'])
+        # The first refit has no previous weights to trade from
+        refit_turnover = walk_forward['turnover'].iloc[1:]
+        average_turnover = f"{refit_turnover.mean():.1%}" if len(refit_turnover) > 0 else "N/A"
+        st.markdown(f"""
+            <div class="interpretation-box">
+                <div class="interpretation-title">💡 In-Sample vs Out-of-Sample</div>
+                <p><strong>{len(wf_weights)} refits</strong>, average turnover 
+                {average_turnover} per refit.</p>
+                <p><strong>Sharpe gap (in-sample minus out-of-sample): {sharpe_gap:+.2f}</strong> - 
+                this is how much the full-history optimum flatters itself by knowing the future. 
+                A large gap means the optimizer is fitting noise; prefer more robust objectives 
+                (Min Variance, Risk Parity) or a shrinkage risk model.</p>
+            </div>
+        """, unsafe_allow_html=True)
+    
     # Action Buttons
     st.markdown("---")
     st.markdown("### 🎯 Take Action")
@@ -4676,6 +8639,7 @@ with tab7:
             # Update current portfolio with optimal weights
             st.session_state.portfolios[st.session_state.current_portfolio]['weights'] = optimal_weights_dict
             st.session_state.portfolios[st.session_state.current_portfolio]['returns'] = optimal_returns
+            st.session_state.portfolios[st.session_state.current_portfolio].pop('incremental_metrics', None)
             st.success("✅ Optimal weights applied! Refresh to see changes in other tabs.")
             st.balloons()
     
@@ -4862,6 +8826,188 @@ with tab8:
     
     else:
         st.success("✅ **Portfolio is perfectly balanced!** No rebalancing needed.")
+    
+    # Rebalancing policy backtest
+    st.markdown("---")
+    st.markdown("### 🔁 Rebalancing Policy Backtest")
+    st.markdown("""
+        **How often should you rebalance?** Portfolio returns elsewhere in the app assume you rebalance 
+        to target every day. Here holdings drift with prices and are only reset on your schedule, 
+        with trading costs charged on every rebalance.
+    """)
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        rebalance_schedule = st.selectbox(
+            "Rebalancing Schedule",
+            options=[s for s in REBALANCE_SCHEDULES if s not in ('daily', 'none')],
+            index=1,
+            format_func=lambda s: REBALANCE_SCHEDULES[s],
+            key="backtest_schedule"
+        )
+    with col2:
+        rebalance_band = st.slider(
+            "Drift Band (%)",
+            min_value=1,
+            max_value=20,
+            value=5,
+            disabled=rebalance_schedule != 'band',
+            help="Rebalance whenever any holding drifts this far from its target weight",
+            key="backtest_band"
+        ) / 100
+    with col3:
+        cost_bps = st.number_input(
+            "Transaction Cost (bps per $ traded)",
+            min_value=0.0,
+            max_value=100.0,
+            value=5.0,
+            step=1.0,
+            key="backtest_cost"
+        )
+    
+    backtest_policies = {
+        REBALANCE_SCHEDULES[rebalance_schedule]: run_backtest(prices, weights, rebalance_schedule,
+                                                              rebalance_band, cost_bps / 10000),
+        REBALANCE_SCHEDULES['daily']: run_backtest(prices, weights, 'daily', rebalance_band, cost_bps / 10000),
+        REBALANCE_SCHEDULES['none']: run_backtest(prices, weights, 'none', rebalance_band, cost_bps / 10000)
+    }
+    
+    policy_metrics = calculate_batch_metrics(
+        pd.DataFrame({name: result['returns'] for name, result in backtest_policies.items()})
+    )
+    years = len(portfolio_returns) / 252
+    policy_rows = []
+    for name, result in backtest_policies.items():
+        policy_rows.append({
+            'Policy': name,
+            'Annual Return': f"{policy_metrics.loc[name, 'Annual Return']:.2%}",
+            'Volatility': f"{policy_metrics.loc[name, 'Annual Volatility']:.2%}",
+            'Sharpe Ratio': f"{policy_metrics.loc[name, 'Sharpe Ratio']:.2f}",
+            'Max Drawdown': f"{policy_metrics.loc[name, 'Max Drawdown']:.2%}",
+            'Rebalances': len(result['rebalance_dates']),
+            'Annual Turnover': f"{result['turnover'].sum() / years:.1%}" if years > 0 else "N/A",
+            'Cost Drag (Annual)': f"{result['costs'].sum() / years:.3%}" if years > 0 else "N/A"
+        })
+    st.dataframe(pd.DataFrame(policy_rows), use_container_width=True, hide_index=True)
+    
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        fig, ax = plt.subplots(figsize=(10, 6))
+        for name, result in backtest_policies.items():
+            ax.plot(result['values'].index, result['values'].values, linewidth=2, label=name)
+        ax.set_title('Growth of $1 by Rebalancing Policy', fontsize=14, fontweight='bold', pad=15)
+        ax.set_xlabel('Date', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Portfolio Value ($)', fontsize=12, fontweight='bold')
+        ax.legend(loc='best', frameon=True, shadow=True, fontsize=10)
+        ax.grid(True, alpha=0.3, linestyle='--')
+        ax.set_facecolor('#f8f9fa')
+        fig.patch.set_facecolor('white')
+        plt.tight_layout()
+        st.pyplot(fig)
+    
+    with col2:
+        selected_weights = backtest_policies[REBALANCE_SCHEDULES[rebalance_schedule]]['weights']
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.stackplot(selected_weights.index, (selected_weights * 100).T.values,
+                     labels=selected_weights.columns, alpha=0.85)
+        ax.set_title(f'Weight Drift ({REBALANCE_SCHEDULES[rebalance_schedule]})',
+                     fontsize=14, fontweight='bold', pad=15)
+        ax.set_xlabel('Date', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Weight (%)', fontsize=12, fontweight='bold')
+        ax.set_ylim(0, 100)
+        ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize=9)
+        ax.set_facecolor('#f8f9fa')
+        fig.patch.set_facecolor('white')
+        plt.tight_layout()
+        st.pyplot(fig)
+    
+    st.markdown("""
+        <div class="interpretation-box">
+            <div class="interpretation-title">💡 Choosing a Rebalancing Policy</div>
+            <p><strong>Daily constant mix</strong> is the theoretical ideal, but its turnover makes it expensive in practice.</p>
+            <p><strong>Buy & hold</strong> costs nothing, but winners grow into concentrated positions and risk drifts away from your plan.</p>
+            <p><strong>Calendar or band rebalancing</strong> usually captures most of the risk control with a small fraction 
+            of the turnover - bands trade only when drift actually matters.</p>
+        </div>
+    """, unsafe_allow_html=True)
+    
+    # Policy sweep across schedules, bands and cost assumptions
+    st.markdown("---")
+    st.markdown("### 🧪 Rebalancing Policy Sweep")
+    st.markdown("""
+        **Which policy would have worked best?** Tests every calendar schedule and a range of drift bands 
+        under several trading-cost assumptions, then maps turnover against risk-adjusted return.
+    """)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        sweep_bands = st.multiselect(
+            "Drift Bands (%)",
+            options=[1, 2, 3, 5, 7.5, 10, 15, 20],
+            default=[1, 2, 3, 5, 7.5, 10, 15, 20],
+            key="sweep_bands"
+        )
+    with col2:
+        sweep_costs = st.multiselect(
+            "Transaction Costs (bps)",
+            options=[0, 2, 5, 10, 25, 50],
+            default=[0, 5, 10, 25, 50],
+            key="sweep_costs"
+        )
+    
+    if st.checkbox("Run policy sweep", value=False, key="run_policy_sweep") and sweep_costs:
+        with st.spinner("Backtesting rebalancing policies..."):
+            sweep = get_rebalancing_sweep(
+                prices, weights,
+                bands=tuple(sorted(b / 100 for b in sweep_bands)),
+                transaction_costs=tuple(sorted(c / 10000 for c in sweep_costs))
+            )
+        sweep_metrics = sweep['metrics']
+        frontier = sweep['frontier']
+        
+        st.success(f"✅ Evaluated {len(sweep_metrics)} policies")
+        
+        fig, ax = plt.subplots(figsize=(12, 6))
+        scatter = ax.scatter(sweep_metrics['Annual Turnover'] * 100, sweep_metrics['Sharpe Ratio'],
+                             c=sweep_metrics['Cost'] * 10000, cmap='viridis', s=40, alpha=0.7)
+        ax.plot(frontier['Annual Turnover'] * 100, frontier['Sharpe Ratio'], color='#dc3545',
+                linewidth=2, marker='o', label='Efficient Policies')
+        fig.colorbar(scatter, ax=ax, label='Transaction Cost (bps)')
+        ax.set_title('Turnover vs Sharpe Ratio by Rebalancing Policy', fontsize=14, fontweight='bold', pad=15)
+        ax.set_xlabel('Annual Turnover (%)', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Sharpe Ratio', fontsize=12, fontweight='bold')
+        ax.legend(loc='best', frameon=True, shadow=True, fontsize=10)
+        ax.grid(True, alpha=0.3, linestyle='--')
+        ax.set_facecolor('#f8f9fa')
+        fig.patch.set_facecolor('white')
+        plt.tight_layout()
+        st.pyplot(fig)
+        
+        sweep_display = sweep_metrics.sort_values('Sharpe Ratio', ascending=False).reset_index()
+        sweep_display = pd.DataFrame({
+            'Policy': sweep_display['Policy'],
+            'Rebalances': sweep_display['Rebalances'],
+            'Annual Turnover': sweep_display['Annual Turnover'].map(lambda x: f"{x:.1%}"),
+            'Annual Return': sweep_display['Annual Return'].map(lambda x: f"{x:.2%}"),
+            'Volatility': sweep_display['Annual Volatility'].map(lambda x: f"{x:.2%}"),
+            'Sharpe Ratio': sweep_display['Sharpe Ratio'].map(lambda x: f"{x:.3f}"),
+            'Max Drawdown': sweep_display['Max Drawdown'].map(lambda x: f"{x:.2%}")
+        })
+        st.dataframe(sweep_display, use_container_width=True, hide_index=True, height=400)
+        
+        best_policy = sweep_metrics['Sharpe Ratio'].idxmax()
+        st.markdown(f"""
+            <div class="interpretation-box">
+                <div class="interpretation-title">💡 Reading the Sweep</div>
+                <p><strong>Best Sharpe:</strong> {best_policy} 
+                ({sweep_metrics.loc[best_policy, 'Sharpe Ratio']:.3f} with 
+                {sweep_metrics.loc[best_policy, 'Annual Turnover']:.1%} annual turnover)</p>
+                <p><strong>Efficient policies</strong> (red line) are the ones no cheaper policy beats - anything 
+                below the line trades more for less. Compare points with the same color to see how much 
+                trading costs change the answer.</p>
+            </div>
+        """, unsafe_allow_html=True)
 
 
 # =============================================================================
@@ -4876,16 +9022,11 @@ with tab9:
         High correlation (close to 1.0) = NOT diversified. Low/negative correlation = TRUE diversification.
     """)
     
-    # Calculate correlation matrix
-    returns_df = pd.DataFrame()
-    for ticker in weights.keys():
-        ticker_data = download_ticker_data([ticker], current['start_date'], current['end_date'])
-        if ticker_data is not None:
-            ticker_returns = ticker_data.pct_change().dropna()
-            returns_df[ticker] = ticker_returns.iloc[:, 0] if isinstance(ticker_returns, pd.DataFrame) else ticker_returns
+    # Correlation matrix from the shared risk model (no re-download)
+    returns_df = moments['returns']
     
     if not returns_df.empty:
-        corr_matrix = returns_df.corr()
+        corr_matrix = moments['corr_matrix']
         
         # Display correlation matrix
         st.markdown("### 📊 Correlation Matrix")
@@ -5003,6 +9144,122 @@ with tab9:
             st.warning("⚠️ **Moderate Diversification:** Consider adding more uncorrelated assets.")
         else:
             st.error("🚨 **Poor Diversification:** Assets are highly correlated. You're essentially holding the same thing multiple times.")
+        
+        # Correlations through time
+        st.markdown("---")
+        st.markdown("### 🎞️ Correlations Through Time")
+        st.caption("Correlations are not constant - in crises they tend to spike toward 1.0 exactly when "
+                   "diversification is needed most.")
+        
+        if len(returns_df.columns) < 2:
+            st.info("Add at least two holdings to see how their correlations evolve.")
+        else:
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                corr_method = st.radio(
+                    "Weighting",
+                    ["Rolling Window", "EWMA"],
+                    horizontal=True,
+                    help="Rolling Window weights every day in the window equally; "
+                         "EWMA weights recent days more (half-life = window)"
+                )
+            
+            with col2:
+                corr_window = st.slider("Window / Half-life (days)", min_value=21, max_value=252, value=63, step=21)
+            
+            # Full price history, not the estimation window, so past crises stay visible
+            rolling_corr = get_rolling_correlations(get_asset_returns(prices), corr_window,
+                                                    'ewma' if corr_method == "EWMA" else 'window')
+            corr_dates = rolling_corr['dates']
+            first_valid = corr_window - 1
+            
+            if len(corr_dates) <= first_valid:
+                st.info("Not enough history for the selected window.")
+            else:
+                # Average pairwise correlation over time
+                avg_corr_series = pd.Series(np.nanmean(rolling_corr['correlations'], axis=1), index=corr_dates)
+                
+                fig, ax = plt.subplots(figsize=(14, 5))
+                avg_corr_series.plot(ax=ax, linewidth=2, color='#667eea', label='Average Pairwise Correlation')
+                ax.axhline(y=avg_corr, color='#6c757d', linestyle='--', alpha=0.7, label=f'Correlation Matrix Average ({avg_corr:.2f})')
+                ax.axhline(y=0.85, color='#dc3545', linestyle=':', alpha=0.7, label='High (0.85)')
+                ax.set_title('Average Pairwise Correlation Over Time', fontsize=14, fontweight='bold')
+                ax.set_xlabel('Date', fontsize=11, fontweight='bold')
+                ax.set_ylabel('Correlation', fontsize=11, fontweight='bold')
+                ax.legend(loc='best', frameon=True, shadow=True)
+                ax.grid(True, alpha=0.3, linestyle='--')
+                ax.set_facecolor('#f8f9fa')
+                fig.patch.set_facecolor('white')
+                plt.tight_layout()
+                st.pyplot(fig)
+                
+                # Scrub through time
+                col1, col2 = st.columns([3, 1])
+                
+                with col1:
+                    scrub_date = st.slider(
+                        "Matrix Date",
+                        min_value=corr_dates[first_valid].date(),
+                        max_value=corr_dates[-1].date(),
+                        value=corr_dates[-1].date(),
+                        help="Drag to see the correlation matrix on any date"
+                    )
+                
+                with col2:
+                    matrix_kind = st.radio("Show", ["Correlation", "Beta"], horizontal=True,
+                                           help="Beta = how much the row asset moves per 1% move in the column asset")
+                
+                scrub_idx = max(first_valid, min(corr_dates.searchsorted(pd.Timestamp(scrub_date), side='right') - 1,
+                                                 len(corr_dates) - 1))
+                matrix_at_date = rolling_matrix_at(rolling_corr, scrub_idx, matrix_kind.lower())
+                
+                fig, ax = plt.subplots(figsize=(10, 8))
+                sns.heatmap(
+                    matrix_at_date,
+                    mask=np.triu(np.ones_like(matrix_at_date, dtype=bool)) if matrix_kind == "Correlation" else None,
+                    annot=len(matrix_at_date) <= 15,
+                    fmt='.2f',
+                    cmap='RdYlGn_r',
+                    center=0,
+                    square=True,
+                    linewidths=1,
+                    cbar_kws={"shrink": 0.8},
+                    vmin=-1 if matrix_kind == "Correlation" else None,
+                    vmax=1 if matrix_kind == "Correlation" else None,
+                    ax=ax
+                )
+                ax.set_title(f'{matrix_kind} Matrix on {corr_dates[scrub_idx].strftime("%Y-%m-%d")}',
+                             fontsize=16, fontweight='bold', pad=20)
+                plt.tight_layout()
+                st.pyplot(fig)
+                
+                # Selected pairs over time
+                upper_i, upper_j = rolling_corr['pairs']
+                pair_labels = [f"{rolling_corr['tickers'][i]} / {rolling_corr['tickers'][j]}"
+                               for i, j in zip(upper_i, upper_j)]
+                latest_corr = rolling_corr['correlations'][-1]
+                default_pairs = [pair_labels[k] for k in np.argsort(-np.nan_to_num(latest_corr))[:3]]
+                
+                selected_pairs = st.multiselect("Pairs to Chart", pair_labels, default=default_pairs)
+                
+                if selected_pairs:
+                    fig, ax = plt.subplots(figsize=(14, 6))
+                    for k, label in enumerate(selected_pairs):
+                        pair_idx = pair_labels.index(label)
+                        ax.plot(corr_dates, rolling_corr['correlations'][:, pair_idx], linewidth=2,
+                                label=label, color=plt.cm.tab10(k % 10))
+                    ax.axvline(x=corr_dates[scrub_idx], color='#6c757d', linestyle='--', alpha=0.7)
+                    ax.set_title('Rolling Pair Correlations', fontsize=14, fontweight='bold')
+                    ax.set_xlabel('Date', fontsize=11, fontweight='bold')
+                    ax.set_ylabel('Correlation', fontsize=11, fontweight='bold')
+                    ax.set_ylim(-1.05, 1.05)
+                    ax.legend(loc='best', frameon=True, shadow=True)
+                    ax.grid(True, alpha=0.3, linestyle='--')
+                    ax.set_facecolor('#f8f9fa')
+                    fig.patch.set_facecolor('white')
+                    plt.tight_layout()
+                    st.pyplot(fig)
 
 
 # =============================================================================
@@ -5061,13 +9318,14 @@ with tab10:
         if portfolio3 and portfolio3 not in [portfolio1, portfolio2]:
             portfolios_to_compare[portfolio3] = st.session_state.portfolios[portfolio3]
         
-        # Calculate metrics for each
+        # Calculate metrics for all selected portfolios in one batch
+        compare_returns = pd.DataFrame({name: portfolio_data['returns']
+                                        for name, portfolio_data in portfolios_to_compare.items()})
+        metrics_values = calculate_batch_metrics(compare_returns)
+        
         comparison_data = []
         
-        for name, portfolio_data in portfolios_to_compare.items():
-            returns = portfolio_data['returns']
-            metrics_calc = calculate_portfolio_metrics(returns)
-            
+        for name, metrics_calc in metrics_values.iterrows():
             comparison_data.append({
                 'Portfolio': name,
                 'Annual Return': f"{metrics_calc['Annual Return']:.2%}",
@@ -5091,21 +9349,17 @@ with tab10:
         
         col1, col2, col3 = st.columns(3)
         
-        # Get numeric values for comparison
-        returns_values = {name: st.session_state.portfolios[name]['returns'] for name in portfolios_to_compare.keys()}
-        metrics_values = {name: calculate_portfolio_metrics(returns_values[name]) for name in portfolios_to_compare.keys()}
-        
         # Best return
-        best_return_name = max(metrics_values.keys(), key=lambda x: metrics_values[x]['Annual Return'])
-        best_return_val = metrics_values[best_return_name]['Annual Return']
+        best_return_name = metrics_values['Annual Return'].idxmax()
+        best_return_val = metrics_values.loc[best_return_name, 'Annual Return']
         
         # Best Sharpe
-        best_sharpe_name = max(metrics_values.keys(), key=lambda x: metrics_values[x]['Sharpe Ratio'])
-        best_sharpe_val = metrics_values[best_sharpe_name]['Sharpe Ratio']
+        best_sharpe_name = metrics_values['Sharpe Ratio'].idxmax()
+        best_sharpe_val = metrics_values.loc[best_sharpe_name, 'Sharpe Ratio']
         
         # Best Drawdown (least negative)
-        best_dd_name = max(metrics_values.keys(), key=lambda x: metrics_values[x]['Max Drawdown'])
-        best_dd_val = metrics_values[best_dd_name]['Max Drawdown']
+        best_dd_name = metrics_values['Max Drawdown'].idxmax()
+        best_dd_val = metrics_values.loc[best_dd_name, 'Max Drawdown']
         
         with col1:
             st.metric("🏆 Highest Return", best_return_name, f"{best_return_val:.2%}")
@@ -5201,6 +9455,168 @@ with tab11:
         Our swaps avoid this by using different ETFs that track the same index.
     """)
     
+    st.markdown("---")
+    st.markdown("### 📒 Tax-Lot Ledger")
+    st.caption("Upload your transaction history to track lots, realized gains and wash-sale conflicts")
+    
+    col1, col2 = st.columns([3, 2])
+    with col1:
+        uploaded_ledger = st.file_uploader(
+            "Upload transactions (CSV)",
+            type=['csv'],
+            help="Columns: Date, Ticker, Action (BUY/SELL), Shares, Price. "
+                 "Optional Lot ID names a lot on a BUY and picks the lot to sell on a SELL.",
+            key="tax_ledger_upload"
+        )
+        if uploaded_ledger is not None:
+            try:
+                st.session_state.tax_ledger = load_transactions(uploaded_ledger)
+            except ValueError as e:
+                st.error(f"Could not parse transactions: {str(e)}")
+    with col2:
+        lot_method = st.selectbox(
+            "Lot Selection Method",
+            list(LOT_METHODS.keys()),
+            format_func=lambda m: f"{m} - {LOT_METHODS[m]}",
+            key="lot_method"
+        )
+    
+    ledger = None
+    if st.session_state.tax_ledger is not None:
+        try:
+            ledger = build_tax_lots(st.session_state.tax_ledger, lot_method)
+        except ValueError as e:
+            st.error(f"❌ {str(e)}")
+    
+    if ledger is not None:
+        lots = ledger['lots']
+        realized = ledger['realized']
+        
+        st.markdown("#### Open Lots")
+        open_summary = lots.groupby('Ticker').agg(
+            Lots=('Lot ID', 'count'),
+            Shares=('Shares', 'sum'),
+            Cost_Basis=('Cost Basis', 'sum')
+        ).rename(columns={'Cost_Basis': 'Cost Basis'})
+        open_summary['Avg Cost/Share'] = open_summary['Cost Basis'] / open_summary['Shares']
+        st.dataframe(open_summary.style.format({
+            'Shares': '{:,.2f}',
+            'Cost Basis': '${:,.2f}',
+            'Avg Cost/Share': '${:,.2f}'
+        }), use_container_width=True)
+        
+        with st.expander("📄 All open lots"):
+            st.dataframe(lots.style.format({
+                'Acquired': '{:%Y-%m-%d}',
+                'Shares': '{:,.4f}',
+                'Cost/Share': '${:,.2f}',
+                'Cost Basis': '${:,.2f}'
+            }), use_container_width=True, hide_index=True)
+        
+        st.markdown("#### Realized Gains")
+        if realized.empty:
+            st.info("No sales in the transaction history yet.")
+        else:
+            short_term = realized.loc[realized['Term'] == 'Short', 'Gain/Loss'].sum()
+            long_term = realized.loc[realized['Term'] == 'Long', 'Gain/Loss'].sum()
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Short-Term", f"${short_term:+,.0f}")
+            with col2:
+                st.metric("Long-Term", f"${long_term:+,.0f}")
+            with col3:
+                st.metric("Net Realized", f"${short_term + long_term:+,.0f}")
+            
+            with st.expander("📄 Realized lots"):
+                st.dataframe(realized.style.format({
+                    'Sale Date': '{:%Y-%m-%d}',
+                    'Acquired': '{:%Y-%m-%d}',
+                    'Shares': '{:,.4f}',
+                    'Proceeds': '${:,.2f}',
+                    'Cost Basis': '${:,.2f}',
+                    'Gain/Loss': '${:+,.2f}'
+                }), use_container_width=True, hide_index=True)
+        
+        st.markdown("#### ⚠️ Wash-Sale Check")
+        include_partners = st.checkbox(
+            "Include swap partners (substantially identical funds)",
+            value=True,
+            key="wash_sale_partners",
+            help="Also flags purchases of the ETFs in the swap table and known cheaper equivalents"
+        )
+        wash_sales = detect_wash_sales(ledger, include_partners=include_partners)
+        if wash_sales.empty:
+            st.success(f"✅ No purchases within {WASH_SALE_WINDOW_DAYS} days of a loss sale.")
+        else:
+            disallowed = wash_sales['Disallowed Loss'].sum()
+            st.warning(f"**{len(wash_sales)} wash-sale match(es)** - ${abs(disallowed):,.0f} "
+                       "of realized losses may be disallowed.")
+            st.dataframe(wash_sales.style.format({
+                'Sale Date': '{:%Y-%m-%d}',
+                'Buy Date': '{:%Y-%m-%d}',
+                'Loss': '${:,.2f}',
+                'Buy Shares': '{:,.2f}',
+                'Matched Shares': '{:,.2f}',
+                'Disallowed Loss': '${:,.2f}'
+            }), use_container_width=True, hide_index=True)
+        
+        st.markdown("#### 🎯 Harvest Candidates Across All Lots")
+        st.caption("Every open lot in the ledger (all accounts) is valued at the latest close in one pass")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            short_rate = st.number_input("Short-Term Tax Rate (%)", min_value=0.0, max_value=60.0,
+                                         value=HARVEST_TAX_RATES['Short'] * 100, step=1.0,
+                                         key="harvest_short_rate") / 100
+        with col2:
+            long_rate = st.number_input("Long-Term Tax Rate (%)", min_value=0.0, max_value=40.0,
+                                        value=HARVEST_TAX_RATES['Long'] * 100, step=1.0,
+                                        key="harvest_long_rate") / 100
+        with col3:
+            min_harvest_loss = st.number_input("Minimum Loss ($)", min_value=0.0, max_value=1000000.0,
+                                               value=100.0, step=50.0, key="harvest_min_loss")
+        
+        # The ledger is valued today, independent of the analysis period of the portfolio
+        ledger_prices = get_latest_prices(tuple(sorted(lots['Ticker'].unique())))
+        missing_prices = sorted(set(lots['Ticker']) - set(ledger_prices.index))
+        if missing_prices:
+            st.warning(f"⚠️ No recent price for: {', '.join(missing_prices)} - those lots are skipped.")
+        
+        candidates = scan_tax_loss_harvesting(
+            lots, ledger_prices, as_of=pd.Timestamp.now().normalize(),
+            tax_rates={'Short': short_rate, 'Long': long_rate},
+            min_loss=min_harvest_loss, include_partners=include_partners
+        )
+        if candidates.empty:
+            st.info("No lots are below cost by more than the minimum loss.")
+        else:
+            actionable = candidates[~candidates['Wash Sale Risk']]
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Candidates", f"{len(actionable)} of {len(candidates)}",
+                          help="Candidates without a recent purchase that would trigger a wash sale")
+            with col2:
+                st.metric("Harvestable Loss", f"${abs(actionable['Loss'].sum()):,.0f}")
+            with col3:
+                st.metric("Estimated Tax Savings", f"${actionable['Tax Savings'].sum():,.0f}")
+            
+            if 'Account' in lots.columns:
+                st.caption(f"Scanned {lots['Account'].nunique():,} accounts and {len(lots):,} open lots")
+            else:
+                candidates = candidates.drop(columns='Account')
+            st.dataframe(candidates.style.format({
+                'Shares': '{:,.2f}',
+                'Price': '${:,.2f}',
+                'Cost Basis': '${:,.0f}',
+                'Market Value': '${:,.0f}',
+                'Loss': '${:,.0f}',
+                'Short Loss': '${:,.0f}',
+                'Long Loss': '${:,.0f}',
+                'Tax Savings': '${:,.0f}',
+                'Harvest After': lambda d: '' if pd.isna(d) else f"{d:%Y-%m-%d}"
+            }), use_container_width=True, hide_index=True)
+    else:
+        st.info("📁 No transactions loaded. Without a ledger, enter a per-share cost basis for each holding below.")
+    
     st.markdown("---")
     st.markdown("### 💼 Your Holdings Analysis")
     
@@ -5208,6 +9624,12 @@ with tab11:
     st.markdown("#### Enter Your Cost Basis")
     st.caption("For each holding, enter what you originally paid (your cost basis)")
     
+    ledger_costs = {}
+    if ledger is not None and not ledger['lots'].empty:
+        ledger_basis = ledger['lots'].groupby('Ticker')[['Shares', 'Cost Basis']].sum()
+        ledger_costs = (ledger_basis['Cost Basis'] / ledger_basis['Shares']).to_dict()
+    
+    latest_prices = get_latest_prices(tuple(weights.keys()), current['end_date'])
     holdings_data = []
     for ticker in weights.keys():
         col1, col2, col3 = st.columns([2, 2, 2])
@@ -5216,10 +9638,9 @@ with tab11:
             st.markdown(f"**{ticker}**")
         
         with col2:
-            # Get current price
-            ticker_data = download_ticker_data([ticker], current['end_date'] - timedelta(days=5), current['end_date'])
-            if ticker_data is not None and not ticker_data.empty:
-                current_price = ticker_data.iloc[-1].values[0]
+            # Current price from the batched download
+            if ticker in latest_prices.index:
+                current_price = float(latest_prices[ticker])
                 st.metric("Current Price", f"${current_price:.2f}")
             else:
                 current_price = 100.0
@@ -5229,11 +9650,11 @@ with tab11:
             cost_basis = st.number_input(
                 "Your Cost Basis ($)",
                 min_value=0.0,
-                max_value=10000.0,
-                value=current_price,
+                max_value=1000000.0,
+                value=float(ledger_costs.get(ticker, current_price)),
                 step=0.01,
                 key=f"cost_basis_{ticker}",
-                help="What you originally paid per share"
+                help="What you originally paid per share (defaults to the ledger's average cost when loaded)"
             )
         
         # Calculate gain/loss
@@ -5271,19 +9692,7 @@ with tab11:
     st.markdown("### 🎯 Tax Loss Harvesting Opportunities")
     
     # Map of ETF swaps that avoid wash sale
-    swap_map = {
-        'SPY': {'swap_to': 'VOO', 'name': 'Vanguard S&P 500', 'note': 'Identical index, lower fees'},
-        'VOO': {'swap_to': 'IVV', 'name': 'iShares Core S&P 500', 'note': 'Identical index'},
-        'IVV': {'swap_to': 'SPY', 'name': 'SPDR S&P 500', 'note': 'Identical index'},
-        'QQQ': {'swap_to': 'QQQM', 'name': 'Invesco NASDAQ 100', 'note': 'Identical index, lower fees'},
-        'QQQM': {'swap_to': 'QQQ', 'name': 'Invesco QQQ Trust', 'note': 'Identical index'},
-        'VTI': {'swap_to': 'ITOT', 'name': 'iShares Core Total US', 'note': 'Same exposure'},
-        'ITOT': {'swap_to': 'VTI', 'name': 'Vanguard Total Market', 'note': 'Same exposure'},
-        'IWM': {'swap_to': 'VTWO', 'name': 'Vanguard Russell 2000', 'note': 'Identical index'},
-        'VTWO': {'swap_to': 'VB', 'name': 'Vanguard Small-Cap', 'note': 'Similar exposure'},
-        'AGG': {'swap_to': 'BND', 'name': 'Vanguard Total Bond', 'note': 'Identical exposure'},
-        'BND': {'swap_to': 'AGG', 'name': 'iShares Aggregate Bond', 'note': 'Identical exposure'},
-    }
+    swap_map = TAX_LOSS_SWAP_MAP
     
     harvest_opportunities = []
     for holding in holdings_data: